@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+What it costs TypeChecker and X86_64_Generator to pick the handler of an instruction.
+The first table checks an instruction of each op from a generated program again,
+with its handler picked by an `if/elif` chain in the order the type checker used
+to test them and by `TypeChecker.HANDLERS`, and times looking the op up in
+`X86_64_Generator.HANDLERS`. The second times both stages end to end on the
+program, per instruction, which puts the cost of dispatching in proportion to the
+rest of the work.
+
+    python benchmarks/dispatch.py [functions]
+"""
+import sys
+import time
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+from ir import Op, validate_ir, remove_unused_functions
+from lexer import Lexer
+from parser import Parser
+from type_checker import TypeChecker
+from x86_64_generator import X86_64_Generator
+
+
+# The order that the `if/elif` chain of TypeChecker.check_ tested the ops in.
+CHAIN = [
+    Op.LIT, Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.MOD, Op.AND, Op.OR, Op.EQ, Op.NEQ, Op.LT, Op.ACCESS,
+    Op.DECL, Op.MULTIDECL, Op.ASSIGN, Op.LABEL, Op.CALL, Op._, Op.PARAM, Op.FIELD, Op.INIT, Op.SYSCALL,
+    Op.ASM, Op.INDEX, Op.REF, Op.MOVE, Op.BRW, Op.COPY, Op.PHI, Op.AS, Op.BR, Op.JMP, Op.RET,
+]
+
+
+def make_chain():
+    """
+    An `if/elif` chain like the one that was replaced, as real comparisons instead of a
+    loop, which calls the same handlers as `TypeChecker.HANDLERS`.
+    """
+    lines = ['def dispatch(self, function, block, code):', '    op = code.op']
+    namespace = {'Op': Op}
+    for i, op in enumerate(CHAIN):
+        namespace[f'handler_{i}'] = TypeChecker.HANDLERS[op]
+        lines.append(f'    {"if" if i == 0 else "elif"} op == Op.{op.name}: handler_{i}(self, function, block, code)')
+    exec('\n'.join(lines), namespace)
+    return namespace['dispatch']
+
+
+def program(functions: int) -> str:
+    source = ['import * from system', 'import * from core', '', 'Pair: struct {', '\tleft: int', '\tright: int', '}', '']
+    for i in range(functions):
+        source += [
+            f'f{i}: (n: int) -> int {{',
+            '\tpair := Pair { left = n right = 1 }',
+            '\ti := 0',
+            '\twhile i < n {',
+            '\t\tif i < pair.left {',
+            '\t\t\ti = i + pair.right',
+            '\t\t} else {',
+            '\t\t\ti = i + 2',
+            '\t\t}',
+            '\t}',
+            f'\treturn {f"f{i - 1}(i)" if i else "i"}',
+            '}',
+        ]
+    source.append(f'exit(f{functions - 1}(3))')
+    return '\n'.join(source) + '\n'
+
+
+def best(function, repeat=5) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    functions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    source = program(functions)
+    module = Parser.parse_module(source, Lexer.lex_fast('benchmark.sf', source), 'benchmark.sf')
+    validate_ir(module)
+    remove_unused_functions(module)
+    instructions = sum(1 for f in module.functions.values() for _ in f.code())
+
+    # Checked once, so the checker is left with the types of the function and checking its instructions again changes nothing.
+    function = module.functions[f'f{min(functions - 1, 1)}']
+    checker = TypeChecker(module.name, module.source, module.functions, module.data, module.constants, module.types)
+    checker.check_(only={function.name})
+    samples = {}
+    for block, code in function.code():
+        samples.setdefault(code.op, (block, code))
+
+    dispatch = make_chain()
+    checks, generates = TypeChecker.HANDLERS, X86_64_Generator.HANDLERS
+    number = 100_000
+    print(f'{"op":<10} {"chain (ns)":>12} {"table (ns)":>12} {"generator lookup (ns)":>22}')
+    for op in (Op.LIT, Op.ACCESS, Op.INIT, Op.CALL, Op.BR, Op.RET):
+        if op not in samples:
+            continue
+        block, code = samples[op]
+        run = {**globals(), **locals()}
+        a = min(timeit.repeat('dispatch(checker, function, block, code)', number=number, repeat=7, globals=run)) / number * 1e9
+        b = min(timeit.repeat('checks.get(code.op)(checker, function, block, code)', number=number, repeat=7, globals=run)) / number * 1e9
+        c = min(timeit.repeat('generates.get(code.op)', number=number, repeat=7, globals=run)) / number * 1e9
+        print(f'{op.name:<10} {a:>12.1f} {b:>12.1f} {c:>22.1f}')
+
+    check = best(lambda: TypeChecker.check(module))
+    types = TypeChecker.check(module)
+    generate = best(lambda: X86_64_Generator.generate(module, types, comments=False))
+
+    print()
+    print(f'{instructions} instructions in {functions} functions')
+    print(f'TypeChecker.check        {check / instructions * 1e9:>8.0f} ns per instruction')
+    print(f'X86_64_Generator.generate {generate / instructions * 1e9:>7.0f} ns per instruction')
+
+
+if __name__ == '__main__':
+    main()
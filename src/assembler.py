@@ -6,7 +6,7 @@
 
 INTERNAL_CODE = """\
 ; ---- Built-ins ----
-; void* {rax} alloc(int size {rax})
+; void* {{rax}} alloc(int size {{rax}})
 alloc:
     mov rdi, [rel memory.ptr]       ; Load current pointer (offset in bytes)
 
@@ -26,8 +26,8 @@ alloc:
 
 .error:
     mov rdi, 123                    ; exit code
-    mov rax, 0x2000001              ; SYS_exit
-    syscall
+    mov rax, {exit:<#23x}; SYS_exit
+    {syscall}
 
 """
 INTERNAL_DATA = """
@@ -45,36 +45,14 @@ times 4096-($-memory) db 0
 """
 
 
+import functools
+import os
+import struct
 import subprocess
 
-
-def le16(n):
-  return [
-    n & 0xFF,
-    (n >> 8) & 0xFF
-  ]
-
-
-def le32(n):
-  return [
-    n & 0xFF,
-    (n >> 8) & 0xFF,
-    (n >> 16) & 0xFF,
-    (n >> 24) & 0xFF
-  ]
-
-
-def le64(n):
-  return [
-    n & 0xFF,
-    (n >> 8) & 0xFF,
-    (n >> 16) & 0xFF,
-    (n >> 24) & 0xFF,
-    (n >> 32) & 0xFF,
-    (n >> 40) & 0xFF,
-    (n >> 48) & 0xFF,
-    (n >> 56) & 0xFF
-  ]
+from binary_writer import BinaryWriter
+from linker import Linker, ObjectFile
+from x86_64_encoder import X86_64_Encoder
 
 
 HEADER_SIZE     = 32
@@ -100,47 +78,19 @@ VM_PROT_EXECUTE             = 0x4
 x86_THREAD_STATE64          = 0x4
 x86_EXCEPTION_STATE64_COUNT = 42
 
+SYS_EXIT                    = 0x2000001
+ORIGIN                      = 0x100000000
+HEADERS_SIZE                = HEADER_SIZE + CMD_SIZE + 2 * (CMD_SIZE + SECT_SIZE) + START_CMD_SIZE
 
-def pad_byte_string(string: str, size):
-    return [*string.encode()] + [0] * (size-len(string))
 
+MACH_HEADER     = struct.Struct('<8I')          # mach_header_64
+SEGMENT_COMMAND = struct.Struct('<2I16s4Q4I')   # segment_command_64
+SECTION         = struct.Struct('<16s16s2Q8I')  # section_64
+THREAD_COMMAND  = struct.Struct('<4I21Q')       # thread_command with x86_thread_state64_t
+assert (MACH_HEADER.size, SEGMENT_COMMAND.size, SECTION.size, THREAD_COMMAND.size) == (HEADER_SIZE, CMD_SIZE, SECT_SIZE, START_CMD_SIZE)
 
-def section(name, address, size, offset):
-#   struct section_64 { /* for 64-bit architectures */
-# 	char		sectname[16];	/* name of this section */
-# 	char		segname[16];	/* segment this section goes in */
-# 	uint64_t	addr;		/* memory address of this section */
-# 	uint64_t	size;		/* size in bytes of this section */
-# 	uint32_t	offset;		/* file offset of this section */
-# 	uint32_t	align;		/* section alignment (power of 2) */
-# 	uint32_t	reloff;		/* file offset of relocation entries */
-# 	uint32_t	nreloc;		/* number of relocation entries */
-# 	uint32_t	flags;		/* flags (section type and attributes)*/
-# 	uint32_t	reserved1;	/* reserved (for offset or index) */
-# 	uint32_t	reserved2;	/* reserved (for count or sizeof) */
-# 	uint32_t	reserved3;	/* reserved */
-# };
-    align = 1
-    reloff = 0
-    nreloc = 0
-    flags  = 0
-    return [
-        *pad_byte_string(name.lower(), 16),
-        *pad_byte_string(name.upper(), 16),
-        *le64(address),
-        *le64(size),
-        *le32(offset),
-        *le32(align),
-        *le32(reloff),
-        *le32(nreloc),
-        *le32(flags),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-    ]
-
-
-def macho_header(command_count, command_size):
+
+def macho_header(writer: BinaryWriter, command_count, command_size):
     #   dd MH_MAGIC_64                                      ; magic
     # 	dd CPU_TYPE_X86_64                                  ; cputype
     # 	dd CPU_SUBTYPE_LIB64 | CPU_SUBTYPE_I386_ALL         ; cpusubtype
@@ -149,47 +99,13 @@ def macho_header(command_count, command_size):
     # 	dd __COMMANDSend - __COMMANDSstart                  ; sizeofcmds
     # 	dd MH_NOUNDEFS                                      ; flags
     # 	dd 0x0                                              ; reserved
-    return [
-        *le32(MH_MAGIC_64),
-        *le32(CPU_TYPE_X86_64),
-        *le32(CPU_SUBTYPE_LIB64 | CPU_SUBTYPE_I386_ALL),
-        *le32(MH_EXECUTE),
-        *le32(command_count),
-        *le32(command_size),
-        *le32(MH_NOUNDEFS),
-        *le32(0)
-    ]
-
-def macho_page_zero(origin):
-    #   __PAGEZEROstart:
-    # 	dd LC_SEGMENT_64                                    ; cmd
-    # 	dd __PAGEZEROend - __PAGEZEROstart                  ; command size
-    # 	db '__PAGEZERO', 0, 0, 0, 0, 0, 0                   ; segment name (pad to 16 bytes)
-    # 	dq 0                                                ; vmaddr
-    # 	dq ORIGIN                                           ; vmsize
-    # 	dq 0                                                ; fileoff
-    # 	dq 0                                                ; filesize
-    # 	dd 0                                                ; maxprot
-    # 	dd 0                                                ; initprot
-    # 	dd 0                                                ; nsects
-    # 	dd 0                                                ; flags
-    # __PAGEZEROend:
-    return [
-        *le32(LC_SEGMENT_64),
-        *le32(72),
-        *pad_byte_string('__PAGEZERO', 16),
-        *le64(0),
-        *le64(origin),
-        *le64(0),
-        *le64(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-    ]
-
-
-def macho_load_command(name, origin, size):
+    writer.pack(
+        MACH_HEADER, MH_MAGIC_64, CPU_TYPE_X86_64, CPU_SUBTYPE_LIB64 | CPU_SUBTYPE_I386_ALL,
+        MH_EXECUTE, command_count, command_size, MH_NOUNDEFS, 0
+    )
+
+
+def macho_segment(writer: BinaryWriter, name, address, size, offset, file_size, protection, section_count):
     # __TEXTstart:
     # 	dd LC_SEGMENT_64                                    ; cmd
     # 	dd __TEXTend - __TEXTstart                          ; command size
@@ -203,25 +119,35 @@ def macho_load_command(name, origin, size):
     # 	dd 0                                                ; nsects
     # 	dd 0                                                ; flags
     # __TEXTend:
-    # cmd_size = 72
-    cmd_size = 72 + 80
-    offset = HEADER_SIZE + CMD_SIZE + 2*(CMD_SIZE+SECT_SIZE) + START_CMD_SIZE
-    return [
-        *le32(LC_SEGMENT_64),
-        *le32(cmd_size),
-        *pad_byte_string(name.upper(), 16),
-        *le64(origin if name == '__TEXT' else origin + 4096),
-        *le64(size),
-        *le64(HEADER_SIZE+CMD_SIZE if name == '__TEXT' else HEADER_SIZE+CMD_SIZE+CMD_SIZE+SECT_SIZE),
-        *le64(CMD_SIZE+SECT_SIZE),
-        *le32(VM_PROT_READ | VM_PROT_EXECUTE if name == '__TEXT' else VM_PROT_READ | VM_PROT_WRITE),
-        *le32(VM_PROT_READ | VM_PROT_EXECUTE if name == '__TEXT' else VM_PROT_READ | VM_PROT_WRITE),
-        *le32(1),
-        *le32(0),
-        *section(name, origin, size-offset, offset if name == '__TEXT' else  4096)
-    ]
-
-def macho_start(entry):
+    writer.pack(
+        SEGMENT_COMMAND, LC_SEGMENT_64, CMD_SIZE + section_count * SECT_SIZE, name.encode(),
+        address, size, offset, file_size, protection, protection, section_count, 0
+    )
+
+
+def macho_section(writer: BinaryWriter, name, segment, address, size, offset):
+#   struct section_64 { /* for 64-bit architectures */
+# 	char		sectname[16];	/* name of this section */
+# 	char		segname[16];	/* segment this section goes in */
+# 	uint64_t	addr;		/* memory address of this section */
+# 	uint64_t	size;		/* size in bytes of this section */
+# 	uint32_t	offset;		/* file offset of this section */
+# 	uint32_t	align;		/* section alignment (power of 2) */
+# 	uint32_t	reloff;		/* file offset of relocation entries */
+# 	uint32_t	nreloc;		/* number of relocation entries */
+# 	uint32_t	flags;		/* flags (section type and attributes)*/
+# 	uint32_t	reserved1;	/* reserved (for offset or index) */
+# 	uint32_t	reserved2;	/* reserved (for count or sizeof) */
+# 	uint32_t	reserved3;	/* reserved */
+# };
+    align = 1
+    reloff = 0
+    nreloc = 0
+    flags  = 0
+    writer.pack(SECTION, name.encode(), segment.encode(), address, size, offset, align, reloff, nreloc, flags, 0, 0, 0)
+
+
+def macho_start(writer: BinaryWriter, entry):
     # __UNIX_THREADstart:
     # 	dd LC_UNIXTHREAD                            ; cmd
     # 	dd __UNIX_THREADend - __UNIX_THREADstart    ; cmdsize
@@ -233,181 +159,93 @@ def macho_start(entry):
     # 	dq 0, 0, 0, 0                               ; r12, r13, r14, r15
     # 	dq __codestart, 0, 0, 0, 0                  ; rip, rflags, cs, fs, gs
     # __UNIX_THREADend:
-    return [
-        *le32(LC_UNIXTHREAD),
-        *le32(184),
-        *le32(x86_THREAD_STATE64),
-        *le32(x86_EXCEPTION_STATE64_COUNT),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(entry),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-    ]
+    writer.pack(
+        THREAD_COMMAND, LC_UNIXTHREAD, START_CMD_SIZE, x86_THREAD_STATE64, x86_EXCEPTION_STATE64_COUNT,
+        *[0] * 16, entry, 0, 0, 0, 0
+    )
 
 
 def round_up_to_multiple_of_two(number, multiple):
     return (number + multiple - 1) & -multiple
 
-# %rdi, %rsi, %rdx, %rcx, %r8 and %r9
-def make_macho_executable(output, code, data, generate_debug=False):
-    origin = 0x100000000
 
-    head_s = 32
-    zero_s = 72
-    text_s = 72+80
-    data_s = 72+80
-    start_s = 184
-    all_header_s = head_s + zero_s + text_s + data_s + start_s
+def assemble_with_nasm(output, program):
+    """Assembles the program with nasm instead, to cross-check the built-in encoder."""
+    os.makedirs('build', exist_ok=True)
+    with open(f'build/{output}.s', 'w') as file:
+        file.write(program)
 
-    entry = origin + all_header_s
+    try:
+        status = subprocess.run(['nasm', '-f', 'bin', '-w+all', '-o', f'build/{output}.nasm', f'build/{output}.s'], capture_output=True)
+    except FileNotFoundError:
+        raise RuntimeError('Cross-checking the encoder requires nasm to be installed')
+    if status.returncode != 0:
+        raise RuntimeError(f'"{' '.join(status.args)}" failed with status code {status.returncode}:\n{status.stdout}\n{status.stderr}' )
+    with open(f'build/{output}.nasm', 'rb') as file:
+        return file.read()
 
-    header = f'BITS 64\norg {entry}\n'
-    program = header+code+INTERNAL_CODE+INTERNAL_DATA+data+PAD_DATA
 
-    subprocess.run(['mkdir', '-p', 'build'])
-    with open(f'build/{output}.s', 'w') as file:
-        file.write(program)
+def assemble(output, program, cross_check=False):
+    """The binary of the program and the start address of each of its sections."""
+    encoder = X86_64_Encoder(program)
+    binary = encoder.layout()
+    if cross_check:
+        reference = assemble_with_nasm(output, program)
+        if reference != binary:
+            offset = next((i for i, (a, b) in enumerate(zip(binary, reference)) if a != b), min(len(binary), len(reference)))
+            raise RuntimeError(f'The encoder and nasm disagree on build/{output}.s at offset {offset:#x} (size {len(binary)} vs {len(reference)})')
+    return binary, encoder.sections
+
+
+@functools.cache
+def builtins_object(exit_syscall) -> ObjectFile:
+    return ObjectFile.assemble(INTERNAL_CODE.format(exit=exit_syscall, syscall='syscall'))
+
+
+def link_program(objects, data, exit_syscall, origin):
+    """Links the objects of the functions with the built-ins and the data, like `assemble` on their sources."""
+    objects = [*objects, builtins_object(exit_syscall), ObjectFile.assemble(INTERNAL_DATA + data + PAD_DATA)]
+    return Linker.link(objects, origin)
+
+
+# %rdi, %rsi, %rdx, %rcx, %r8 and %r9
+def make_macho_executable(output, code, data, generate_debug=False, cross_check=False):
+    entry = ORIGIN + HEADERS_SIZE
+
+    header = f'BITS 64\norg {entry}\n'
+    program = header+code+INTERNAL_CODE.format(exit=SYS_EXIT, syscall='syscall')+INTERNAL_DATA+data+PAD_DATA
 
     # Code binary
-    status = subprocess.run(['nasm', '-f', 'bin', '-w+all', '-o', f'build/{output}', f'build/{output}.s'], capture_output=True)
-    if status.returncode != 0:
-        raise RuntimeError(f'"{' '.join(status.args)}" failed with status code {status.args}:\n{status.stdout}\n{status.stderr}' )
-    status = subprocess.run(['chmod', '+x', f'build/{output}'], capture_output=True)
-    if status.returncode != 0:
-        raise RuntimeError(f'"{', '.join(status.args)}" failed with status code {status.args}:\n{status.stdout}\n{status.stderr}' )
-    binary = open(f'build/{output}', 'rb').read()
+    binary, _ = assemble(output, program, cross_check)
 
     # Debug code
     if generate_debug:
+        os.makedirs('build', exist_ok=True)
         header = f'BITS 64\nglobal _start\n_start:\n'
-        debug = header + code + INTERNAL_CODE + INTERNAL_DATA + data + PAD_DATA
+        debug = header + code + INTERNAL_CODE.format(exit=SYS_EXIT, syscall='syscall') + INTERNAL_DATA + data + PAD_DATA
         with open(f'build/{output}_debug.s', 'w') as file:
             file.write(debug)
         subprocess.run(['nasm', '-f', 'macho64', '-g', '-F', 'dwarf', '-w+all', f'build/{output}_debug.s', '-o', f'build/{output}_debug.o', '&&', 'ld', '-macos_version_min', '11.0', '-L', '/Library/Developer/CommandLineTools/SDKs/MacOSX.sdk/usr/lib/', '-lSystem', '-o', f'build/{output}_debug', '-e', '_start', f'build/{output}_debug.o'], capture_output=True)
 
-    zero  = [
-        *le32(LC_SEGMENT_64),
-        *le32(CMD_SIZE),
-        *pad_byte_string('__PAGEZERO', 16),
-        *le64(0),
-        *le64(origin),
-        *le64(0),
-        *le64(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-    ]
-    offset = len(zero)
-    text  = [
-        *le32(LC_SEGMENT_64),
-        *le32(CMD_SIZE + SECT_SIZE),
-        *pad_byte_string('__TEXT', 16),
-        *le64(origin),
-        *le64(4096),
-        *le64(0),
-        *le64(4096),
-        *le32(VM_PROT_READ | VM_PROT_EXECUTE),
-        *le32(VM_PROT_READ | VM_PROT_EXECUTE),
-        *le32(1),
-        *le32(0),
-        # Section 1
-        *pad_byte_string('__text', 16),
-        *pad_byte_string('__TEXT', 16),
-        *le64(origin+all_header_s),
-        *le64(4096-all_header_s),
-        *le32(all_header_s),
-        *le32(1),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-    ]
-    data_ = [
-        *le32(LC_SEGMENT_64),
-        *le32(CMD_SIZE+SECT_SIZE),
-        *pad_byte_string('__DATA', 16),
-        *le64(origin+4096),
-        *le64(4096),
-        *le64(4096),
-        *le64(4096),
-        *le32(VM_PROT_READ | VM_PROT_WRITE),
-        *le32(VM_PROT_READ | VM_PROT_WRITE),
-        *le32(1),
-        *le32(0),
-        # Section 1
-        *pad_byte_string('__data', 16),
-        *pad_byte_string('__DATA', 16),
-        *le64(origin+4096),
-        *le64(4096),
-        *le32(4096),
-        *le32(1),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-        *le32(0),
-    ]
-    start = [
-        *le32(LC_UNIXTHREAD),
-        *le32(184),
-        *le32(x86_THREAD_STATE64),
-        *le32(x86_EXCEPTION_STATE64_COUNT),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(entry),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-        *le64(0),
-    ]
-    command_size = len(zero) + len(text) + len(data_) + len(start)
-    head  = [
-        *le32(MH_MAGIC_64),
-        *le32(CPU_TYPE_X86_64),
-        *le32(CPU_SUBTYPE_LIB64 | CPU_SUBTYPE_I386_ALL),
-        *le32(MH_EXECUTE),
-        *le32(4),
-        *le32(command_size),
-        *le32(MH_NOUNDEFS),
-        *le32(0)
-    ]
-
-    executable = bytes(head + zero + text + data_ + start) + binary
-    result = executable + bytes([0] * (4096-len(executable)))  # Pad
-
-    return result, program
+    return macho_container(binary), program
+
+
+def link_macho_executable(objects, data):
+    """The executable of separately assembled functions, which is the same as `make_macho_executable` of their code."""
+    binary, _ = link_program(objects, data, SYS_EXIT, ORIGIN + HEADERS_SIZE)
+    return macho_container(binary)
+
+
+def macho_container(binary):
+    page = 4096
+    command_size = CMD_SIZE + 2 * (CMD_SIZE + SECT_SIZE) + START_CMD_SIZE
+    writer = BinaryWriter(max(HEADERS_SIZE + len(binary), page))
+    macho_header(writer, 4, command_size)
+    macho_segment(writer, '__PAGEZERO', 0, ORIGIN, 0, 0, 0, 0)
+    macho_segment(writer, '__TEXT', ORIGIN, page, 0, page, VM_PROT_READ | VM_PROT_EXECUTE, 1)
+    macho_section(writer, '__text', '__TEXT', ORIGIN + HEADERS_SIZE, page - HEADERS_SIZE, HEADERS_SIZE)
+    macho_segment(writer, '__DATA', ORIGIN + page, page, page, page, VM_PROT_READ | VM_PROT_WRITE, 1)
+    macho_section(writer, '__data', '__DATA', ORIGIN + page, page, page)
+    macho_start(writer, ORIGIN + HEADERS_SIZE)
+    writer.write(binary)
+    return writer.getvalue()
@@ -0,0 +1,30 @@
+import struct
+
+
+class BinaryWriter:
+    """
+    Writes a binary into a buffer that is allocated once up front. Headers are
+    packed in place with precompiled `struct.Struct` layouts and blobs are copied
+    in with slice assignment, so no byte is ever a separate Python object. What
+    isn't written stays zero, which makes padding free.
+    """
+
+    def __init__(self, size: int):
+        self.buffer = bytearray(size)
+        self.position = 0
+
+    def pack(self, layout: struct.Struct, *values):
+        layout.pack_into(self.buffer, self.position, *values)
+        self.position += layout.size
+
+    def write(self, data):
+        end = self.position + len(data)
+        assert end <= len(self.buffer), f'Writing {len(data)} bytes at {self.position} overflows the buffer of {len(self.buffer)} bytes'
+        self.buffer[self.position:end] = data
+        self.position = end
+
+    def seek(self, position: int):
+        self.position = position
+
+    def getvalue(self) -> bytearray:
+        return self.buffer
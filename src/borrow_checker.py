@@ -11,6 +11,17 @@ class State(Enum):
     EXCLUSIVELY_BORROWED = auto()
 
 
+# From the least to the most restrictive. Where paths meet, a variable is in the most
+# restrictive state it's in on any of them, so nothing is allowed that one path forbids.
+ORDER = {state: i for i, state in enumerate((
+    State.OWNING, State.SHARED_BORROWING, State.EXCLUSIVELY_BORROWING,
+    State.SHARED_BORROWED, State.EXCLUSIVELY_BORROWED, State.MOVED,
+))}
+# A borrowed variable is paired with the sorted names of its borrowers instead of one name,
+# as it can be borrowed by one variable on one path and by another on another.
+BORROWED = (State.SHARED_BORROWED, State.EXCLUSIVELY_BORROWED)
+
+
 class BorrowChecker:
     def __init__(self, functions, data, constants, user_types):
         self.functions = functions
@@ -18,7 +29,9 @@ class BorrowChecker:
         self.constants = constants
         self.user_types = user_types
         self.state = {}
-        self.successors = {}
+        # The offset of the last use of each variable in each block, and the variables used after each block.
+        self.last_uses: dict[str, dict[str, int]] = {}
+        self.live_out: dict[str, set[str]] = {}
 
     @staticmethod
     def check(module):
@@ -29,93 +42,160 @@ class BorrowChecker:
         self = BorrowChecker(functions, data, constants, user_types)
         return self.check_()
 
+    @staticmethod
+    def join(states: list[dict]) -> dict:
+        """
+        The state of each variable where paths meet. The states of a variable are ordered
+        by how restrictive they are and then by the other variable, so this is the
+        greatest of them, except that a variable borrowed on several paths is borrowed
+        by all of their borrowers. Either way a variable's state only changes a few times.
+        """
+        result = {}
+        for state in states:
+            for name, s in state.items():
+                old = result.get(name)
+                if old is None:
+                    result[name] = s
+                elif old[0] in BORROWED and s[0] in BORROWED:
+                    result[name] = (max(old[0], s[0], key=ORDER.get), tuple(sorted({*old[1], *s[1]})))
+                elif (ORDER[s[0]], s[1] or '') > (ORDER[old[0]], old[1] or ''):
+                    result[name] = s
+        return result
+
     def has_later_use(self, block, offset, var):
-        for code in block.instructions[offset:]:
-            if var in code.refs:
-                return True
-        return False
+        """Whether the variable is used at or after `offset` in the block, or in a block after it."""
+        return self.last_uses[block.label].get(var, -1) >= offset or var in self.live_out[block.label]
+
+    @staticmethod
+    def release(state, name):
+        """Ends the loan held by `name`, which is about to be defined again."""
+        held = state.get(name)
+        if held is None or held[0] not in (State.SHARED_BORROWING, State.EXCLUSIVELY_BORROWING):
+            return
+        lender = state.get(held[1])
+        if lender is not None and lender[0] in BORROWED and name in lender[1]:
+            borrowers = tuple(b for b in lender[1] if b != name)
+            if not borrowers:
+                state[held[1]] = (State.OWNING, None)
+            elif any(state.get(b, (None, ))[0] == State.EXCLUSIVELY_BORROWING for b in borrowers):
+                state[held[1]] = (State.EXCLUSIVELY_BORROWED, borrowers)
+            else:
+                state[held[1]] = (State.SHARED_BORROWED, borrowers)
 
     def check_block(self, block, state):
-        """Check a single block for borrow errors"""
+        """
+        Check a single block for borrow errors, which updates the state as it goes. The
+        whole block is gone through even after an error, so the state it leaves doesn't
+        depend on where the error was. The first error is returned.
+        """
+        first = None
         for i, code in enumerate(block.instructions):
-            if code.op == Op.MOVE:
-                dst = code.dest
-                src = code.refs[0]
+            if code.dest is not None:
+                self.release(state, code.dest)
+            error = self.check_code(block, i, code, state)
+            first = first or error
 
-                # Check if the source is in a state that doesn't allow moving
-                if state[src][0] == State.MOVED:
-                    return f"'{dst}' cannot move '{src}'; '{src}' is already moved to '{state[src][1]}'"
-                if state[src][0] == State.EXCLUSIVELY_BORROWED:
-                    return f"'{dst}' cannot move '{src}'; '{src}' is exclusively borrowed by '{state[src][1]}'"
-                if state[src][0] == State.SHARED_BORROWED:
-                    return f"'{dst}' cannot move '{src}'; '{src}' is shared borrowed by '{state[src][1]}'"
-
-                # Check if the source is borrowed by another variable
-                # for name, (status, var) in state.items():
-                #     if status == State.EXCLUSIVELY_BORROWED and var == src:
-                #         return f"Cannot move '{src}' while it is exclusively borrowed by '{name}'"
-                #     if status == State.SHARED_BORROWED and var == src:
-                #         return f"Cannot move '{src}' while it is shared borrowed by '{name}'"
-
-                state[dst] = (State.OWNING, src)
-                state[src] = (State.MOVED, dst)
-            elif code.op == Op.BRW:
+            if code.op in (Op.MOVE, Op.BRW, Op.REF):
                 dst = code.dest
                 src = code.refs[0]
-
-                # Check if the source is in a state that doesn't allow shared borrowing
-                if state[src][0] == State.MOVED:
-                    return f"'{dst}' cannot share borrow '{src}'; '{src}' was moved to '{state[src][1]}'"
-                if state[src][0] == State.EXCLUSIVELY_BORROWED:
-                    return f"'{dst}' cannot share borrow '{src}'; '{src}' is exclusively borrowed from '{state[src][1]}'"
-
-                state[dst] = (State.SHARED_BORROWING, src)
-                state[src] = (State.SHARED_BORROWED,  dst)
-            elif code.op == Op.REF:
-                dst = code.dest
-                src = code.refs[0]
-
-                # Check if the source is in a state that doesn't allow immutable borrowing
-                if state[src][0] == State.MOVED and self.has_later_use(block, i+1, state[src][1]):
-                    return f"'{dst}' cannot mutably borrow moved value '{src}'; '{src}' was moved from '{state[src][1]}'"
-                if state[src][0] == State.SHARED_BORROWED and self.has_later_use(block, i+1, state[src][1]):
-                    return f"'{dst}' cannot mutably borrow '{src}'; '{src}' already shared borrowed by '{state[src][1]}'"
-                if state[src][0] == State.EXCLUSIVELY_BORROWED and self.has_later_use(block, i+1, state[src][1]):
-                    return f"'{dst}' cannot mutably borrow '{src}'; '{src}' already exclusively borrowed by '{state[src][1]}'"
-
-                state[dst] = (State.EXCLUSIVELY_BORROWING, src)
-                state[src] = (State.EXCLUSIVELY_BORROWED,  dst)
+                if code.op == Op.MOVE:
+                    state[dst] = (State.OWNING, src)
+                    state[src] = (State.MOVED, dst)
+                elif code.op == Op.BRW:
+                    # Any number of shared borrows can be held at once.
+                    shared = state[src][1] if state[src][0] == State.SHARED_BORROWED else ()
+                    state[dst] = (State.SHARED_BORROWING, src)
+                    state[src] = (State.SHARED_BORROWED,  tuple(sorted({*shared, dst})))
+                else:
+                    state[dst] = (State.EXCLUSIVELY_BORROWING, src)
+                    state[src] = (State.EXCLUSIVELY_BORROWED,  (dst, ))
             else:
-                for ref in code.refs:
-                    if ref in state:
-                        if state[ref][0] == State.MOVED:
-                            return f"Cannot use moved value '{ref}', it was moved to '{state[ref][1]}'"
                 state[code.dest] = (State.OWNING, None)
 
+        return first
+
+    def check_code(self, block, i, code, state):
+        """The borrow error of the instruction at offset `i`, if any."""
+        if code.op == Op.MOVE:
+            dst = code.dest
+            src = code.refs[0]
+
+            # Check if the source is in a state that doesn't allow moving
+            if state[src][0] == State.MOVED:
+                return f"'{dst}' cannot move '{src}'; '{src}' is already moved to '{state[src][1]}'"
+            if state[src][0] == State.EXCLUSIVELY_BORROWED:
+                return f"'{dst}' cannot move '{src}'; '{src}' is exclusively borrowed by '{state[src][1][0]}'"
+            if state[src][0] == State.SHARED_BORROWED:
+                return f"'{dst}' cannot move '{src}'; '{src}' is shared borrowed by '{state[src][1][0]}'"
+        elif code.op == Op.BRW:
+            dst = code.dest
+            src = code.refs[0]
+
+            # Check if the source is in a state that doesn't allow shared borrowing
+            if state[src][0] == State.MOVED:
+                return f"'{dst}' cannot share borrow '{src}'; '{src}' was moved to '{state[src][1]}'"
+            if state[src][0] == State.EXCLUSIVELY_BORROWED:
+                return f"'{dst}' cannot share borrow '{src}'; '{src}' is exclusively borrowed from '{state[src][1][0]}'"
+        elif code.op == Op.REF:
+            dst = code.dest
+            src = code.refs[0]
+
+            # Check if the source is in a state that doesn't allow immutable borrowing
+            if state[src][0] == State.MOVED and self.has_later_use(block, i+1, state[src][1]):
+                return f"'{dst}' cannot mutably borrow moved value '{src}'; '{src}' was moved from '{state[src][1]}'"
+            if state[src][0] in BORROWED:
+                # Only a borrower that's used later still holds its loan.
+                for borrower in state[src][1]:
+                    if self.has_later_use(block, i+1, borrower):
+                        # The borrowers may have borrowed in different ways on different paths.
+                        kind = 'exclusively' if state.get(borrower, (None, ))[0] == State.EXCLUSIVELY_BORROWING else 'shared'
+                        return f"'{dst}' cannot mutably borrow '{src}'; '{src}' already {kind} borrowed by '{borrower}'"
+        else:
+            for ref in code.refs:
+                if ref in state:
+                    if state[ref][0] == State.MOVED:
+                        return f"Cannot use moved value '{ref}', it was moved to '{state[ref][1]}'"
         return None
 
-    def dfs(self, name: str, block: Block, state):
-        error = self.check_block(block, state)
-        if error:
-            raise RuntimeError(f"Error in function '{name}' at block '{block.label}': {error}")
-
-        for neighbour in self.successors[block.label]:
-            new_state = state.copy()
-            self.dfs(name, neighbour, new_state)
+    def check_function(self, name: str, function: Function):
+        """
+        Finds the state of the variables coming into each block with a dataflow analysis,
+        which joins the states where paths meet, so each block is checked once for all of
+        them instead of once for each path, and loops are checked until nothing changes.
+        Blocks that can't be reached from the entry are never run, so they aren't checked
+        and their empty state adds nothing where they meet the others.
+        """
+        reachable = {function.blocks[0].label}
+        stack = [function.blocks[0]]
+        while stack:
+            for successor in function.successors[stack.pop().label]:
+                if successor.label not in reachable:
+                    reachable.add(successor.label)
+                    stack.append(successor)
+
+        def transfer(block: Block, state: dict) -> dict:
+            if block.label not in reachable:
+                return {}
+            state = dict(state)
+            self.check_block(block, state)
+            return state
+
+        self.last_uses = {b.label: b.last_uses() for b in function.blocks}
+        _, self.live_out = function.live_variables()
+        in_, _ = function.analyze({}, {}, merge=lambda _, states: BorrowChecker.join(states), transfer=transfer, forward=True)
+        for block in function.reverse_postorder():
+            if block.label not in reachable:
+                continue
+            error = self.check_block(block, dict(in_[block.label]))
+            if error:
+                raise RuntimeError(f"Error in function '{name}' at block '{block.label}': {error}")
 
     def check_(self):
         """Borrow checking"""
-        # Assuming DAG for now.
         for name, function in self.functions.items():
             if isinstance(function, Function):
-                self.successors = function.successors
-                entry = function.entry()
-                state = {}
                 try:
-                    self.dfs(name, entry, state)
+                    self.check_function(name, function)
                 except RuntimeError as e:
                     return str(e)
         return None
-
-
-
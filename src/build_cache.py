@@ -0,0 +1,100 @@
+import functools
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Optional
+
+from import_cache import ImportCache
+from ir import Op
+
+
+class BuildCache:
+    """
+    Cache of the stages of a build, written to `directory` so an unchanged program
+    isn't compiled again. Entries are keyed by a hash of what the stage is built
+    from, which always includes the version of the compiler. The imports of the
+    source are only known after parsing, so the type-checked IR is keyed by the
+    source and records the fingerprints of its imports, and is used while they are
+    unchanged. What's built from a function on its own, its types, assembly and
+    object, is keyed by its `function_key` and the stage, so an edit only builds the
+    functions it changed again. The assembly of the program is keyed by the keys of
+    its functions and their comments, and the executable by the keys of its functions
+    and the data, so an unchanged program isn't linked again.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory: str = 'build/.cache'):
+        self.directory = Path(directory)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    @functools.cache
+    def compiler_version() -> str:
+        """A hash of the source of the compiler, so any change to it is a new version."""
+        digest = hashlib.sha256()
+        root = Path(__file__).parent
+        for path in sorted(root.rglob('*.py')):
+            digest.update(str(path.relative_to(root)).encode())
+            digest.update(path.read_bytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(*parts) -> str:
+        digest = hashlib.sha256(BuildCache.compiler_version().encode())
+        for part in parts:
+            digest.update(repr(part).encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    @staticmethod
+    def dependencies(paths) -> dict[str, tuple[int, str]]:
+        return {path: ImportCache.fingerprint(path) for path in sorted(paths)}
+
+    @staticmethod
+    def function_key(module, function) -> str:
+        """
+        A key for what's built from a function: its IR, the signatures of the functions
+        it calls and the constants and types it sees. The tokens are left out, so a
+        function that only moved in the source isn't built again.
+        """
+        body, calls, constants = [], {}, {}
+        for block in function.blocks:
+            body.append(block.label)
+            for code in (*block.instructions, block.terminator):
+                body.append((code.op.name, code.dest, code.args, code.refs))
+                if code.op == Op.CALL:
+                    callee = module.functions.get(code.args[0])
+                    calls[code.args[0]] = callee and (callee.params, callee.returns)
+                constants.update((r, module.constants[r]) for r in code.refs if type(r) == str and r in module.constants)
+        return BuildCache.key(
+            'function', function.name, function.params, function.returns, function.is_main, function.is_module,
+            body, sorted(calls.items()), sorted(constants.items()), sorted(module.types.items()),
+        )
+
+    def load(self, key: str) -> Optional[tuple[Any, dict[str, tuple[int, str]]]]:
+        """The value and dependencies stored at `key`, if the dependencies are unchanged."""
+        try:
+            with open(self.file_of(key), 'rb') as file:
+                version, dependencies, payload = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            version = None
+        if version != BuildCache.VERSION or not ImportCache.is_fresh(dependencies):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(payload), dependencies
+
+    def store(self, key: str, value: Any, dependencies: Optional[dict[str, tuple[int, str]]] = None):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entry = (BuildCache.VERSION, dependencies or {}, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        # Written to the side and renamed, so parallel builds never read half an entry.
+        temporary = self.file_of(key).with_suffix(f'.{os.getpid()}.tmp')
+        with open(temporary, 'wb') as file:
+            pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.file_of(key))
+
+    def file_of(self, key: str) -> Path:
+        return self.directory / (key + '.pickle')
@@ -0,0 +1,58 @@
+INSTRUCTION, LABEL, COMMENT, TEXT = range(4)
+
+
+class Emitter:
+    """
+    Collects generated assembly as a list of records that are formatted and joined
+    once at the end. Without `comments`, comments are dropped, and callers check the
+    flag before building expensive ones.
+    """
+
+    def __init__(self, comments: bool = True):
+        self.comments = comments
+        self.records: list[tuple] = []
+
+    def instruction(self, mnemonic, *operands, comment=None):
+        self.records.append((INSTRUCTION, mnemonic, operands, comment if self.comments else None))
+
+    def label(self, name: str):
+        self.records.append((LABEL, name))
+
+    def comment(self, text: str, indent: bool = True):
+        if self.comments:
+            self.records.append((COMMENT, text, indent))
+
+    def text(self, text: str):
+        """Verbatim lines, like inline assembly."""
+        self.records.append((TEXT, text))
+
+    def blank(self):
+        self.records.append((TEXT, '\n'))
+
+    @staticmethod
+    def format_instruction(mnemonic, operands, comment) -> str:
+        if len(operands) == 2:
+            a = operands[0] + ',' if len(operands[0]) == 3 else operands[0] + ', '
+            line = f'\t{mnemonic:<5} {a:<3} {operands[1]:<3}'
+        elif len(operands) == 1:
+            line = f'\t{mnemonic:<5} {operands[0]:<7}'
+        elif len(operands) == 0:
+            line = f'\t{mnemonic:<13}'
+        else:
+            assert False, f'Too many operands for {mnemonic}'
+        if comment: line += f'\t\t; {comment}'
+        return line + '\n'
+
+    def assemble(self) -> str:
+        lines = []
+        for record in self.records:
+            kind = record[0]
+            if kind == INSTRUCTION:
+                lines.append(Emitter.format_instruction(*record[1:]))
+            elif kind == LABEL:
+                lines.append(f'{record[1]}:\n')
+            elif kind == COMMENT:
+                lines.append(f'\t; {record[1]}\n' if record[2] else f'; {record[1]}\n')
+            else:
+                lines.append(record[1])
+        return ''.join(lines)
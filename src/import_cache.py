@@ -0,0 +1,90 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Optional
+
+
+class ImportCache:
+    """
+    Cache of parsed library modules for `import * from X`, keyed by the path of
+    the module. An entry is valid as long as the module and everything it
+    imported are unchanged, which is checked by mtime and, if the mtime moved,
+    by content hash. Entries are kept pickled so every lookup gets its own copy
+    of the IR, and are optionally written to `directory` to survive between runs.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = Path(directory) if directory else None
+        # path -> (dependencies, payload), where dependencies is path -> (mtime, digest).
+        self.entries: dict[str, tuple[dict[str, tuple[int, str]], bytes]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(path: str, source: Optional[str] = None) -> tuple[int, str]:
+        mtime = os.stat(path).st_mtime_ns
+        if source is None:
+            with open(path, 'r') as file:
+                source = file.read()
+        return mtime, hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def load(self, path: str) -> Optional[Any]:
+        entry = self.entries.get(path)
+        if entry is None and self.directory is not None:
+            entry = self.read(path)
+
+        if entry is None or not self.is_fresh(entry[0]):
+            self.entries.pop(path, None)
+            self.misses += 1
+            return None
+
+        self.entries[path] = entry
+        self.hits += 1
+        return pickle.loads(entry[1])
+
+    def store(self, path: str, source: str, value: Any, imported: list[str]):
+        dependencies = {path: self.fingerprint(path, source)}
+        for dependency in imported:
+            if dependency in self.entries:
+                dependencies.update(self.entries[dependency][0])
+            else:
+                dependencies[dependency] = self.fingerprint(dependency)
+
+        entry = dependencies, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.entries[path] = entry
+        if self.directory is not None:
+            self.write(path, entry)
+
+    @staticmethod
+    def is_fresh(dependencies: dict[str, tuple[int, str]]) -> bool:
+        for path, (mtime, digest) in dependencies.items():
+            try:
+                if os.stat(path).st_mtime_ns == mtime:
+                    continue
+                # Touched but maybe not modified.
+                current = ImportCache.fingerprint(path)
+            except OSError:
+                return False
+            if current[1] != digest:
+                return False
+            dependencies[path] = current
+        return True
+
+    def file_of(self, path: str) -> Path:
+        return self.directory / (path.replace('/', '_').replace('\\', '_') + '.pickle')
+
+    def read(self, path: str):
+        try:
+            with open(self.file_of(path), 'rb') as file:
+                version, entry = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        return entry if version == ImportCache.VERSION else None
+
+    def write(self, path: str, entry):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.file_of(path), 'wb') as file:
+            pickle.dump((ImportCache.VERSION, entry), file, protocol=pickle.HIGHEST_PROTOCOL)
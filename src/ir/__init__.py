@@ -1,4 +1,4 @@
-from .ir_code import Op, Code, TERMINATORS, ARITHMETICS, INSTRUCTIONS, SIDE_EFFECTS
+from .ir_code import Op, Code, TERMINATORS, ARITHMETICS, LOGICALS, COMMUTATIVE, INSTRUCTIONS, SIDE_EFFECTS
 from .basic_block import Block, Entry
 from .function import Function, Builtin
 from .module import Module
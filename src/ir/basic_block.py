@@ -1,14 +1,34 @@
 from typing import Optional, Any
 from collections import namedtuple
 
-from ir import Op, Code, INSTRUCTIONS, SIDE_EFFECTS, TERMINATORS
+from ir import Op, Code, INSTRUCTIONS, SIDE_EFFECTS, TERMINATORS, ARITHMETICS, LOGICALS, COMMUTATIVE
 
 Entry = namedtuple('Entry', ('value', 'variable'))
 
-def find(table, v):
-    for i, entry in table.items():
-        if entry.value == v:
-            return i
+def wrap(value: int) -> int:
+    """Wraps an integer to signed 64 bits, like the registers it ends up in."""
+    return (value + (1 << 63)) % (1 << 64) - (1 << 63)
+
+
+def fold(op: Op, lhs: Any, rhs: Any) -> Optional[int]:
+    """
+    Evaluates `op` on two values from the LVN table if both are integer literals.
+    The result wraps around at 64 bits and division truncates towards zero, like
+    `idiv`. Division by zero and the overflowing division are left alone, as they trap.
+    """
+    if lhs is None or rhs is None or lhs[0] != Op.LIT or rhs[0] != Op.LIT or lhs[2] != 'int' or rhs[2] != 'int':
+        return None
+    a, b = wrap(lhs[1]), wrap(rhs[1])
+    match op:
+        case Op.ADD:
+            return wrap(a + b)
+        case Op.SUB:
+            return wrap(a - b)
+        case Op.MUL:
+            return wrap(a * b)
+        case Op.DIV | Op.MOD if b != 0 and not (a == -(1 << 63) and b == -1):
+            quotient = abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+            return quotient if op == Op.DIV else a - b * quotient
     return None
 
 
@@ -58,15 +78,38 @@ class Block:
                 defined.add(i.dest)
         return used
 
+    def last_uses(self) -> dict[str, int]:
+        """
+        The offset of the last instruction that reads each variable, found by sweeping the
+        block backwards. The terminator is at the offset after the last instruction.
+        Example:
+            a := x + y      # 0
+            b := a + x      # 1
+            ret b           # 2
+            ----
+            { 'x': 1, 'y': 0, 'a': 1, 'b': 2 }
+        """
+        last: dict[str, int] = {}
+        codes = self.instructions if self.terminator is None else [*self.instructions, self.terminator]
+        for offset in range(len(codes) - 1, -1, -1):
+            for v in codes[offset].refs:
+                if type(v) == str and v not in last:
+                    last[v] = offset
+        return last
+
     def canonicalize(self) -> None:
         """
         1. Order arguments for commutative instructions in alphabetical order.
         """
         for instruction in self.instructions:
-            if instruction.refs and instruction.op in (Op.ADD, Op.MUL, Op.EQ, Op.NEQ):
+            if instruction.refs and instruction.op in COMMUTATIVE:
                 instruction.refs = tuple(sorted(instruction.refs))
 
     def to_ssa(self) -> None:
+        """
+        Renames redefinitions within the block, in one pass. The first definition
+        keeps its name and the following are named x'0, x'1 and so on.
+        """
         def rename(x):
             if "'" in x:
                 name, version = x.split("'")
@@ -75,80 +118,172 @@ class Block:
             else:
                 return x + "'0"
 
-        defined = set()
-        for i, instruction in enumerate(self.instructions):
+        def current(refs):
+            return tuple(names.get(x, x) if type(x) == str else x for x in refs)
+
+        names: dict[str, str] = {}
+        for instruction in self.instructions:
+            if instruction.refs:
+                instruction.refs = current(instruction.refs)
             if old_name := instruction.dest:
-                if old_name in defined:
-                    new_name = rename(old_name)
-                    for candidate in self.instructions[i+1:]:
-                        if candidate.refs:
-                            candidate.refs = tuple(new_name if x == old_name else x for x in candidate.refs)
-                        if candidate.dest and candidate.dest == old_name:
-                            candidate.dest = new_name
-                    defined.add(new_name)
-                    instruction.dest = new_name
+                if old_name in names:
+                    names[old_name] = rename(names[old_name])
+                    instruction.dest = names[old_name]
                 else:
-                    defined.add(old_name)
+                    names[old_name] = old_name
+        if self.terminator is not None and self.terminator.refs:
+            self.terminator.refs = current(self.terminator.refs)
 
+    def shift_offsets(self, start: int, delta: int) -> None:
+        """
+        Moves integer refs (offsets into this block) at or after `start` by `delta`,
+        for when instructions are inserted or removed.
+        """
+        def shift(refs):
+            return tuple(x + delta if type(x) == int and x >= start else x for x in refs)
+
+        for instruction in self.instructions:
+            if instruction.refs:
+                instruction.refs = shift(instruction.refs)
+        if self.terminator is not None and self.terminator.refs:
+            self.terminator.refs = shift(self.terminator.refs)
 
     def remove_nop(self):
         self.instructions = [i for i in self.instructions if i.op != Op.NOP]
 
-    def lvn(self, table: dict[int, Entry], environment: dict[str, int]) -> tuple[dict[int, Entry], dict[str, int]]:
+    def lvn(self, table: dict[int, Entry], environment: dict[str, int], fold_constants: bool = False) -> tuple[dict[int, Entry], dict[str, int]]:
+        """
+        Local value numbering. Values of commutative instructions are keyed with
+        their operands in order, so `a + b` and `b + a` are the same value.
+        :param fold_constants: Replace arithmetic on integer literals with a literal of
+            its result. Like the literals of the parser, its value is written out as a
+            string, but it has no index as it isn't in the data of the module.
+        """
         table = table.copy()
         environment = environment.copy()
         value: tuple[Op, Any, Any]
 
+        # Reverse index of `table`, from a value to the first entry holding it.
+        index: dict[Any, int] = {}
+        for id, entry in table.items():
+            if entry.value is not None:
+                index.setdefault(entry.value, id)
+
+        def number(name: str, value: Any) -> int:
+            id = len(table)
+            table[id] = Entry(value, name)
+            if value is not None:
+                index.setdefault(value, id)
+            environment[name] = id
+            return id
+
+        def value_of(name: str) -> int:
+            if name not in environment:
+                # Defined outside what we've seen, so it's an unknown value.
+                return number(name, None)
+            return environment[name]
+
+        def variable_of(name: Any) -> Any:
+            return table[environment[name]].variable if name in environment else name
+
         for instruction in self.instructions:
             if instruction.dest:
                 name = instruction.dest
                 if instruction.op == Op.LIT:
                     ty, idx, val = instruction.args
-                    value = (instruction.op, val, None)
-                    if (identical := find(table, value)) is not None:
-                        # If we found an identical value, we'll use that value instead of this, so we can delete it.
-                        instruction.op = Op.NOP
-                        environment[name] = identical
-                    else:
-                        environment[name] = len(table)
-                        table[len(table)] = Entry(value, name)
+                    # The parser writes integers as in the source and the IR parser as numbers, which are the same value.
+                    value = (instruction.op, int(val) if ty == 'int' else val, ty)
                 elif instruction.op in (Op.REF, Op.MOVE, Op.ALLOC):
-                    value = (instruction.op, environment[instruction.refs[0]], None)
+                    value = (instruction.op, value_of(instruction.refs[0]), None)
                     instruction.refs  = (table[value[1]].variable,)
-                    environment[name] = len(table)
-                    table[len(table)] = Entry(value, name)
-                else:
-                    value = (instruction.op, environment[instruction.refs[0]], environment[instruction.refs[1]])
-                    if (identical := find(table, value)) is not None:
-                        # If we found an identical value, we'll use that value instead of this, so we can delete it.
-                        instruction.op = Op.NOP
-                        environment[name] = identical
+                    number(name, value)
+                    continue
+                elif instruction.op in ARITHMETICS + LOGICALS and len(instruction.refs) == 2:
+                    lhs, rhs = value_of(instruction.refs[0]), value_of(instruction.refs[1])
+                    if instruction.op in COMMUTATIVE and rhs < lhs:
+                        value = (instruction.op, rhs, lhs)
                     else:
-                        instruction.refs = (table[value[1]].variable, table[value[2]].variable)
-                        environment[name] = len(table)
-                        table[len(table)] = Entry(value, name)
+                        value = (instruction.op, lhs, rhs)
+
+                    if fold_constants and (result := fold(instruction.op, table[lhs].value, table[rhs].value)) is not None:
+                        instruction.op, instruction.args, instruction.refs = Op.LIT, ('int', None, str(result)), ()
+                        value = (Op.LIT, result, 'int')
+                    elif value not in index:
+                        instruction.refs = (table[lhs].variable, table[rhs].variable)
+                else:
+                    # Unknown or side effects, so the value is always new.
+                    instruction.refs = tuple(variable_of(arg) for arg in instruction.refs)
+                    number(name, (instruction.op, len(table), name))
+                    continue
+
+                if (identical := index.get(value)) is not None:
+                    # If we found an identical value, we'll use that value instead of this, so we can delete it.
+                    instruction.op = Op.NOP
+                    environment[name] = identical
+                else:
+                    number(name, value)
             elif instruction.refs:
-                instruction.refs = tuple(table[environment[arg]].variable for arg in instruction.refs)
+                instruction.refs = tuple(variable_of(arg) for arg in instruction.refs)
 
         self.remove_nop()
 
         return table, environment
 
-    def dce(self, keep: Optional[set[str]] = None):
+    def dce(self, keep: Optional[set[str]] = None) -> int:
         """
-        Removes all unused code.
+        Removes all unused code, by marking the needed instructions in one backward
+        pass and then compacting the instructions once.
         :param keep: Variables used after this basic block, i.e. variables not to be removed.
+        :return: The number of removed instructions.
         """
-        used: set[str] = (keep and keep.copy()) or set()
-        for i in reversed(self.instructions):
+        used: set[str] = set(keep) if keep else set()
+        needed: set[int] = set()
+        alive = bytearray(len(self.instructions))
+
+        def mark(refs):
+            for ref in refs:
+                # Integers refer to the instruction at that offset in the block.
+                if type(ref) == int:
+                    needed.add(ref)
+                else:
+                    used.add(ref)
+
+        if self.terminator is not None:
+            mark(self.terminator.refs)
+
+        for index in range(len(self.instructions) - 1, -1, -1):
+            i = self.instructions[index]
             if i.op in SIDE_EFFECTS:
                 # All instructions with side effects must be kept
-                used.update(i.refs)
-            elif i.dest and i.dest not in used or i.op == Op.NOP:
+                alive[index] = 1
+            elif i.op == Op.NOP or (i.dest and i.dest not in used and index not in needed):
                 # Instructions that haven't been used can be removed
-                self.instructions.remove(i)
-            elif i.refs:
-                used.update(i.refs)
+                continue
+            alive[index] = 1
+            mark(i.refs)
+
+        removed = len(alive) - sum(alive)
+        if removed == 0:
+            return 0
+
+        offsets = []
+        instructions = []
+        for i, is_alive in zip(self.instructions, alive):
+            offsets.append(len(instructions))
+            if is_alive:
+                instructions.append(i)
+
+        def remap(refs):
+            return tuple(offsets[ref] if type(ref) == int else ref for ref in refs)
+
+        for i in instructions:
+            if needed and i.refs:
+                i.refs = remap(i.refs)
+        if needed and self.terminator is not None:
+            self.terminator.refs = remap(self.terminator.refs)
+
+        self.instructions = instructions
+        return removed
 
     def borrow_check(self, loans: dict[str, set[str]], live_variables: set[str]) -> dict[str, set[str]]:
         """
@@ -0,0 +1,61 @@
+from collections.abc import Mapping
+from typing import Any, Iterable
+
+
+class Numbering:
+    """
+    Dense numbering of the facts of a dataflow problem, so a set of facts can be
+    kept as the bits of a Python int and merged and transferred with `|`, `&`
+    and `& ~` instead of copying sets.
+    """
+
+    def __init__(self, items: Iterable[Any] = ()):
+        self.index: dict[Any, int] = {}
+        self.items: list[Any] = []
+        for item in items:
+            self.number(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def number(self, item: Any) -> int:
+        index = self.index.get(item)
+        if index is None:
+            index = self.index[item] = len(self.items)
+            self.items.append(item)
+        return index
+
+    def encode(self, items: Iterable[Any]) -> int:
+        bits = 0
+        for item in items:
+            bits |= 1 << self.number(item)
+        return bits
+
+    def decode(self, bits: int) -> set[Any]:
+        result = set()
+        while bits:
+            lowest = bits & -bits
+            result.add(self.items[lowest.bit_length() - 1])
+            bits ^= lowest
+        return result
+
+
+class DecodedSets(Mapping):
+    """Read-only view of label -> bit-vector as label -> set, decoding each entry on first access."""
+
+    def __init__(self, numbering: Numbering, bits: dict[Any, int]):
+        self.numbering = numbering
+        self.bits = bits
+        self.decoded: dict[Any, set[Any]] = {}
+
+    def __getitem__(self, label):
+        result = self.decoded.get(label)
+        if result is None:
+            result = self.decoded[label] = self.numbering.decode(self.bits[label])
+        return result
+
+    def __iter__(self):
+        return iter(self.bits)
+
+    def __len__(self):
+        return len(self.bits)
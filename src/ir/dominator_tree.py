@@ -0,0 +1,95 @@
+from typing import Any, Optional
+
+
+class DominatorTree:
+    """
+    The dominator tree of the blocks reachable from the entry of a function, built
+    with the iterative algorithm by Cooper, Harvey and Kennedy over reverse postorder
+    indices. Dominance queries are answered in constant time from the entry and exit
+    numbers of a depth-first walk over the tree.
+    """
+
+    def __init__(self, function):
+        order = function.reverse_postorder()
+        predecessors = function.predecessors
+        index = {b.label: i for i, b in enumerate(order)}
+
+        # Blocks are referred to by their index in reverse postorder, so every
+        # dominator of a block has a lower index than the block itself.
+        parent: list[Optional[int]] = [None] * len(order)
+        parent[0] = 0
+
+        def intersect(a: int, b: int) -> int:
+            while a != b:
+                while a > b:
+                    a = parent[a]
+                while b > a:
+                    b = parent[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for i in range(1, len(order)):
+                new = None
+                for p in predecessors[order[i].label]:
+                    j = index[p.label]
+                    if parent[j] is not None:
+                        new = j if new is None else intersect(j, new)
+                if new is not None and parent[i] != new:
+                    parent[i] = new
+                    changed = True
+
+        # Unreachable blocks are never given a parent and are left out of the tree.
+        self.root = order[0].label
+        self.idom: dict[Any, Optional[Any]] = {self.root: None}
+        self.children: dict[Any, list[Any]] = {self.root: []}
+        for block in function.blocks:
+            i = index[block.label]
+            if i != 0 and parent[i] is not None:
+                self.idom[block.label] = order[parent[i]].label
+                self.children.setdefault(block.label, [])
+        for label, dominator in self.idom.items():
+            if dominator is not None:
+                self.children.setdefault(dominator, []).append(label)
+
+        self.frontiers: dict[Any, set[Any]] = {label: set() for label in self.idom}
+        for label in self.idom:
+            incoming = [p.label for p in predecessors[label] if p.label in self.idom]
+            if len(incoming) < 2:
+                continue
+            for runner in incoming:
+                while runner != self.idom[label]:
+                    self.frontiers[runner].add(label)
+                    runner = self.idom[runner]
+
+        self.enter: dict[Any, int] = {}
+        self.exit: dict[Any, int] = {}
+        clock = 0
+        stack = [(self.root, False)]
+        while stack:
+            label, done = stack.pop()
+            if done:
+                self.exit[label] = clock
+            else:
+                self.enter[label] = clock
+                stack.append((label, True))
+                stack.extend((child, False) for child in reversed(self.children[label]))
+            clock += 1
+
+    def __contains__(self, label):
+        return label in self.idom
+
+    def dominates(self, a, b) -> bool:
+        """Whether every path from the entry to `b` goes through `a`. Only true for reachable blocks."""
+        if a not in self.enter or b not in self.enter:
+            return False
+        return self.enter[a] <= self.enter[b] and self.exit[b] <= self.exit[a]
+
+    def dominators(self, label) -> set[Any]:
+        """The blocks dominating `label`, including itself."""
+        result = set()
+        while label is not None:
+            result.add(label)
+            label = self.idom[label]
+        return result
@@ -1,6 +1,12 @@
-from typing import Callable, List, Any
+import heapq
+from collections import namedtuple
+from typing import Callable, List, Any, Optional, Iterable
 
 from ir import Code, TERMINATORS, Op, ARITHMETICS, Block, Entry
+from ir.bit_vector import Numbering, DecodedSets
+from ir.dominator_tree import DominatorTree
+
+AnalysisStats = namedtuple('AnalysisStats', ('iterations', 'transfers'))
 
 
 def lt(a, b): return (a[0], min(a[1], b[1] - 1)), (max(a[0] + 1, b[0]), b[1])
@@ -46,6 +52,9 @@ class Function:
         self._successors = successors
         self._live_in = None
         self._live_out = None
+        self._reverse_postorder = None
+        self._dominator_tree = None
+        self.analysis_stats = AnalysisStats(0, 0)
 
     def add(self, block: Block):
         id = len(self.blocks)
@@ -88,16 +97,36 @@ class Function:
                 yield block, code
             yield block, block.terminator
 
-    def live_in(self):
+    def live_in(self) -> DecodedSets:
         if self._live_in is None:
-            self._live_in, self._live_out = self.live_variables()
+            self.compute_liveness()
         return self._live_in
 
-    def live_out(self):
+    def live_out(self) -> DecodedSets:
         if self._live_out is None:
-            self._live_in, self._live_out = self.live_variables()
+            self.compute_liveness()
         return self._live_out
 
+    def compute_liveness(self):
+        # Only the blocks that are looked at get decoded into sets.
+        numbering, in_, out = self.live_variable_bits()
+        self._live_in, self._live_out = DecodedSets(numbering, in_), DecodedSets(numbering, out)
+
+    def parameter_names(self) -> list[str]:
+        # The parser stores parameters by name, while the IR parser has a list of them.
+        if isinstance(self.params, dict):
+            return list(self.params)
+        return [p['name'] for p in self.params]
+
+    def invalidate(self):
+        """Drops the cached analyses, which must be done after changing the code."""
+        self._predecessors = None
+        self._successors = None
+        self._live_in = None
+        self._live_out = None
+        self._reverse_postorder = None
+        self._dominator_tree = None
+
     @property
     def predecessors(self):
         if self._predecessors is None:
@@ -136,18 +165,24 @@ class Function:
     def lvn(self) -> None:
         table: dict[int, Entry] = {}
         environment: dict[str, int] = {}
-        for param in self.params:
-            environment[param['name']] = len(table)
-            table[len(table)] = (Entry(None, param['name']))
+        for param in self.parameter_names():
+            environment[param] = len(table)
+            table[len(table)] = (Entry(None, param))
 
         def merge(_: Block, s: list[Any]):
-            t0: dict[str, Any] = {}
-            e0: dict[str, Any] = {}
-            for x in s:
-                t1, e1 = x
-                t0.update(t1)
-                e0.update(e0)
-            return t0, e0
+            # Only what every path agrees on is known where they meet. Each path numbers
+            # its values after the ones it came in with, so the entries the tables agree
+            # on are the first ones, and the names must hold the same value on every path.
+            (t0, e0), *rest = s
+            if not rest:
+                return t0, e0
+            common = 0
+            while common in t0 and all(t.get(common) == t0[common] for t, _ in rest):
+                common += 1
+            environment = {n: i for n, i in e0.items() if i < common and all(e.get(n) == i for _, e in rest)}
+            # A value whose variable holds something else on some path can't be reused by that name.
+            table = {i: t0[i] if environment.get(t0[i].variable) == i else Entry(None, t0[i].variable) for i in range(common)}
+            return table, environment
 
         def trans(b: Block, s: set[Any]):
             t, e = s
@@ -160,6 +195,22 @@ class Function:
         # for block in self.blocks:
         #     table, environment = block.lvn(table, environment)
 
+    def dce(self) -> int:
+        """
+        Removes definitions that are dead at the end of their block and never used
+        within it, by running `Block.dce` with the live-out variables of each block
+        until nothing more can be removed.
+        :return: The number of removed instructions.
+        """
+        total = 0
+        while True:
+            live_out = self.live_out()
+            removed = sum(block.dce(keep=live_out[block.label]) for block in self.blocks)
+            if removed == 0:
+                return total
+            total += removed
+            self._live_in = self._live_out = None
+
     def remove_unreachable_blocks(self):
         successors = self.successors
         queue = [self.blocks[0]]
@@ -178,9 +229,37 @@ class Function:
                     b.instructions = []
             self.blocks = [b for b in self.blocks if b.label in visited]
 
+    def reverse_postorder(self) -> list[Block]:
+        """
+        The blocks reachable from the entry in reverse postorder, followed by the
+        unreachable blocks in their original order.
+        """
+        if self._reverse_postorder is None:
+            successors = self.successors
+            first = self.blocks[0]
+            postorder = []
+            visited = {first.label}
+            stack = [(first, iter(successors[first.label]))]
+            while stack:
+                block, children = stack[-1]
+                for child in children:
+                    if child.label not in visited:
+                        visited.add(child.label)
+                        stack.append((child, iter(successors[child.label])))
+                        break
+                else:
+                    postorder.append(block)
+                    stack.pop()
+            postorder.reverse()
+            self._reverse_postorder = postorder + [b for b in self.blocks if b.label not in visited]
+        return self._reverse_postorder
+
     def analyze(self, init: Any, rest: Any, merge: Callable[[Block, List[Any]], Any],
                 transfer: Callable[[Block, Any], Any], forward: bool) -> tuple[dict[str, Any], dict[str, Any]]:
         """
+        Solves a dataflow problem with a worklist ordered by reverse postorder, or postorder
+        for backward problems, so a block is processed after the blocks flowing into it.
+        The number of sweeps over that order and of transfer calls are in `analysis_stats`.
         :param init: Initial value of all in-data and out-data
         :param merge: Combines in-data from other nodes out-data
         :param transfer: Transfers in-data to out-data
@@ -188,70 +267,92 @@ class Function:
         :return:
         """
         predecessors, successors = self.predecessors, self.successors
+        order = self.reverse_postorder()
         if forward:
-            queue = self.blocks.copy()
             first_block = self.blocks[0]
             in_edges = predecessors
             out_edges = successors
         else:
-            queue = list(reversed(self.blocks.copy()))
+            order = order[::-1]
             first_block = self.blocks[-1]
             in_edges = successors
             out_edges = predecessors
 
+        priority = {b.label: i for i, b in enumerate(order)}
         in_data = {first_block.label: init}
         out_data = {b.label: rest for b in self.blocks}
 
-        block = queue.pop(0)
-        in_data[block.label] = merge(block, [init])
-        out_result = transfer(block, in_data[block.label])
-        if out_data[block.label] != out_result:
-            out_data[block.label] = out_result
-            queue.extend(out_edges[block.label])
+        # Every block is processed at least once.
+        queue = list(range(len(order)))
+        in_queue = bytearray(b'\x01') * len(order)
+        iterations, transfers, previous = 0, 0, len(order)
 
-        while len(queue) > 0:
-            block = queue.pop(0)
+        while queue:
+            index = heapq.heappop(queue)
+            in_queue[index] = 0
+            if index <= previous:
+                iterations += 1
+            previous = index
+            block = order[index]
 
             # All out variables of the predecessors are in variables for this block.
-            in_data[block.label] = merge(block, [out_data[b.label] for b in in_edges[block.label]])
+            incoming = [out_data[b.label] for b in in_edges[block.label]]
+            if block is first_block or not incoming:
+                incoming.insert(0, init)
+            in_data[block.label] = merge(block, incoming)
 
             # All in variables will also be out variables.
             out_result = transfer(block, in_data[block.label])
+            transfers += 1
 
             # If the out variables have been updated, then we need to process successors.
             if out_data[block.label] != out_result:
                 out_data[block.label] = out_result
-                queue.extend(out_edges[block.label])
+                for successor in out_edges[block.label]:
+                    i = priority[successor.label]
+                    if not in_queue[i]:
+                        in_queue[i] = 1
+                        heapq.heappush(queue, i)
+
+        self.analysis_stats = AnalysisStats(iterations, transfers)
 
         if forward:
             return in_data, out_data
         else:
             return out_data, in_data
 
-    def reaching_definitions(self) -> tuple[dict[str, set[tuple[str, int]]], dict[str, set[tuple[str, int]]]]:
+    def reaching_definition_bits(self) -> tuple[Numbering, dict[str, int], dict[str, int]]:
         """
-        :return:
+        Reaching definitions as bit-vectors over the numbered (variable, label) facts,
+        where the label is None for an undefined variable and '__init__' for a parameter.
         """
-        Var = tuple[str, str]
-
-        def gen(b: Block) -> set[Var]:
-            return set((name, b.label) for name in b.gen())
+        defined = {b.label: b.gen() for b in self.blocks}
+        all_variables = sorted(set().union(*defined.values()))
+        numbering = Numbering((v, None) for v in all_variables)
+        initial_state = numbering.encode((name, '__init__') for name in self.parameter_names())
+        initial_state |= (1 << len(all_variables)) - 1
 
-        def kill(b: Block, in_: set[Var]) -> set[Var]:
-            defined = b.gen()
-            return set((name, label) for name, label in in_ if name in defined)
+        # Every definition of a variable is killed by a block that assigns to it.
+        facts: dict[str, int] = {}
+        gen = {b.label: numbering.encode((name, b.label) for name in defined[b.label]) for b in self.blocks}
+        for (name, _), index in numbering.index.items():
+            facts[name] = facts.get(name, 0) | (1 << index)
+        kill = {b.label: ~self.union(facts[name] for name in defined[b.label]) for b in self.blocks}
 
-        def merge(_: Block, s: list[set[Var]]):
-            return set().union(*s)
+        def merge(_: Block, s: list[int]):
+            return self.union(s)
 
-        def trans(b: Block, in_: set[Var]):
-            return gen(b).union(in_ - kill(b, in_))
+        def trans(b: Block, in_: int):
+            return gen[b.label] | (in_ & kill[b.label])
 
-        all_variables = set().union(*[b.gen() for b in self.blocks])
+        return numbering, *self.analyze(initial_state, initial_state, merge=merge, transfer=trans, forward=True)
 
-        parameters = set((v['name'], '__init__') for v in self.params)
-        initial_state = set((v, None) for v in all_variables).union(parameters)
-        return self.analyze(initial_state, initial_state, merge=merge, transfer=trans, forward=True)
+    def reaching_definitions(self) -> tuple[dict[str, set[tuple[str, int]]], dict[str, set[tuple[str, int]]]]:
+        """
+        :return:
+        """
+        numbering, in_, out = self.reaching_definition_bits()
+        return dict(DecodedSets(numbering, in_)), dict(DecodedSets(numbering, out))
 
     def very_busy_expressions(self) -> tuple[
         dict[str, set[tuple[str, Any, Any]]], dict[str, set[tuple[str, Any, Any]]]]:
@@ -293,25 +394,41 @@ class Function:
         initial_state = all_expressions
         return self.analyze(set(), initial_state, merge=merge, transfer=trans, forward=False)
 
-    def live_variables(self) -> tuple[dict[str, set[str]], dict[str, set[str]]]:
+    def live_variable_bits(self) -> tuple[Numbering, dict[str, int], dict[str, int]]:
         """
-        :return:
+        Live variables as bit-vectors over the numbered variables of the function.
         """
+        numbering = Numbering()
+        use: dict[str, int] = {}
+        kill: dict[str, int] = {}
+        for b in self.blocks:
+            defined = b.gen()
+            used = set(a for a in b.use() if type(a) == str)
+            used.update(a for a in b.terminator.refs if type(a) == str and a not in defined)
+            use[b.label] = numbering.encode(used)
+            kill[b.label] = ~numbering.encode(defined)
 
-        def merge(_: Block, s: list[set[str]]):
-            return set.union(*s)
+        def merge(_: Block, s: list[int]):
+            return self.union(s)
 
-        def trans(b: Block, in_: set[str]):
-            result = in_.copy()
-            for i in reversed(b.instructions):
-                if i.dest and i.dest in result:
-                    result.remove(i.dest)
-                for a in i.refs:
-                    if type(a) == str:
-                        result.add(a)
-            return result
+        def trans(b: Block, in_: int):
+            return use[b.label] | (in_ & kill[b.label])
+
+        return numbering, *self.analyze(0, 0, merge=merge, transfer=trans, forward=False)
+
+    def live_variables(self) -> tuple[dict[str, set[str]], dict[str, set[str]]]:
+        """
+        :return:
+        """
+        numbering, in_, out = self.live_variable_bits()
+        return dict(DecodedSets(numbering, in_)), dict(DecodedSets(numbering, out))
 
-        return self.analyze(set(), set(), merge=merge, transfer=trans, forward=False)
+    @staticmethod
+    def union(bits: Iterable[int]) -> int:
+        result = 0
+        for x in bits:
+            result |= x
+        return result
 
     def interval_analysis(self) -> tuple[dict[str, dict[str, tuple[int, int]]], dict[str, dict[str, tuple[int, int]]]]:
         """
@@ -423,33 +540,190 @@ class Function:
 
         return in_data, out_data
 
+    def dominator_tree(self) -> DominatorTree:
+        if self._dominator_tree is None:
+            self._dominator_tree = DominatorTree(self)
+        return self._dominator_tree
+
     def dominators(self) -> dict[str, set[str]]:
         """
         A block is dominating blocks if it has to be executed before the others.
         Domination is reflexive, meaning any block dominates itself, and antisymmetric.
-        :return: A mapping from a block to a set of blocks it dominates.
+        :return: A mapping from a block to the set of blocks dominating it. Every block
+                 dominates an unreachable block.
         """
-        predecessors, successors = self.predecessors, self.successors
-        first = self.blocks[0].label
+        tree = self.dominator_tree()
         universe = set(b.label for b in self.blocks)
+        return {b.label: tree.dominators(b.label) if b.label in tree else universe for b in self.blocks}
 
-        dom = {b.label: universe for b in self.blocks}
-        dom[first] = set()
-
-        queue = [first]
-        while len(queue) > 0:
-            node = queue.pop(0)
+    def immediate_dominators(self) -> dict[Any, Optional[Any]]:
+        """
+        :return: A mapping from each reachable block to its immediate dominator, which
+                 is None for the entry block.
+        """
+        return self.dominator_tree().idom
 
-            predecessor_dominators = [dom[n.label] for n in predecessors[node]]
-            node_dominators = set.intersection(*predecessor_dominators) if predecessor_dominators else set()
-            new = node_dominators.union({node})
+    def dominance_frontiers(self) -> dict[Any, set[Any]]:
+        """
+        The dominance frontier of a block is where its dominance stops, i.e. the blocks
+        with a predecessor it dominates while not strictly dominating the block itself.
+        :return: A mapping from each reachable block to its dominance frontier.
+        """
+        return self.dominator_tree().frontiers
 
-            if new != dom[node]:
-                dom[node] = new
-                for successor in successors[node]:
-                    queue.append(successor.label)
+    def to_ssa(self) -> None:
+        """
+        Constructs SSA form (Cytron et al.). Phi instructions are placed on the iterated
+        dominance frontiers of the blocks defining a variable, where the variable is live,
+        and all variables are then renamed in one walk over the dominator tree.
+        Variables with a single definition are left as they are. Otherwise, the first
+        definition keeps the name unless the variable is live into the function, and
+        the following are named x'0, x'1 and so on.
+        """
+        tree = self.dominator_tree()
+        idom, children, frontiers = tree.idom, tree.children, tree.frontiers
+        live_in = self.live_in()
+        first = self.blocks[0].label
+        blocks = {b.label: b for b in self.blocks}
 
-        return dom
+        taken = set(self.parameter_names())
+        params = set(taken) - {i.dest for b in self.blocks for i in b.instructions if i.op == Op.PARAM}
+        definitions: dict[str, list[Any]] = {p: [first] for p in params}
+        for block in self.blocks:
+            for instruction in block.instructions:
+                taken.update(x for x in instruction.refs if type(x) == str)
+                if instruction.dest:
+                    taken.add(instruction.dest)
+                    if block.label in idom:
+                        definitions.setdefault(instruction.dest, []).append(block.label)
+
+        variables = [v for v, sites in definitions.items() if len(sites) > 1]
+        if not variables:
+            return
+
+        # Place phi instructions.
+        phis: dict[Any, dict[str, Code]] = {label: {} for label in idom}
+        for v in variables:
+            work = list(dict.fromkeys(definitions[v]))
+            visited = set(work)
+            while work:
+                for label in frontiers[work.pop()]:
+                    if v in phis[label] or v not in live_in[label]:
+                        continue
+                    predecessors = tuple(p.label for p in self.predecessors[label])
+                    phis[label][v] = Code(Op.PHI, dest=v, args=predecessors, refs=(v, ) * len(predecessors), token=blocks[label].terminator.token)
+                    if label not in visited:
+                        visited.add(label)
+                        work.append(label)
+
+        for label, block_phis in phis.items():
+            if block_phis:
+                block = blocks[label]
+                block.shift_offsets(0, len(block_phis))
+                block.instructions[0:0] = block_phis.values()
+
+        # Rename.
+        reserved = params | live_in[first]
+        stacks = {v: [v] if v in reserved else [] for v in variables}
+        versions = {v: 0 for v in variables}
+
+        def fresh(v):
+            if v not in reserved:
+                reserved.add(v)
+                return v
+            while f"{v}'{versions[v]}" in taken:
+                versions[v] += 1
+            name = f"{v}'{versions[v]}"
+            taken.add(name)
+            return name
+
+        def current(refs):
+            return tuple(stacks[x][-1] if x in stacks and stacks[x] else x for x in refs)
+
+        work = [(first, None)]
+        while work:
+            label, pushed = work.pop()
+            if pushed is not None:
+                for v in pushed:
+                    stacks[v].pop()
+                continue
+
+            block = blocks[label]
+            pushed = []
+            for instruction in block.instructions:
+                if instruction.op != Op.PHI and instruction.refs:
+                    instruction.refs = current(instruction.refs)
+                if instruction.dest in stacks:
+                    v = instruction.dest
+                    instruction.dest = fresh(v)
+                    stacks[v].append(instruction.dest)
+                    pushed.append(v)
+            if block.terminator.refs:
+                block.terminator.refs = current(block.terminator.refs)
+
+            for successor in self.successors[label]:
+                for v, phi in phis.get(successor.label, {}).items():
+                    value = stacks[v][-1] if stacks[v] else v
+                    phi.refs = tuple(value if p == label else x for p, x in zip(phi.args, phi.refs))
+
+            work.append((label, pushed))
+            work.extend((child, None) for child in reversed(children[label]))
+
+        self.invalidate()
+
+    def from_ssa(self) -> None:
+        """
+        Replaces phi instructions with copies at the end of the predecessors. Critical
+        edges are split by a new block, and the copies along an edge are ordered so that
+        they behave as if done in parallel, e.g. when two variables are swapped.
+        """
+        offsets = {b.label: i for i, b in enumerate(self.blocks)}
+        copies: dict[int, list[tuple[str, str, Code]]] = {}
+        count = 0
+        for offset, block in enumerate(list(self.blocks)):
+            phis = 0
+            while phis < len(block.instructions) and block.instructions[phis].op == Op.PHI:
+                phis += 1
+            if phis == 0:
+                continue
+
+            for i, label in enumerate(block.instructions[0].args):
+                source = offsets[label]
+                if len(self.successors[label]) > 1:
+                    # Critical edge, so the copies need a block of their own.
+                    predecessor = self.blocks[source]
+                    jump = Code(Op.JMP, args=(offset, ), token=predecessor.terminator.token)
+                    source = self.add(Block(f'{label}_{block.label}', [], terminator=jump))
+                    if predecessor.terminator.op == Op.BR:
+                        predecessor.terminator.args = tuple(source if x == offset else x for x in predecessor.terminator.args)
+                    else:
+                        predecessor.terminator.args = (source, *predecessor.terminator.args[1:])
+                for phi in block.instructions[:phis]:
+                    copies.setdefault(source, []).append((phi.dest, phi.refs[i], phi))
+
+            block.instructions = block.instructions[phis:]
+            block.shift_offsets(phis, -phis)
+
+        for source, parallel in copies.items():
+            pending = [(dest, src, phi) for dest, src, phi in parallel if dest != src]
+            sequential = []
+            while pending:
+                sources = {src for _, src, _ in pending}
+                ready = [copy for copy in pending if copy[0] not in sources]
+                if ready:
+                    sequential.extend(ready)
+                    pending = [copy for copy in pending if copy[0] in sources]
+                else:
+                    # A cycle, which is broken by saving one of the values.
+                    dest, src, phi = pending[0]
+                    temporary = f"{dest}'copy{count}"
+                    count += 1
+                    sequential.append((temporary, src, phi))
+                    pending[0] = (dest, temporary, phi)
+            self.blocks[source].instructions.extend(Code(Op.COPY, dest=dest, refs=(src, ), token=phi.token) for dest, src, phi in sequential)
+
+        if copies:
+            self.invalidate()
 
     def constant_propagation(self):
         in_, out = self.analyze(init=dict(), rest=dict(), merge=cprop_merge, transfer=cprop_transfer, forward=True)
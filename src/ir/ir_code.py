@@ -37,6 +37,7 @@ class Op(Enum):
     PARAM = auto()
     FIELD = auto()
     INIT = auto()
+    PHI = auto()        # Args are the predecessor labels, refs the value from each of them
     # Side effects
     RET = auto()
     PRINT = auto()
@@ -65,8 +66,9 @@ TERMINATORS  = (Op.BR, Op.JMP, Op.RET)
 SIDE_EFFECTS = (Op.RET, Op.PRINT, Op.CALL, Op.ALLOC, Op.FREE, Op.SYSCALL, Op.DECL, Op.MULTIDECL, Op.ASM)
 ARITHMETICS = (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.MOD)
 LOGICALS = (Op.AND, Op.OR, Op.NOT, Op.EQ, Op.NEQ, Op.GT, Op.LT, Op.GTE, Op.LTE)
+COMMUTATIVE = (Op.ADD, Op.MUL, Op.EQ, Op.NEQ, Op.AND, Op.OR)
 INSTRUCTIONS = ARITHMETICS + LOGICALS + (
-    Op.DOT, Op.AS, Op.INDEX, Op.ASSIGN, Op.LIT, Op.REF, Op.MOVE, Op.COPY, Op.BRW, Op.PARAM, Op.FIELD, Op.INIT
+    Op.DOT, Op.AS, Op.INDEX, Op.ASSIGN, Op.LIT, Op.REF, Op.MOVE, Op.COPY, Op.BRW, Op.PARAM, Op.FIELD, Op.INIT, Op.PHI
 ) + SIDE_EFFECTS + TERMINATORS + (Op.SET, Op.ACCESS, Op.ASM, Op.DECL, Op.MULTIDECL, Op.LABEL)
 
 @dataclass
@@ -141,6 +143,8 @@ class Code:
                 return f'{self.dest} :: .{self.args[1]} = %{self.refs[0]}'
             case Op.INIT:
                 return f'{self.dest} := {self.args[0]}{{{", ".join(f"%{i}" for i in self.refs)}}}'
+            case Op.PHI:
+                return f'{self.dest} := phi {", ".join(f"${label} %{ref}" for label, ref in zip(self.args, self.refs))}'
             case Op.ACCESS:
                 return f'{self.dest} := %{self.refs[0]}.%{self.refs[1]}'
             case Op.RET:
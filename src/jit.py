@@ -0,0 +1,230 @@
+import ctypes
+import mmap
+import os
+import platform
+import sys
+from typing import Optional
+
+from assembler import INTERNAL_CODE, INTERNAL_DATA, PAD_DATA
+from target import Target
+from x86_64_encoder import X86_64_Encoder
+
+
+SYS_WRITE   = 1
+SYS_EXIT    = 60
+
+# long write(long fd, void* buffer, long count) and long main(void), as seen from C.
+WRITE = ctypes.CFUNCTYPE(ctypes.c_long, ctypes.c_long, ctypes.c_void_p, ctypes.c_long)
+ENTRY = ctypes.CFUNCTYPE(ctypes.c_long)
+
+CALLEE_SAVED = ('rbx', 'rbp', 'r12', 'r13', 'r14', 'r15')
+RWX = mmap.PROT_READ | mmap.PROT_WRITE | mmap.PROT_EXEC
+
+
+# Called from C, so the registers C expects to be preserved are saved along with the
+# stack pointer, which lets an exit from anywhere in the program unwind back here.
+ENTER = ''.join(f'    push {r}\n' for r in CALLEE_SAVED) + '    mov [rel jit_stack], rsp\n'
+PRELUDE = f"""\
+BITS 64
+jit_enter:
+{ENTER}\
+    sub rsp, 8                      ; Aligned as at the start of a process
+
+"""
+# Replaces 'syscall'. Like it, only 'rax', 'rcx' and 'r11' may be clobbered on return.
+RUNTIME = f"""
+; ---- JIT trampolines ----
+jit_syscall:
+    cmp rax, {SYS_EXIT}
+    je .exit
+    cmp rax, {SYS_WRITE}
+    je .write
+    syscall                         ; Everything else goes straight to the kernel
+    ret
+
+.write:
+    push rdx
+    push rsi
+    push rdi
+    push r8
+    push r9
+    push r10
+    push rbp
+    mov rbp, rsp
+    and rsp, -16                    ; C expects an aligned stack
+    call [rel jit_write]
+    mov rsp, rbp
+    pop rbp
+    pop r10
+    pop r9
+    pop r8
+    pop rdi
+    pop rsi
+    pop rdx
+    ret
+
+.exit:
+    mov rax, rdi                    ; The exit code is returned to the caller of the entry
+    mov qword [rel jit_exited], 1
+
+jit_leave:
+    mov rsp, [rel jit_stack]
+{''.join(f'    pop {r}{chr(10)}' for r in reversed(CALLEE_SAVED))}\
+    ret
+
+jit_stack: dq 0
+jit_write: dq 0
+jit_exited: dq 0
+"""
+# Like the data of an executable, but with room for everything allocated in a session.
+SESSION_DATA = """
+section .data
+memory:
+.ptr: dq 0
+.start:
+    times {size} db 0
+.end:
+"""
+
+
+def map_executable(size: int) -> tuple[mmap.mmap, int]:
+    region = mmap.mmap(-1, size, prot=RWX)
+    start = ctypes.c_char.from_buffer(region)
+    address = ctypes.addressof(start)
+    # The region can't be closed while a ctypes object points into it.
+    del start
+    return region, address
+
+
+class JIT:
+    """
+    Runs generated code inside the compiler's own process. The program is encoded
+    into an executable `mmap` region and called through `ctypes`, with 'syscall'
+    replaced by a call to a trampoline. Writes go to a Python callback and an exit
+    returns to the caller, so nothing touches the disk and no process is spawned.
+    """
+
+    TARGET = Target('jit-x86_64', 'linux', SYS_EXIT, None, syscall=('call', 'jit_syscall'))
+
+    def __init__(self, write=None):
+        # (fd, data) -> None; defaults to writing to the file descriptor.
+        self.write = write or JIT.write_to_fd
+
+    @staticmethod
+    def supported() -> bool:
+        return sys.platform.startswith('linux') and platform.machine() in ('x86_64', 'AMD64')
+
+    @staticmethod
+    def ensure_supported():
+        if not JIT.supported():
+            raise RuntimeError(f'[JIT] Can only run on linux x86_64, not {sys.platform} {platform.machine()}')
+
+    @staticmethod
+    def write_to_fd(fd: int, data: bytes):
+        if fd in (1, 2):
+            (sys.stdout if fd == 1 else sys.stderr).flush()
+        os.write(fd, data)
+
+    @staticmethod
+    def run(code: str, data: str, write=None) -> int:
+        return JIT(write).execute(code, data)
+
+    def callback(self):
+        def write(fd, buffer, count):
+            self.write(fd, ctypes.string_at(buffer, count))
+            return count
+        return WRITE(write)
+
+    def execute(self, code: str, data: str) -> int:
+        JIT.ensure_supported()
+
+        # The generated code is position independent and the region is page aligned, so it can be encoded at 0.
+        program = PRELUDE + code + INTERNAL_CODE.format(exit=SYS_EXIT, syscall='call jit_syscall') + RUNTIME + INTERNAL_DATA + data + PAD_DATA
+        encoder = X86_64_Encoder(program)
+        binary = encoder.layout()
+
+        callback = self.callback()
+        region, address = map_executable(len(binary))
+        try:
+            region[:] = binary
+            ctypes.c_void_p.from_address(address + encoder.symbols['jit_write']).value = ctypes.cast(callback, ctypes.c_void_p).value
+            status = ENTRY(address)()
+        finally:
+            region.close()
+
+        return status & 0xFF
+
+
+class JITMemory(JIT):
+    """
+    A region that code is loaded into piece by piece, so a program can be run a part
+    at a time while its memory lives on. Each piece is assembled at the address it's
+    loaded to and reaches the earlier ones through the symbols they export. Values
+    that outlive a piece are kept in a table of globals, and the pieces run on a
+    stack of their own whose top is moved below what must be kept on it.
+    """
+
+    SIZE        = 64 << 20
+    STACK_SIZE  = 8 << 20
+    HEAP_SIZE   = 1 << 20
+    GLOBALS     = 4096
+
+    def __init__(self, write=None):
+        super().__init__(write)
+        JIT.ensure_supported()
+        self.region, self.address = map_executable(JITMemory.SIZE)
+        self.size = 0
+        self.stack_top = self.address + JITMemory.SIZE
+        self.stack_limit = self.stack_top - JITMemory.STACK_SIZE
+        self.code_limit = self.stack_limit - 8 * JITMemory.GLOBALS
+        self.globals = (ctypes.c_int64 * JITMemory.GLOBALS).from_address(self.code_limit)
+        self.symbols: dict[str, int] = {'jit_globals': self.code_limit}
+
+        self.write_callback = self.callback()
+        runtime = RUNTIME + INTERNAL_CODE.format(exit=SYS_EXIT, syscall='call jit_syscall') + SESSION_DATA.format(size=JITMemory.HEAP_SIZE)
+        self.load(runtime, ('jit_syscall', 'jit_leave', 'jit_stack', 'jit_write', 'jit_exited', 'alloc'))
+        ctypes.c_void_p.from_address(self.symbols['jit_write']).value = ctypes.cast(self.write_callback, ctypes.c_void_p).value
+
+    def load(self, source: str, exports=()):
+        """Assembles the source after what's already loaded and makes the `exports` available to later pieces."""
+        origin = self.address + self.size
+        encoder = X86_64_Encoder(f'BITS 64\norg {origin}\n' + source, self.symbols)
+        binary = encoder.layout()
+        end = self.size + len(binary)
+        if self.address + end > self.code_limit:
+            raise RuntimeError(f'[JIT] Out of memory for code ({end} bytes)')
+        self.region[self.size:end] = binary
+        self.size = end + (-end % 16)
+        for name in exports:
+            self.symbols[name] = encoder.symbols[name]
+
+    def entry(self, function: str, arguments: list[int], results: list[int], registers: list[str]) -> str:
+        """
+        An entry point called `<function>.enter` that passes the globals in the `arguments`
+        slots to the function and stores what it returns in the `results` slots.
+        """
+        if len(arguments) > len(registers) or len(results) > len(registers):
+            raise RuntimeError(f'[JIT] Too many values passed to {function}')
+        lines = [f'{function}.enter:\n', ENTER, f'    mov rsp, {self.stack_top:#x}\n']
+        lines += [f'    mov {registers[i]}, [rel jit_globals + {8 * slot}]\n' for i, slot in enumerate(arguments)]
+        lines += [f'    call {function}\n']
+        lines += [f'    mov [rel jit_globals + {8 * slot}], {registers[i]}\n' for i, slot in enumerate(results)]
+        lines += ['    mov rax, 0\n', '    jmp jit_leave\n']
+        return ''.join(lines)
+
+    def call(self, entry: str) -> Optional[int]:
+        """Runs a loaded entry point. The exit code is returned if the program exits."""
+        exited = ctypes.c_int64.from_address(self.symbols['jit_exited'])
+        exited.value = 0
+        status = ENTRY(self.symbols[entry])()
+        return status & 0xFF if exited.value else None
+
+    def keep_stack(self, address: int):
+        """Moves the top of the stack below an address on it, so later calls don't overwrite what's there."""
+        if self.stack_limit <= address < self.stack_top:
+            self.stack_top = address & ~15
+            if self.stack_top - self.stack_limit < 64 << 10:
+                raise RuntimeError('[JIT] Out of stack')
+
+    def close(self):
+        self.region.close()
@@ -1,3 +1,5 @@
+import re
+from array import array
 from typing import Any, Optional
 
 import errors
@@ -86,6 +88,8 @@ class Token:
 
     KIND = {*TOKENS1, *TOKENS2, *KEYWORDS, *KIND_WITH_DATA}
 
+    __slots__ = ('kind', 'begin', 'end', 'data')
+
     def __init__(self, kind: str, begin: Location, end: Location, data: Any = None):
         self.kind = kind
         self.begin = begin
@@ -111,6 +115,93 @@ class Token:
         return f'Tok({self.kind})'
 
 
+# Character classes for the table-driven lexer. Only ASCII is in the table,
+# anything else is classified by the same predicates `Lexer.lex` uses.
+WHITESPACE, IDENT, NUMBER, STRING, OPEN, CLOSE, COMMENT, SYMBOL = range(8)
+
+CHAR_CLASS = [SYMBOL] * 128
+for _char in ' \t\n':
+    CHAR_CLASS[ord(_char)] = WHITESPACE
+for _char in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_':
+    CHAR_CLASS[ord(_char)] = IDENT
+for _char in '0123456789':
+    CHAR_CLASS[ord(_char)] = NUMBER
+for _char in '({[':
+    CHAR_CLASS[ord(_char)] = OPEN
+for _char in ')}]':
+    CHAR_CLASS[ord(_char)] = CLOSE
+CHAR_CLASS[ord('"')] = STRING
+CHAR_CLASS[ord('#')] = COMMENT
+del _char
+
+# `\w` is exactly `is_ident_cont`, also for non-ASCII characters.
+IDENT_RUN  = re.compile(r'\w*')
+DIGIT_RUN  = re.compile(r'[0-9]*')
+HEX_RUN    = re.compile(r'[0-9A-Fa-f]*')
+SPACE_RUN  = re.compile(r'[ \t\n]*')
+STRING_RUN = re.compile(r'[^"\n]*')
+
+
+KINDS = [*sorted(Token.KIND), 'eof']
+KIND_ID = {kind: i for i, kind in enumerate(KINDS)}
+
+
+class TokenBuffer:
+    """
+    Struct-of-arrays storage for tokens. Every field is a parallel `array('i')`
+    column indexed by token, and the data of identifiers, strings and numbers is
+    kept in a side table. `Token` objects are only built when asked for.
+    """
+
+    def __init__(self):
+        self.kinds = array('i')
+        self.begin = array('i')
+        self.begin_row = array('i')
+        self.begin_col = array('i')
+        self.end = array('i')
+        self.end_row = array('i')
+        self.end_col = array('i')
+        self.payloads = {}
+
+    @staticmethod
+    def from_tokens(tokens: list[Token]) -> 'TokenBuffer':
+        self = TokenBuffer()
+        for token in tokens:
+            b, e = token.begin, token.end
+            self.append(token.kind, b.index, b.row, b.col, e.index, e.row, e.col, token.data)
+        return self
+
+    def append(self, kind: str, begin: int, begin_row: int, begin_col: int, end: int, end_row: int, end_col: int, data: Any = None):
+        if data is not None:
+            self.payloads[len(self.kinds)] = data
+        self.kinds.append(KIND_ID[kind])
+        self.begin.append(begin)
+        self.begin_row.append(begin_row)
+        self.begin_col.append(begin_col)
+        self.end.append(end)
+        self.end_row.append(end_row)
+        self.end_col.append(end_col)
+
+    def kind(self, i: int) -> str:
+        return KINDS[self.kinds[i]]
+
+    def token(self, i: int) -> Token:
+        begin = Location(self.begin[i], self.begin_row[i], self.begin_col[i])
+        end = Location(self.end[i], self.end_row[i], self.end_col[i])
+        return Token(KINDS[self.kinds[i]], begin, end, self.payloads.get(i))
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.token(j) for j in range(*i.indices(len(self.kinds)))]
+        return self.token(range(len(self.kinds))[i])
+
+    def __iter__(self):
+        return (self.token(i) for i in range(len(self.kinds)))
+
+
 def is_ident_start(char: str) -> bool:
     return char.isalpha() or char == '_'
 
@@ -303,41 +394,190 @@ class Lexer:
 
         return self.tokens
 
+    @staticmethod
+    def lex_fast(name, source) -> TokenBuffer:
+        """
+        Same tokens as `Lexer.lex`, but scans with character class tables and
+        regexes over the whole buffer. Row and column are kept as integers and
+        the tokens are stored directly in a `TokenBuffer`.
+        """
+        tokens = TokenBuffer()
+        expected_delimiter = []
+
+        n = len(source)
+        i = 0
+        row = 1
+        line_start = 0
+
+        def loc(index):
+            return Location(index, row, index - line_start + 1)
+
+        def emit(kind, begin, end, data=None):
+            col = 1 - line_start
+            tokens.append(kind, begin, row, begin + col, end, row, end + col, data)
+
+        def skip_numeric(run, index):
+            index = run.match(source, index).end()
+            while index < n and source[index].isnumeric():
+                index = run.match(source, index + 1).end()
+            return index
+
+        # The end-of-file token normally covers the location after the last character.
+        eof_begin, eof_end = n, n + 1
+
+        while i < n:
+            char = source[i]
+            code = ord(char)
+            if code < 128:
+                kind = CHAR_CLASS[code]
+            elif char.isalpha():
+                kind = IDENT
+            elif char.isnumeric():
+                kind = NUMBER
+            else:
+                kind = SYMBOL
+
+            if kind == WHITESPACE:
+                j = SPACE_RUN.match(source, i).end()
+                if (newline := source.rfind('\n', i, j)) != -1:
+                    row += source.count('\n', i, j)
+                    line_start = newline + 1
+                i = j
+
+            elif kind == IDENT:
+                j = IDENT_RUN.match(source, i).end()
+                text = source[i:j]
+                if text in KEYWORDS:
+                    emit(text, i, j)
+                else:
+                    emit('ident', i, j, bytes(text, 'utf-8'))
+                i = j
+
+            elif kind == NUMBER:
+                if char == '0' and source.startswith('x', i + 1):
+                    j = skip_numeric(HEX_RUN, i + 2)
+                    emit('number', i, j, int(source[i:j], 16))
+                else:
+                    j = skip_numeric(DIGIT_RUN, i + 1)
+                    if source.startswith('.', j):
+                        j = skip_numeric(DIGIT_RUN, j + 1)
+                        emit('real', i, j, float(source[i:j]))
+                    else:
+                        emit('number', i, j, int(source[i:j]))
+                i = j
+
+            elif kind == STRING:
+                j = STRING_RUN.match(source, i + 1).end()
+                if j == n or source[j] != '"':
+                    raise RuntimeError(f"Missing close quotation, got {repr(source[j:j+1])}")
+                # NOTE: Don't include '"' in the data or location.
+                emit('string', i + 1, j, bytes(source[i+1:j], 'utf-8'))
+                i = j + 1
+
+            elif kind == OPEN:
+                expected_delimiter.append(Lexer.MATCHING_DELIMITER[char])
+                emit(char, i, i + 1)
+                i += 1
+
+            elif kind == CLOSE:
+                if char != (expected := expected_delimiter.pop()):
+                    raise RuntimeError(f'Delimiter {char} does not match delimiter {expected} @ {loc(i)}')
+                emit(char, i, i + 1)
+                i += 1
+
+            elif kind == COMMENT:
+                j = source.find('\n', i + 1)
+                if j == -1:
+                    j = n
+                    if i + 1 == n:
+                        # An empty comment at the end leaves the end-of-file token at the '#'.
+                        eof_begin = i
+                i = j
+
+            elif char == '/' and source.startswith('*', i + 1):
+                # NOTE: `Lexer.lex` emits the last character of a block comment as a token.
+                opening = loc(i + 1)
+                close = source.find('*/', i + 1)
+                j = n - 1 if close == -1 else close + 1
+                if (newline := source.rfind('\n', i, j + 1)) != -1:
+                    row += source.count('\n', i, j + 1)
+                    line_start = newline + 1
+
+                if close == -1:
+                    # Unterminated, so the token is placed past the end of the source.
+                    char = source[j]
+                    if char not in TOKENS1:
+                        raise errors.error(name, source, loc(n), opening, f'Invalid token {char}')
+                    emit(char, n, n + 1)
+                    eof_begin, eof_end = n + 1, n + 2
+                    i = n
+                else:
+                    emit('*', j, j + 1)
+                    i = j + 1
+
+            elif (symbol := source[i:i+2]) in TOKENS2:
+                emit(symbol, i, i + 1)
+                i += 2
+
+            elif char in TOKENS1:
+                emit(char, i, i + 1)
+                i += 1
+
+            else:
+                raise errors.error(name, source, loc(i), loc(i + 1), f'Invalid token {char}')
+
+        if len(expected_delimiter) != 0:
+            raise RuntimeError('Missing delimiters ' + ', '.join(expected_delimiter))
+
+        emit('eof', eof_begin, eof_end)
+
+        return tokens
+
 
 class TokenStream:
     def __init__(self, source, tokens, name):
+        if not isinstance(tokens, TokenBuffer):
+            tokens = TokenBuffer.from_tokens(tokens)
         self._current = 0
         self._source = source
         self._tokens = tokens
+        self._kinds = tokens.kinds
         self._name = name
 
     def previous(self):
         if self._current == 0:
             return None
-        return self._tokens[self._current - 1]
+        return self._tokens.token(self._current - 1)
+
+    def previous_kind(self) -> Optional[str]:
+        if self._current == 0:
+            return None
+        return KINDS[self._kinds[self._current - 1]]
 
     def previous_is(self, kind):
-        return self.previous() and self.previous().kind == kind
+        return self.previous_kind() == kind
 
     def peek_many(self, count=1) -> list[Token]:
         tokens = self._tokens[self._current:self._current + count]
         return tokens
 
     def peek(self) -> Token:
-        token = self._tokens[self._current]
+        token = self._tokens.token(self._current)
         return token
 
+    def peek_kind(self, offset=0) -> str:
+        index = min(self._current + offset, len(self._kinds) - 1)
+        return KINDS[self._kinds[index]]
+
     def peek_if(self, expected) -> bool:
-        return self.peek().kind == expected
+        return self._kinds[self._current] == KIND_ID.get(expected)
 
     def peek_if_any(self, *expected) -> bool:
-        token = self.peek()
-        return any(token.kind == e for e in expected)
+        return KINDS[self._kinds[self._current]] in expected
 
     def peek_if_all(self, *expected) -> bool:
-        count = len(expected)
-        tokens = self.peek_many(count)
-        if all(t.kind == e for t, e in zip(tokens, expected)):
+        kinds = self._kinds[self._current:self._current + len(expected)]
+        if all(KINDS[k] == e for k, e in zip(kinds, expected)):
             return True
         return False
 
@@ -350,24 +590,25 @@ class TokenStream:
         return token
 
     def next_if(self, expect) -> Optional[Token]:
-        token = self.peek()
-        if expect != token.kind:
+        if self._kinds[self._current] != KIND_ID.get(expect):
             return None
+        token = self.peek()
         if token.kind != 'eof':
             self._current += 1
         return token
 
     def next_if_any(self, *expects) -> Optional[Token]:
-        token = self.peek()
-        if token.kind in expects:
+        if KINDS[self._kinds[self._current]] in expects:
+            token = self.peek()
             self._current += 1
             return token
         return None
 
     def next_if_all(self, *expects) -> list[Optional[Token]]:
         count = len(expects)
-        tokens = self.peek_many(count)
-        if all(t.kind == e for t, e in zip(tokens, expects)):
+        kinds = self._kinds[self._current:self._current + count]
+        if all(KINDS[k] == e for k, e in zip(kinds, expects)):
+            tokens = self.peek_many(count)
             self._current += count
             return tokens
         return [None] * count
@@ -376,10 +617,10 @@ class TokenStream:
         if not self.has_more():
             return True
         else:
-            return token.end.row == self.peek().begin.row
+            return token.end.row == self._tokens.begin_row[self._current]
 
     def has_more(self) -> bool:
-        return self._current + 1 < len(self._tokens)
+        return self._current + 1 < len(self._kinds)
 
 
 def main():
@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+
+from binary_writer import BinaryWriter
+from x86_64_encoder import X86_64_Encoder, fits
+
+
+@dataclass
+class ObjectFile:
+    """
+    Machine code assembled on its own, as if loaded at address 0. The symbols are
+    offsets into the code, and each relocation is the offset of a field relative to
+    the instruction after it, which the linker adds the distance to a symbol from
+    another object to.
+    """
+    code: bytes
+    symbols: dict[str, int]
+    relocations: list[tuple[int, str]]
+    section: str = '.text'
+    alignment: int = 1
+
+    @staticmethod
+    def assemble(source: str) -> 'ObjectFile':
+        encoder = X86_64_Encoder(source, relocatable=True)
+        code = encoder.layout()
+        if len(encoder.sections) > 1:
+            raise RuntimeError(f'[Linker] An object can only have one section, not {", ".join(encoder.sections)}')
+        section = next(iter(encoder.sections), '.text')
+        return ObjectFile(bytes(code), encoder.symbols, encoder.relocations, section, encoder.alignment)
+
+
+class Linker:
+    """
+    Stitches object files into one binary. The objects are placed one after another
+    from the origin, each at its alignment, and the references between them are
+    filled in, which gives the same bytes as assembling their sources together.
+    """
+
+    @staticmethod
+    def link(objects: list[ObjectFile], origin: int) -> tuple[bytearray, dict[str, int]]:
+        """The binary and the start address of each of its sections."""
+        bases, sections, symbols = [], {}, {}
+        address = origin
+        for obj in objects:
+            address += -address % obj.alignment
+            bases.append(address)
+            sections.setdefault(obj.section, address)
+            for name, offset in obj.symbols.items():
+                if name in symbols:
+                    raise RuntimeError(f"[Linker] Symbol '{name}' is defined more than once")
+                symbols[name] = address + offset
+            address += len(obj.code)
+
+        writer = BinaryWriter(address - origin)
+        for obj, base in zip(objects, bases):
+            if obj.section == '.text':
+                writer.write(b'\x90' * (base - origin - writer.position))
+            writer.seek(base - origin)
+            writer.write(obj.code)
+
+        binary = writer.getvalue()
+        for obj, base in zip(objects, bases):
+            for offset, name in obj.relocations:
+                if name not in symbols:
+                    raise RuntimeError(f"[Linker] Undefined symbol '{name}'")
+                position = base - origin + offset
+                value = int.from_bytes(binary[position:position + 4], 'little', signed=True) + symbols[name] - base
+                if not fits(value, 32):
+                    raise RuntimeError(f"[Linker] '{name}' is out of reach at {base + offset:#x}")
+                binary[position:position + 4] = value.to_bytes(4, 'little', signed=True)
+        return binary, sections
@@ -1,6 +1,8 @@
 class Location:
     Self = 'Location'
 
+    __slots__ = ('index', 'row', 'col')
+
     def __init__(self, index: int, row: int, col: int):
         self.index = index
         self.row = row
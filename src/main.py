@@ -2,21 +2,43 @@
 import sys
 
 from ir.passes import generate_graph_viz
+from import_cache import ImportCache
+from build_cache import BuildCache
 from lexer import Lexer
 from parser import Parser
 from ssa import check_if_in_ssa_form
 from type_checker import TypeChecker
 from x86_64_generator import X86_64_Generator
 from ir import parse, validate_ir, remove_unused_functions
-from assembler import make_macho_executable
+from target import TARGETS, DEFAULT_TARGET
+from jit import JIT
+from linker import ObjectFile
+from repl import ReplSession
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 import argparse
+import multiprocessing
+import os
 import subprocess
 
 
-def repl():
-    repl_code = 'import * from macos\nimport * from core\n'
+def repl(target):
+    if JIT.supported() and target.library == JIT.TARGET.library:
+        # Each line is compiled on its own and run in this process.
+        session = ReplSession()
+        while True:
+            line = input('> ')
+            try:
+                status = session.execute(line + '\n')
+            except Exception as e:
+                print(f'[ERROR]: {e}')
+                continue
+            if status is not None:
+                exit(status)
+
+    repl_code = 'import * from system\nimport * from core\n'
     output = ''
     while True:
         line = input('> ')
@@ -24,7 +46,7 @@ def repl():
         source = repl_code + line + '\n'
 
         try:
-            tokens = Lexer.lex('repl', source)
+            tokens = Lexer.lex_fast('repl', source)
             module = Parser.parse_module(source, tokens, 'repl')
 
             remove_unused_functions(module)
@@ -33,10 +55,11 @@ def repl():
             validate_ir(module)
             check_if_in_ssa_form(module)
 
-            code, data = X86_64_Generator.generate(module, types)
-            machine_code, readable_code = make_macho_executable('repl', code, data)
+            code, data = X86_64_Generator.generate(module, types, target=target)
+            machine_code, readable_code = target.make_executable('repl', code, data)
             with open(f'build/repl', 'wb') as file:
                 file.write(machine_code)
+            os.chmod('build/repl', 0o755)
 
             process = subprocess.run([f'build/repl'], capture_output=True)
             if process.stdout:
@@ -49,32 +72,107 @@ def repl():
 
 
 
+def check_types(module, names):
+    return TypeChecker.check(module, only=names)
+
+
+def generate_code(module, types, comments, target, names):
+    code, _ = X86_64_Generator.generate_functions(module, types, comments, target, only=names)
+    return code
+
+
+def assemble_code(module, types, target, names):
+    return {name: ObjectFile.assemble(code) for name, code in generate_code(module, types, False, target, names).items()}
+
+
+def build_functions(keys, cache, build, *parts, jobs=1):
+    """
+    What `build` makes of each function in `keys`, in order. Only the functions that
+    changed are given to `build`, and the rest come from the cache.
+    """
+    built, changed = {}, []
+    for name, key in keys.items():
+        if cache and (cached := cache.load(BuildCache.key(key, *parts))):
+            built[name], _ = cached
+        else:
+            changed.append(name)
+    if changed:
+        for name, value in build_in_parallel(build, changed, jobs).items():
+            built[name] = value
+            if cache:
+                cache.store(BuildCache.key(keys[name], *parts), value)
+    return [built[name] for name in keys]
+
+
+def build_in_parallel(build, names, jobs):
+    """
+    `build(names)`, with the names shared among `jobs` processes. The functions are
+    built independently of each other, so it's the same as building them in one.
+    """
+    if jobs <= 1 or len(names) <= 1:
+        return build(names)
+    shares = [names[i::jobs] for i in range(min(jobs, len(names)))]
+    built = {}
+    # Forking once the pool's thread runs can deadlock, so the workers start from a clean process.
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+    with ProcessPoolExecutor(len(shares), mp_context=context) as pool:
+        for result in pool.map(build, shares):
+            built.update(result)
+    return built
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('file', help='Source code file')
     parser.add_argument('--check', help='Run semantic analysis', action='store_true')
     parser.add_argument('--run', help='Run the executable', action='store_true')
+    parser.add_argument('--jit', help='Run in memory instead of building an executable (linux x86_64 only)', action='store_true')
     parser.add_argument('--is-ir', help='Assume the file is in ir format', action='store_true')
+    parser.add_argument('--no-asm-comments', help='Leave out the comments in the generated assembly', action='store_true')
+    parser.add_argument('--nasm', help='Cross-check the built-in encoder against nasm', action='store_true')
+    parser.add_argument('--target', help='Platform to build for', choices=TARGETS, default=DEFAULT_TARGET.name)
+    parser.add_argument('--no-cache', help='Build everything again instead of using build/.cache', action='store_true')
+    parser.add_argument('-j', '--jobs', help='Number of processes to build the functions with', type=int, default=1)
 
     args = parser.parse_args()
 
+    target = JIT.TARGET if args.jit else TARGETS[args.target]
+
+    os.makedirs('build', exist_ok=True)
+    # Libraries import the platform library of the target, so each target has its own cache.
+    Parser.import_cache = ImportCache(f'build/imports/{target.name}')
+    Parser.system_library = target.library
+
     if args.file == 'repl':
-        return repl()
+        return repl(target)
 
     path = Path(args.file)
+    cache = None if args.no_cache else BuildCache()
 
     source = open(path).read()
-    if args.is_ir or path.suffix == '.ir':
-        module = parse(source)
+    is_ir = args.is_ir or path.suffix == '.ir'
+    ir_key = BuildCache.key('ir', path.name, source, is_ir, target.library)
+    if cache and (cached := cache.load(ir_key)):
+        (module, types, keys), _ = cached
     else:
-        tokens = Lexer.lex(path.name, source)
-        module = Parser.parse_module(source, tokens, path.name)
-        validate_ir(module)
+        if is_ir:
+            module = parse(source)
+        else:
+            tokens = Lexer.lex_fast(path.name, source)
+            module = Parser.parse_module(source, tokens, path.name)
+            validate_ir(module)
+
+        remove_unused_functions(module)
+        # Keyed before type checking, which resolves the types of the module.
+        keys = {name: BuildCache.function_key(module, f) for name, f in module.functions.items() if f.blocks}
+        environments = build_functions(keys, cache, partial(check_types, module), 'types', jobs=args.jobs)
+        types = dict(zip(keys, environments))
+        if not check_if_in_ssa_form(module):
+            raise ValueError("Module is not in SSA form. Please run the SSA pass before type checking.")
 
-    remove_unused_functions(module)
-    types = TypeChecker.check(module)
-    if not check_if_in_ssa_form(module):
-        raise ValueError("Module is not in SSA form. Please run the SSA pass before type checking.")
+        dependencies = BuildCache.dependencies(Parser.import_path(name) for name in module.imports)
+        if cache:
+            cache.store(ir_key, (module, types, keys), dependencies)
 
     if args.check:
         return None
@@ -85,11 +183,37 @@ def main():
 
     # print(module)
 
-    code, data = X86_64_Generator.generate(module, types)
-    machine_code, readable_code = make_macho_executable(path.stem, code, data)
+    comments = not args.no_asm_comments
+    data = X86_64_Generator.generate_data(module.data)
+
+    # The whole program is keyed by its functions in order, so an unchanged one is neither joined nor linked again.
+    functions = list(keys.values())
+    if args.jit or args.nasm:
+        program_key = BuildCache.key('program', functions, comments, target.name)
+        if cache and (cached := cache.load(program_key)):
+            code, _ = cached
+        else:
+            code = ''.join(build_functions(keys, cache, partial(generate_code, module, types, comments, target), 'asm', comments, target.name, jobs=args.jobs))
+            if cache:
+                cache.store(program_key, code)
+        if args.jit:
+            exit(JIT.run(code, data))
+        # The cross-check with nasm is the point of '--nasm', so it always builds.
+        machine_code, readable_code = target.make_executable(path.stem, code, data, cross_check=True)
+    else:
+        executable_key = BuildCache.key('executable', functions, data, target.name)
+        if cache and (cached := cache.load(executable_key)):
+            machine_code, _ = cached
+        else:
+            # Each function is assembled on its own, so only the changed ones are built before linking.
+            objects = build_functions(keys, cache, partial(assemble_code, module, types, target), 'object', target.name, jobs=args.jobs)
+            machine_code = target.link_executable(objects, data)
+            if cache:
+                cache.store(executable_key, machine_code)
 
     with open(f'build/{path.stem}', 'wb') as file:
         file.write(machine_code)
+    os.chmod(f'build/{path.stem}', 0o755)
 
     if args.run:
         process = subprocess.run([f'build/{path.stem}'])
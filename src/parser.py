@@ -1,7 +1,8 @@
 from typing import Union, Dict
 
 import errors
-from lexer import Lexer, Token, TokenStream
+from import_cache import ImportCache
+from lexer import Lexer, Token, TokenBuffer, TokenStream
 from ir import Op, Function, Builtin, Block, Code, Module
 
 
@@ -111,11 +112,20 @@ class Parser(TokenStream):
         "lambda": 1  # Lambda expression
     }
 
+    # Parsed library modules, shared by all parsers.
+    import_cache = ImportCache()
+    # The platform library that 'import * from system' refers to, which depends on the target.
+    system_library = 'macos'
+
+    @staticmethod
+    def import_path(file: str) -> str:
+        return 'examples/' + file + '.sf'
+
     @staticmethod
     def precedence_of(token: Token) -> int:
         return Parser.PRECEDENCE.get(token.kind, -1)
 
-    def __init__(self, source: str, tokens: list[Token], name = '__main__'):
+    def __init__(self, source: str, tokens: Union[TokenBuffer, list[Token]], name = '__main__'):
         super().__init__(source, tokens, name)
         self.name = name
         self.functions: Dict[str, Union[Function, Builtin]] = {
@@ -126,6 +136,8 @@ class Parser(TokenStream):
         self.constants = {}
         self.types = {}
         self.imports = {}
+        # Paths of the modules imported by this one.
+        self.imported = []
         self.in_expression_followed_by_block = False
         self.scopes = []
         self.name_id = -1
@@ -195,55 +207,66 @@ class Parser(TokenStream):
         assert len(self.scopes) == 0
         assert self.block.terminator is None
 
+        self.check_deferred_lookups()
+        self.block.terminator = Code(Op.RET, token=self.peek())
+        return Module(name, source, self.functions, self.data, self.constants, self.types, self.imports)
+
+    def check_deferred_lookups(self):
         if self.deferred_lookup:
             error = ''
             for constant, token in self.deferred_lookup.items():
                 error += str(errors.error(self._name, self._source, token.begin, token.end, f"'{constant}' was never declared"))
             raise RuntimeError(error)
-        self.block.terminator = Code(Op.RET, token=self.peek())
-        return Module(name, source, self.functions, self.data, self.constants, self.types, self.imports)
 
     # TODO: Separate declaration and statements, since a declaration is only allowed
     #       within a module or block.
     def parse_stmt(self):
-        t0, t1 = self.peek_many(2)
+        kind = self.peek_kind()
 
-        if t0.kind == 'ident':
-            if t1.kind in (':', ':=', ','):
+        if kind == 'ident':
+            next_kind = self.peek_kind(1)
+            if next_kind in (':', ':=', ','):
                 return self.parse_decl()
-            elif t1.kind == '=':
+            elif next_kind == '=':
                 ident, comptime = self.parse_ident()
                 if comptime:
+                    t0 = self.previous()
                     raise errors.error(self._name, self._source, t0.begin, t0.end, f"Unknown variable or trying to assign to a comptime value '{ident}'")
                 return self.parse_assign(target=ident)
-            elif t1.kind == '[':
+            elif next_kind == '[':
                 ident, comptime = self.parse_ident()
                 target = self.parse_indexing(ident, is_lvl=True)
                 return self.parse_assign(target=target)
-            elif t1.kind == '(':
+            elif next_kind == '(':
                 return self.parse_func_call()
             else:
-                raise errors.error(self._name, self._source, t0.begin, t0.end, f"Unknown stmt type '{t1.kind}'")
-        elif t0.kind == 'if':
+                t0 = self.peek()
+                raise errors.error(self._name, self._source, t0.begin, t0.end, f"Unknown stmt type '{next_kind}'")
+        elif kind == 'if':
             return self.parse_if()
-        elif t0.kind == 'while':
+        elif kind == 'while':
             return self.parse_while()
-        elif t0.kind == 'return':
+        elif kind == 'return':
             return self.parse_return()
-        elif t0.kind == '{':
+        elif kind == '{':
             return self.parse_block()
-        elif t0.kind == '@':
+        elif kind == '@':
             return self.parse_compiler_attribute()
-        elif t0.kind == 'import':
+        elif kind == 'import':
             return self.parse_import()
         else:
-            raise errors.error(self._name, self._source, t0.begin, t0.end, f"Unknown token '{t0.kind}'")
+            t0 = self.peek()
+            raise errors.error(self._name, self._source, t0.begin, t0.end, f"Unknown token '{kind}'")
 
     def parse_import(self):
         _ = self.next(expect='import')
         things = self.next()
         _ = self.next(expect='from')
         file = self.next(expect='ident').data.decode()
+        if file == 'system':
+            file = Parser.system_library
+        path = Parser.import_path(file)
+        self.imported.append(path)
 
         if file in self.imports:
             functions, data, constants, user_types, decls = self.imports[file]
@@ -255,19 +278,30 @@ class Parser(TokenStream):
             return
 
         assert things.kind == '*', "Only support full imports for now"
-        with open('examples/' + file + '.sf', 'r') as data:
-            source = data.read()
+        if (cached := Parser.import_cache.load(path)) is not None:
+            (functions, data, constants, user_types, decls), nested = cached
+            for name, imported in nested.items():
+                self.imports.setdefault(name, imported)
+        else:
+            with open(path, 'r') as data:
+                source = data.read()
+
+            before = set(self.imports)
+            tokens = Lexer.lex_fast(self._name, source)
+            parser = Parser(source, tokens, file)
+            functions, data, constants, user_types = parser.parse_module_as_import(file + '.sf', self.imports)
+            decls = parser.scope.decls
+
+            nested = {name: self.imports[name] for name in self.imports if name not in before}
+            Parser.import_cache.store(path, source, ((functions, data, constants, user_types, decls), nested), parser.imported)
 
-        tokens = Lexer.lex(self._name, source)
-        parser = Parser(source, tokens, file)
-        functions, data, constants, user_types = parser.parse_module_as_import(file + '.sf', self.imports)
         self.functions.update(functions)
         self.data.update(data)
         self.constants.update(constants)
         self.types.update(user_types)
 
-        self.scope.decls.extend(parser.scope.decls)
-        self.imports[file] = functions, data, constants, user_types, parser.scope.decls
+        self.scope.decls.extend(decls)
+        self.imports[file] = functions, data, constants, user_types, decls
 
 
     def parse_decl(self):
@@ -546,13 +580,13 @@ class Parser(TokenStream):
     def parse_expr(self, precedence=0):
         left = self.parse_prefix()
 
-        while self.precedence_of(self.peek()) >= precedence:
+        while Parser.PRECEDENCE.get(self.peek_kind(), -1) >= precedence:
             # @NOTE: Special rule for initializer. Otherwise, the statement `if 1+2 {}` will take
             #        `1+2` and parse as a type initialization. Which will always fail since 1+2 is
             #         not a type. The common case is `MyType {}`, which is almost always an identifier.
             #         This is only an issue when in an expression that might be followed by a block,
             #         for example the condition in an if-statement.
-            if self.peek_if('{') and (self.previous().kind != 'ident' or self.in_expression_followed_by_block):
+            if self.peek_if('{') and (self.previous_kind() != 'ident' or self.in_expression_followed_by_block):
                 return left
 
             left = self.parse_infix(left)
@@ -587,9 +621,9 @@ class Parser(TokenStream):
         elif self.peek_if('string'):
             return self.parse_string()
         elif self.peek_if('ident'):
-            if self.peek_many(2)[1].kind == '(':
+            if self.peek_kind(1) == '(':
                 return self.parse_func_call()
-            if self.peek_many(2)[1].kind == '{' and not self.in_expression_followed_by_block:
+            if self.peek_kind(1) == '{' and not self.in_expression_followed_by_block:
                 return self.parse_initializer()
             ident, comptime = self.parse_ident()
             return ident
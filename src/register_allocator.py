@@ -0,0 +1,202 @@
+import bisect
+from typing import Any, Optional
+
+from ir import Op, Function, ARITHMETICS, LOGICALS
+
+
+class Interval:
+    """
+    The positions from the first definition to the last use of a value, where every
+    instruction and terminator of a function has its own position in block order.
+    """
+    __slots__ = ('name', 'start', 'end', 'hint', 'source', 'late', 'crosses_call', 'location')
+
+    def __init__(self, name: str, position: int):
+        self.name = name
+        self.start = position
+        self.end = position
+        # A register that saves a move if the value ends up in it.
+        self.hint: Optional[str] = None
+        # A value whose register can be reused as it dies where this one is defined.
+        self.source: Optional[str] = None
+        # Whether it's written after all operands are read, like the result of a call.
+        self.late = False
+        # Whether a call happens while it's live, so it's better off in a callee-saved register.
+        self.crosses_call = False
+        self.location: Optional[str] = None
+
+    def extend(self, position: int):
+        self.start = min(self.start, position)
+        self.end = max(self.end, position)
+
+    def __repr__(self):
+        return f'{self.name}[{self.start}, {self.end}] -> {self.location}'
+
+
+class Allocation:
+    def __init__(self, intervals: dict[str, Interval], slots: int):
+        self.intervals = intervals
+        self.slots = slots
+
+    def location(self, name: str) -> Optional[str]:
+        interval = self.intervals.get(name)
+        return interval.location if interval else None
+
+    def is_spilled(self, name: str) -> bool:
+        location = self.location(name)
+        return location is not None and location.startswith('[')
+
+    def live_across(self, position: int) -> list[tuple[str, str]]:
+        """The registers holding a value that is defined before `position` and used after it."""
+        return [
+            (i.name, i.location) for i in self.intervals.values()
+            if i.start < position < i.end and not i.location.startswith('[')
+        ]
+
+    def registers(self) -> set[str]:
+        return {i.location for i in self.intervals.values() if not i.location.startswith('[')}
+
+
+class LinearScan:
+    """
+    Linear scan register allocation (Poletto and Sarkar). Live intervals are built from
+    the liveness of the function, and when all registers are taken, the interval ending
+    last is spilled to a stack slot relative to `rbp`. Values live across a call are
+    put in callee-saved registers when possible, so they don't need saving at every call.
+    """
+
+    # Instructions that can write their result to the register of their first operand.
+    COALESCE = (Op.DECL, Op.COPY, Op.AS, Op.FIELD, Op.INDEX, *ARITHMETICS, *LOGICALS)
+
+    def __init__(self, registers: list[str], arguments: list[str], callee_saved: tuple[str, ...] = ()):
+        self.registers = registers
+        self.arguments = arguments
+        self.callee_saved = callee_saved
+
+    def intervals(self, function: Function, live_at_exit: Optional[dict[Any, str]] = None) -> dict[str, Interval]:
+        intervals: dict[str, Interval] = {}
+        live_in, live_out = function.live_in(), function.live_out()
+        live_at_exit = live_at_exit or {}
+
+        def name_of(block, ref):
+            return ref if type(ref) == str else block.instructions[ref].dest
+
+        def define(name, position):
+            if name not in intervals:
+                intervals[name] = Interval(name, position)
+            intervals[name].extend(position)
+            return intervals[name]
+
+        uses: list[tuple[str, int]] = []
+        calls: list[int] = []
+        ranges: dict[Any, tuple[int, int]] = {}
+        position = 0
+        parameters = 0
+        for block in function.blocks:
+            first = position
+            for code in block.instructions + [block.terminator]:
+                refs = code.refs[:1] if code.op == Op.ACCESS else code.refs
+                names = [name_of(block, ref) for ref in refs]
+                uses.extend((name, position) for name in names)
+                if code.op in (Op.CALL, Op.SYSCALL):
+                    calls.append(position)
+
+                if code.op == Op.PARAM:
+                    # Parameters arrive in registers and are all live at the entry.
+                    interval = define(code.dest, 0)
+                    interval.hint = self.arguments[parameters]
+                    parameters += 1
+                elif code.op == Op.MULTIDECL:
+                    call = intervals[names[0]]
+                    for i, name in enumerate(code.args):
+                        result = define(f'{names[0]}.{i}', call.start)
+                        result.hint = self.arguments[i]
+                        result.late = True
+                        result.extend(position)
+                        define(name, position)
+                elif code.dest is not None:
+                    interval = define(code.dest, position)
+                    if code.op in (Op.CALL, Op.SYSCALL):
+                        interval.hint = self.arguments[0]
+                        interval.late = True
+                    elif code.op in LinearScan.COALESCE and names:
+                        interval.source = names[0]
+                position += 1
+
+            ranges[block.label] = (first, position - 1)
+            for name in live_in[block.label]:
+                uses.append((name, first))
+            for name in live_out[block.label]:
+                uses.append((name, position - 1))
+
+        # A value read on exit is live back to its definitions, which the liveness of the function doesn't know about.
+        for label, name in live_at_exit.items():
+            uses.append((name, ranges[label][1]))
+            stack, visited = [label], set()
+            while stack:
+                current = stack.pop()
+                if current in visited:
+                    continue
+                visited.add(current)
+                if any(name == code.dest or (code.op == Op.MULTIDECL and name in code.args) for code in function.block_at(current).instructions):
+                    continue
+                uses.append((name, ranges[current][0]))
+                for predecessor in function.predecessors[current]:
+                    uses.append((name, ranges[predecessor.label][1]))
+                    stack.append(predecessor.label)
+
+        # Names that are never defined are constants or functions.
+        for name, use in uses:
+            if name in intervals:
+                intervals[name].extend(use)
+
+        for interval in intervals.values():
+            after = bisect.bisect_right(calls, interval.start)
+            interval.crosses_call = after < len(calls) and calls[after] < interval.end
+        return intervals
+
+    def allocate(self, function: Function, live_at_exit: Optional[dict[Any, str]] = None) -> Allocation:
+        intervals = self.intervals(function, live_at_exit)
+        order = sorted(intervals.values(), key=lambda i: i.start)
+
+        free = list(self.registers)
+        active: list[Interval] = []
+        slots = 0
+
+        def spill(interval: Interval):
+            nonlocal slots
+            slots += 1
+            interval.location = f'[rbp - {8 * slots}]'
+
+        for current in order:
+            for interval in [i for i in active if i.end < current.start or (current.late and i.end == current.start)]:
+                active.remove(interval)
+                free.append(interval.location)
+
+            source = intervals.get(current.source)
+            if source in active and source.end == current.start:
+                # The operand dies here, so its register is free for the result.
+                active.remove(source)
+                free.append(source.location)
+                current.hint = source.location
+
+            if free:
+                candidates = free
+                if current.crosses_call and any(r in self.callee_saved for r in free):
+                    candidates = [r for r in free if r in self.callee_saved]
+                register = current.hint if current.hint in candidates else min(candidates, key=self.registers.index)
+                free.remove(register)
+                current.location = register
+                active.append(current)
+                continue
+
+            victim = max(active, key=lambda i: i.end)
+            if victim.end > current.end:
+                current.location = victim.location
+                active.remove(victim)
+                active.append(current)
+                spill(victim)
+            else:
+                spill(current)
+
+        return Allocation(intervals, slots)
@@ -0,0 +1,146 @@
+from typing import Optional
+
+import errors
+from ir import Op, Block, Code, Function, Module, validate_ir
+from jit import JIT, JITMemory
+from lexer import Lexer
+from parser import Parser, Scope
+from ssa import check_if_in_ssa_form
+from type import ArrayType, LiteralType, PointerType, PrimitiveType, StructType, Type
+from type_checker import TypeChecker
+from x86_64_generator import X86_64_Generator
+
+
+class ReplSession:
+    """
+    A REPL that keeps what earlier lines made, so a line is compiled and run on its
+    own. The parsed functions, declarations and type environments are kept between
+    lines, and the machine code is loaded into the same `JITMemory`. Each line is
+    compiled to a function that gets the variables of earlier lines it uses as
+    parameters and returns the ones it declares or assigns, which are kept in the
+    table of globals in between.
+    """
+
+    PRELUDE = 'import * from system\nimport * from core\n'
+
+    def __init__(self, write=None, prelude: str = PRELUDE):
+        self.memory = JITMemory(write)
+        self.functions = Parser('', []).functions
+        self.constants = {}
+        self.types = {}
+        self.imports = {}
+        self.scope = Scope()
+        # The type environments of the compiled functions.
+        self.environments = {}
+        # The slot in the table of globals and the type of every variable declared so far.
+        self.variables: dict[str, tuple[int, str]] = {}
+        self.lines = 0
+        self.execute(prelude)
+
+    def execute(self, source: str) -> Optional[int]:
+        """Compiles and runs a line, which returns the exit code if the program exits."""
+        name = f'repl_{self.lines}'
+        parser = Parser(source, Lexer.lex_fast('repl', source), 'repl')
+        parser.functions = dict(self.functions)
+        parser.constants = dict(self.constants)
+        parser.types = dict(self.types)
+        parser.imports = dict(self.imports)
+
+        function, _ = parser.new_function(name)
+        scope = parser.push_scope(self.scope)
+        while parser.has_more():
+            parser.parse_stmt()
+        parser.pop_scope()
+        parser.check_deferred_lookups()
+        for block in function.blocks:
+            if block.terminator is not None and block.terminator.op == Op.RET:
+                token = block.terminator.token
+                raise errors.error('repl', source, token.begin, token.end, "Can only return from functions")
+        parser.block.terminator = Code(Op.RET, token=parser.peek())
+
+        used = self.bind_parameters(function)
+        new = [f for f in parser.functions.values() if f.name not in self.functions and isinstance(f, Function)]
+        names = {f.name for f in new}
+
+        module = Module('repl', source, {f.name: f for f in new}, parser.data, parser.constants, parser.types, parser.imports)
+        validate_ir(module)
+        check_if_in_ssa_form(module)
+        module.functions = parser.functions
+        environments = TypeChecker.check(module, only=names)
+
+        # What the line leaves behind is only known once its types are.
+        declared = {c.dest for _, c in function.code() if c.op == Op.DECL} | {n for _, c in function.code() if c.op == Op.MULTIDECL for n in c.args}
+        assigned = {c.refs[0] for _, c in function.code() if c.op == Op.ASSIGN and type(c.refs[0]) == str}
+        results = [d for d in scope.decls if type(d) == str and d in declared] + [n for n in used if n in assigned]
+        parser.block.terminator.refs = tuple(results)
+        types = {n: ReplSession.type_name(environments[name][n]) for n in results if n not in self.variables}
+        function.returns = [(f'ret_{i}', types.get(n) or self.variables[n][1]) for i, n in enumerate(results)]
+        function.invalidate()
+
+        code, data = X86_64_Generator.generate(module, {**self.environments, **environments}, target=JIT.TARGET, only=names)
+        slots = {n: self.variables[n][0] for n in results if n in self.variables}
+        slots.update((n, len(self.variables) + i) for i, n in enumerate(types))
+        if len(self.variables) + len(types) > JITMemory.GLOBALS:
+            raise RuntimeError('[REPL] Out of room for variables')
+        entry = self.memory.entry(name, [self.variables[n][0] for n in used], [slots[n] for n in results], X86_64_Generator.REGISTERS)
+        self.memory.load(code + entry + '\nsection .data\n' + data, [*names, f'{name}.enter'])
+
+        # The line compiled, so what it declared is kept, even if running it fails.
+        self.functions = parser.functions
+        self.constants = parser.constants
+        self.types = parser.types
+        self.imports = parser.imports
+        self.scope.decls.extend(scope.decls)
+        self.environments.update(environments)
+        for n, t in types.items():
+            self.variables[n] = (slots[n], t)
+        self.lines += 1
+
+        status = self.memory.call(f'{name}.enter')
+        if status is None:
+            # Structs live on the stack, which must be kept for later lines.
+            for n in results:
+                if isinstance(environments[name].get(n), StructType):
+                    self.memory.keep_stack(self.memory.globals[slots[n]])
+        return status
+
+    def bind_parameters(self, function: Function) -> list[str]:
+        """Makes the variables of earlier lines that the function uses into its parameters."""
+        used = []
+        for _, code in function.code():
+            refs = code.refs[:1] if code.op == Op.ACCESS else code.refs
+            for ref in refs:
+                if type(ref) == str and ref in self.variables and ref not in used:
+                    used.append(ref)
+
+        entry = function.entry()
+        if used and function.predecessors[entry.label]:
+            # The first block is a loop header, so the parameters get a block of their own.
+            for block in function.blocks:
+                if block.terminator.op in (Op.BR, Op.JMP):
+                    block.terminator.args = tuple(offset + 1 for offset in block.terminator.args)
+            entry = Block('bb0_parameters', [], terminator=Code(Op.JMP, args=(1, ), token=entry.terminator.token))
+            function.blocks.insert(0, entry)
+
+        params = [Code(Op.PARAM, args=(self.variables[n][1], ), dest=n, token=entry.terminator.token) for n in used]
+        entry.instructions[0:0] = params
+        entry.shift_offsets(0, len(params))
+        function.params = {n: (self.variables[n][1], i, i) for i, n in enumerate(used)}
+        function.invalidate()
+        return used
+
+    @staticmethod
+    def type_name(t: Type) -> str:
+        """The name that a value of the type is declared with in a later line."""
+        if isinstance(t, LiteralType):
+            return 'int'
+        if isinstance(t, ArrayType) and t.name.startswith('char['):
+            return 'str'
+        if isinstance(t, StructType):
+            return t.name.removeprefix('struct ')
+        if isinstance(t, (PrimitiveType, PointerType)):
+            return t.name
+        raise RuntimeError(f"[REPL] Can't keep a value of type {t} between lines")
+
+    def close(self):
+        self.memory.close()
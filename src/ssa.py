@@ -1,18 +1,30 @@
+from ir import Op
 
 
 def check_if_in_ssa_form(module):
     """
-    Check if the module is in SSA form.
+    Check if the module is in SSA form, i.e. every variable is defined once in its
+    function and phi instructions are first in their block, with one value per predecessor.
     """
     for function in module.functions.values():
         seen_vars = set()
         for block in function.blocks:
+            phis_allowed = True
             for instruction in block.instructions:
+                if instruction.op == Op.PHI:
+                    predecessors = [p.label for p in function.predecessors[block.label]]
+                    if not phis_allowed or sorted(map(str, instruction.args)) != sorted(map(str, predecessors)) or len(instruction.refs) != len(predecessors):
+                        error = f"Error in function '{function.name}' at block '{block.label}':\n"
+                        error += f"Phi for '{instruction.dest}' must be first in the block and have one value per predecessor."
+                        raise RuntimeError(error)
+                else:
+                    phis_allowed = False
+
                 if instruction.dest is None:
                     continue
                 if instruction.dest in seen_vars:
                     error = f"Error in function '{function.name}' at block '{block.label}':\n"
-                    error += f"Variable '{instruction.dest}' is defined multiple times in the  same block."
+                    error += f"Variable '{instruction.dest}' is defined multiple times in the same function."
                     raise RuntimeError(error)
                 seen_vars.add(instruction.dest)
     return True
@@ -0,0 +1,28 @@
+import assembler
+import elf64_assembler
+
+
+class Target:
+    """A platform to build executables for."""
+
+    def __init__(self, name: str, library: str, exit_syscall: int, make_executable, syscall=('syscall', ), link_executable=None):
+        self.name = name
+        # The module that 'import * from system' refers to.
+        self.library = library
+        self.exit_syscall = exit_syscall
+        # (output, code, data, cross_check) -> (executable, program)
+        self.make_executable = make_executable
+        # (objects, data) -> executable, from the separately assembled functions.
+        self.link_executable = link_executable
+        # The instruction that system calls are made with.
+        self.syscall = syscall
+
+    def __repr__(self):
+        return self.name
+
+
+TARGETS = {
+    'macos-x86_64': Target('macos-x86_64', 'macos', assembler.SYS_EXIT, assembler.make_macho_executable, link_executable=assembler.link_macho_executable),
+    'linux-x86_64': Target('linux-x86_64', 'linux', elf64_assembler.SYS_EXIT, elf64_assembler.make_elf64_executable, link_executable=elf64_assembler.link_elf64_executable),
+}
+DEFAULT_TARGET = TARGETS['macos-x86_64']
@@ -23,7 +23,11 @@ class Type(ABC):
         pass
 
     def __eq__(self, other):
-        return self.is_equal(other)
+        return self is other or self.is_equal(other)
+
+    def key(self) -> tuple:
+        """The structure of the type, which is the same for equal types."""
+        return type(self).__name__, self.name, self.size, frozenset(self.qualifiers)
 
     def operation(self, op: Op, other: 'Type') -> Optional['Type']:
         raise NotImplementedError()
@@ -201,6 +205,9 @@ class PointerType(Type):
         super().__init__(name=f"{pointee.name}*", size=8, qualifiers=qualifiers)
         self.pointee = pointee
 
+    def key(self) -> tuple:
+        return super().key() + (self.pointee.key(), )
+
     def get_attribute(self, attribute):
         return self.pointee.get_attribute(attribute)
 
@@ -245,6 +252,9 @@ class ArrayType(Type):
         self.element_type = element_type
         self.length = length
 
+    def key(self) -> tuple:
+        return super().key() + (self.element_type.key(), self.length)
+
     def get_attribute(self, attribute):
         if attribute == 'len':
             return LiteralType(self.size)
@@ -268,6 +278,9 @@ class FunctionType(Type):
         self.return_types = return_types
         self.param_types = param_types
 
+    def key(self) -> tuple:
+        return super().key() + (tuple(t.key() for t in self.return_types), tuple(t.key() for t in self.param_types))
+
     def is_equal(self, other: 'Type') -> bool:
         return isinstance(other, FunctionType) and (
             self.param_types == other.param_types and
@@ -287,6 +300,9 @@ class StructType(Type):
         self.fields = fields
         self.methods: Dict[str, FunctionType] = {}
 
+    def key(self) -> tuple:
+        return super().key() + (tuple((n, t.key()) for n, t in self.fields.items()), )
+
     def get_attribute(self, attribute):
         return self.fields[attribute]
 
@@ -307,6 +323,9 @@ class OptionalType(Type):
         super().__init__(name=f"{base_type.name}?", size=base_type.size + 1)
         self.base_type = base_type
 
+    def key(self) -> tuple:
+        return super().key() + (self.base_type.key(), )
+
     def is_subtype_of(self, other: 'Type') -> bool:
         return self.is_equal(other) or self.base_type.is_equal(other)
 
@@ -320,6 +339,9 @@ class GenericType(Type):
         super().__init__(name, size=-1)
         self.param_names = param_names
 
+    def key(self) -> tuple:
+        return super().key() + tuple(self.param_names)
+
     def instantiate(self, param_types: List[Type]) -> 'InstantiatedGenericType':
         return InstantiatedGenericType(self, param_types)
 
@@ -335,25 +357,48 @@ class InstantiatedGenericType(Type):
         self.generic = generic
         self.param_types = param_types
 
+    def key(self) -> tuple:
+        return super().key() + (self.generic.key(), tuple(t.key() for t in self.param_types))
+
     def __repr__(self):
         return self.name
 
 
 # --- Type Registry ---
 class TypeRegistry:
+    """
+    Hash-conses types: there's one object for each structure, so equal types that went
+    through `intern` are the same object and are compared by identity. Subtyping is
+    remembered for each pair of interned types.
+    """
+
     def __init__(self, data=None):
-        self._registry = {}
+        self._registry: Dict[tuple, Type] = {}
+        # The registry keeps the interned types alive, so their ids are never reused.
+        self._interned: Set[int] = set()
+        self._subtypes: Dict[tuple[int, int], bool] = {}
 
     def intern(self, t: Type) -> Type:
-        key = str(t)
-        if key in self._registry:
-            return self._registry[key]
-        self._registry[key] = t
-        return t
-
-    def lookup(self, key: str) -> Optional[Type]:
+        if id(t) in self._interned:
+            return t
+        key = t.key()
+        interned = self._registry.get(key)
+        if interned is None:
+            interned = self._registry[key] = t
+            self._interned.add(id(t))
+        return interned
+
+    def lookup(self, key: tuple) -> Optional[Type]:
         return self._registry.get(key)
 
+    def is_subtype(self, sub: Type, sup: Type) -> bool:
+        sub, sup = self.intern(sub), self.intern(sup)
+        pair = id(sub), id(sup)
+        result = self._subtypes.get(pair)
+        if result is None:
+            result = self._subtypes[pair] = sub.is_subtype_of(sup)
+        return result
+
 
 
 def example_usage():
@@ -1,4 +1,6 @@
 import sys
+from collections import deque
+from typing import Callable
 
 import errors
 from ir import Op
@@ -10,16 +12,38 @@ from type import *
 #   * Global type checking: https://www.youtube.com/watch?v=fDTt_uo0F-g&t=3343s&ab_channel=ChariotSolutions
 
 
+class Environment(dict):
+    """
+    The types of the names in a function, which notes the names whose type changes.
+    The types are interned, so a type only changes when it's another object.
+    """
+
+    def __init__(self, registry: TypeRegistry):
+        super().__init__()
+        self.registry = registry
+        self.changed: list[str] = []
+
+    def __setitem__(self, name, t):
+        t = tuple(map(self.registry.intern, t)) if type(t) is tuple else self.registry.intern(t)
+        old = self.get(name)
+        if old is not t and not (type(old) is tuple and old == t):
+            self.changed.append(name)
+        super().__setitem__(name, t)
+
+
 class TypeChecker:
+    # Op -> handler(checker, function, block, code), filled in below the class.
+    HANDLERS: dict[Op, Callable] = {}
+
     def __init__(self, name, source, functions, data, constants, user_types):
         self.name = name
         self.source = source
         self.functions = functions
         self.data = data
         self.constants = constants
-        self.env = {}
         self.registry = TypeRegistry()
-        self.builtins = {
+        self.env = Environment(self.registry)
+        builtins = {
             None:       InferredType(),
             'void':     PrimitiveType(name='void', size=0),
             'bool':     PrimitiveType(name='bool', size=1),
@@ -35,12 +59,16 @@ class TypeChecker:
             'void*':    PointerType(PrimitiveType(name='void',  size=0)),
             'char*':    PointerType(PrimitiveType(name='char',  size=1)),
         }
+        self.builtins = {n: self.registry.intern(t) for n, t in builtins.items()}
         self.user_types = user_types
         self.types = []
         for n, t in self.user_types.items():
-            self.user_types[n] = StructType(n, {
+            if isinstance(t, StructType):
+                self.user_types[n] = self.registry.intern(t)
+                continue
+            self.user_types[n] = self.registry.intern(StructType(n, {
                 x: self.builtins[y[0]] if y[0] in self.builtins else self.user_types[y[0]]  for x, y in t.items()
-            })
+            }))
 
     def lookup_type(self, name):
         if name in self.builtins:
@@ -68,18 +96,19 @@ class TypeChecker:
             if arg in self.env:
                 self.env[arg] = t
             else:
-                self.constants[arg] = t
+                self.constants[arg] = self.registry.intern(t)
         else:
             self.env[block.instructions[arg].dest] = t
 
     @staticmethod
-    def check(module) -> dict[str, dict[str, Type]]:
+    def check(module, only=None) -> dict[str, dict[str, Type]]:
+        """Type environments by function, for the functions named in `only` or all of them."""
         functions = module.functions
         data = module.data
         constants = module.constants
         user_types = module.types
         self = TypeChecker(module.name, module.source, functions, data, constants, user_types)
-        types = self.check_()
+        types = self.check_(only)
         for func_name, env in types.items():
             for name, t in env.items():
                 if isinstance(t, InferredType):
@@ -91,146 +120,201 @@ class TypeChecker:
                     raise errors.error(self.name, self.source, Location(0, 1, 1), Location(0, 1, 1), f"Type inference failed for {func_name} {name}. Type is still inferred.")
         return types
 
-    def check_(self) -> dict[str, dict[str, Type]]:
+    def check_(self, only=None) -> dict[str, dict[str, Type]]:
         """Local reasoning type checking"""
         self.types = {}
         for function in self.functions.values():
-            self.env = { }
-            code = list(function.code())
-            for block, code in code + list(reversed(code)):
-                if code.op == Op.LIT:
-                    self.infer_lit(code)
-                elif code.op in (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.MOD, Op.AND, Op.OR, Op.EQ, Op.NEQ, Op.LT):
-                    a = self.type_of(block, code.lhs())
-                    b = self.type_of(block, code.rhs())
-                    t = a.operation(code.op, b)
-                    self.env[code.dest] = t
-                elif code.op == Op.ACCESS:
-                    obj = self.type_of(block, code.obj())
-                    attr = code.attr()
-                    try:
-                        self.env[code.dest] = obj.get_attribute(attr)
-                    except AttributeError:
-                        raise errors.error(self.name, self.source, code.token.begin, code.token.end, f"Cannot access attribute '{attr}' of {obj}.")
-                elif code.op == Op.DECL:
-                    if code.refs:
-                        a = self.lookup_type(code.type())
-                        b = self.type_of(block, code.expr())
-                        if not b.is_subtype_of(a):
-                            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
-                        if isinstance(a, InferredType):
-                            self.env[code.dest] = b
-                        else:
-                            self.env[code.dest] = a
-                    else:
-                        assert False, "Not implemented"
-                elif code.op == Op.MULTIDECL:
-                    a = self.type_of(block, code.expr())
-                    for i, n in enumerate(code.args):
-                        self.env[n] = a[i]
-                elif code.op == Op.ASSIGN:
-                    a = self.type_of(block, code.target())
-                    b = self.type_of(block, code.expr())
-                    if not b.is_subtype_of(a):
-                        raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
-                elif code.op == Op.LABEL:
-                    pass
-                elif code.op == Op.CALL:
-                    f = self.functions.get(code.args[0])
-                    if f is None:
-                        raise errors.error(self.name, self.source, code.token.begin, code.token.end, f"Function '{code.args[0]}' not found.")
-                    args = code.refs[:]
-                    if len(f.params) != len(args):
-                        raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Passing wrong amount of arguments to {f.name}. Expected {len(f.params)}, but got {len(args)}')
-                    for i, (name, t) in enumerate(f.params.items()):
-                        a = self.lookup_type(t[0])
-                        b = self.type_of(block, args[i])
-                        if not b.is_subtype_of(a):
-                            print(f'Error in {function.name} calling {f.name} at argument {i} ({name})', file=sys.stderr)
-                            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
-                    if len(f.returns) == 0:
-                        self.env[code.dest] = self.builtins[None]
-                    elif len(f.returns) == 1:
-                        ret = f.returns[0][1]
-                        self.env[code.dest] = self.lookup_type(ret)
-                    else:
-                        self.env[code.dest] = tuple(self.lookup_type(f.returns[i][1]) for i in range(len(f.returns)))
-                elif code.op == Op._:
-                    f = code.args[0]
-                    ret = f.returns[code.args[1]][1]
-                    self.env[code.dest] = self.lookup_type(ret)
-                elif code.op == Op.PARAM:
-                    self.env[code.dest] = self.lookup_type(code.type())
-                elif code.op == Op.FIELD:
-                    self.env[code.dest] = self.type_of(block, *code.refs)
-                elif code.op == Op.INIT:
-                    thing = self.lookup_type(code.type())
-                    assert len(thing.fields) == len(code.refs)
-                    for (n, t), arg in zip(thing.fields.items(), code.refs):
-                        a = t
-                        b = self.type_of(block, arg)
-                        if not b.is_subtype_of(a):
-                            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
-                    self.env[code.dest] = thing
-                elif code.op == Op.SYSCALL:
-                    self.env[code.dest] = self.builtins[None] if code.dest not in self.env else self.env[code.dest]
-                elif code.op == Op.ASM:
-                    self.env[code.dest] = self.type_of(block, *code.refs)
-                elif code.op == Op.INDEX:
-                    target = self.type_of(block, code.target())
-                    if target.name == 'str' or target.name == 'char*':
-                        self.env[code.dest] = self.builtins['char']
-                    else:
-                        assert isinstance(target, PointerType), f"Cannot index a '{target}'"
-                        self.env[code.dest] = target.pointee
-                elif code.op == Op.REF:
-                    target = self.type_of(block, code.target())
-                    self.env[code.dest] = PointerType(target)
-                elif code.op == Op.MOVE:
-                    target = self.type_of(block, code.target())
-                    self.env[code.dest] = target
-                elif code.op == Op.BRW:
-                    target = self.type_of(block, code.target())
-                    self.env[code.dest] = target
-                elif code.op == Op.COPY:
-                    target = self.type_of(block, code.target())
-                    self.env[code.dest] = target
-                elif code.op == Op.AS:
-                    target = code.target()
-                    obj = self.type_of(block, target)
-                    to  = self.lookup_type(code.type())
-                    if not obj.is_subtype_of(to):
-                        raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {obj} and {to}')
-                    dest = target if isinstance(target, str) else block.instructions[target].dest
-                    self.env[dest] = to
-                    self.env[code.dest] = to
-                elif code.op == Op.BR:
-                    pass
-                elif code.op == Op.JMP:
-                    pass
-                elif code.op == Op.RET:
-                    if function.is_module:
-                        continue
-                    elif len(function.returns) != len(code.refs):
-                        if ((len(function.returns) == 1 and function.returns[0][1] == 'void') or (len(function.returns) == 0)) and len(code.refs) == 0:
-                            self.env[code.dest] = self.builtins['void']
-                        else:
-                            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f"Returning wrong amount of returns to '{function.name}'. Expected {len(function.returns)}, but got {len(code.refs)}")
-                    elif len(function.returns) == 0 and len(code.refs) == 0:
-                        self.env[code.dest] = self.builtins['void']
-
-                    for ret, arg in zip(function.returns, code.refs):
-                        a = self.lookup_type(ret[1])
-                        b = self.type_of(block, arg)
-                        if not b.is_subtype_of(a):
-                            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
-                        self.set_type(block, arg, a)
-                else:
-                    assert False, f'Unknown instruction {code}'
-            self.types[function.name] = self.env
+            if only is not None and function.name not in only:
+                continue
+            self.env = Environment(self.registry)
+            self.infer(function)
+            self.types[function.name] = dict(self.env)
         return self.types
 
-    def infer_lit(self, code):
+    def infer(self, function):
+        """
+        Checks the instructions in order, and again whenever the type of something they
+        use changes, until no type does. Straight-line code is checked once, and a loop
+        until the types coming in over its back edges are settled.
+        """
+        handlers = self.HANDLERS
+        code = list(function.code())
+        users: dict[str, list[int]] = {}
+        for i, (block, c) in enumerate(code):
+            for ref in c.refs:
+                users.setdefault(block.instructions[ref].dest if type(ref) == int else ref, []).append(i)
+
+        worklist = deque(range(len(code)))
+        queued = [True] * len(code)
+        changed = self.env.changed
+        while worklist:
+            i = worklist.popleft()
+            queued[i] = False
+            block, c = code[i]
+            handler = handlers.get(c.op)
+            assert handler is not None, f'Unknown instruction {c}'
+            handler(self, function, block, c)
+            while changed:
+                for user in users.get(changed.pop(), ()):
+                    if not queued[user]:
+                        queued[user] = True
+                        worklist.append(user)
+
+    @classmethod
+    def register(cls, op: Op, handler):
+        """Makes `handler(checker, function, block, code)` check the instructions with the op."""
+        cls.HANDLERS[op] = handler
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Registering a handler in a subclass leaves the others alone.
+        cls.HANDLERS = dict(cls.HANDLERS)
+
+    def check_binary(self, function, block, code):
+        a = self.type_of(block, code.lhs())
+        b = self.type_of(block, code.rhs())
+        t = a.operation(code.op, b)
+        self.env[code.dest] = t
+
+    def check_access(self, function, block, code):
+        obj = self.type_of(block, code.obj())
+        attr = code.attr()
+        try:
+            self.env[code.dest] = obj.get_attribute(attr)
+        except AttributeError:
+            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f"Cannot access attribute '{attr}' of {obj}.")
+
+    def check_decl(self, function, block, code):
+        if code.refs:
+            a = self.lookup_type(code.type())
+            b = self.type_of(block, code.expr())
+            if not self.registry.is_subtype(b, a):
+                raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
+            if isinstance(a, InferredType):
+                self.env[code.dest] = b
+            else:
+                self.env[code.dest] = a
+        else:
+            assert False, "Not implemented"
+
+    def check_multidecl(self, function, block, code):
+        a = self.type_of(block, code.expr())
+        for i, n in enumerate(code.args):
+            self.env[n] = a[i]
+
+    def check_assign(self, function, block, code):
+        a = self.type_of(block, code.target())
+        b = self.type_of(block, code.expr())
+        if not self.registry.is_subtype(b, a):
+            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
+
+    def check_nothing(self, function, block, code):
+        pass
+
+    def check_call(self, function, block, code):
+        f = self.functions.get(code.args[0])
+        if f is None:
+            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f"Function '{code.args[0]}' not found.")
+        args = code.refs[:]
+        if len(f.params) != len(args):
+            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Passing wrong amount of arguments to {f.name}. Expected {len(f.params)}, but got {len(args)}')
+        for i, (name, t) in enumerate(f.params.items()):
+            a = self.lookup_type(t[0])
+            b = self.type_of(block, args[i])
+            if not self.registry.is_subtype(b, a):
+                print(f'Error in {function.name} calling {f.name} at argument {i} ({name})', file=sys.stderr)
+                raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
+        if len(f.returns) == 0:
+            self.env[code.dest] = self.builtins[None]
+        elif len(f.returns) == 1:
+            ret = f.returns[0][1]
+            self.env[code.dest] = self.lookup_type(ret)
+        else:
+            self.env[code.dest] = tuple(self.lookup_type(f.returns[i][1]) for i in range(len(f.returns)))
+
+    def check_result(self, function, block, code):
+        f = code.args[0]
+        ret = f.returns[code.args[1]][1]
+        self.env[code.dest] = self.lookup_type(ret)
+
+    def check_param(self, function, block, code):
+        self.env[code.dest] = self.lookup_type(code.type())
+
+    def check_field(self, function, block, code):
+        self.env[code.dest] = self.type_of(block, *code.refs)
+
+    def check_init(self, function, block, code):
+        thing = self.lookup_type(code.type())
+        assert len(thing.fields) == len(code.refs)
+        for (n, t), arg in zip(thing.fields.items(), code.refs):
+            a = t
+            b = self.type_of(block, arg)
+            if not self.registry.is_subtype(b, a):
+                raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
+        self.env[code.dest] = thing
+
+    def check_syscall(self, function, block, code):
+        self.env[code.dest] = self.builtins[None] if code.dest not in self.env else self.env[code.dest]
+
+    def check_asm(self, function, block, code):
+        self.env[code.dest] = self.type_of(block, *code.refs)
+
+    def check_index(self, function, block, code):
+        target = self.type_of(block, code.target())
+        if target.name == 'str' or target.name == 'char*':
+            self.env[code.dest] = self.builtins['char']
+        else:
+            assert isinstance(target, PointerType), f"Cannot index a '{target}'"
+            self.env[code.dest] = target.pointee
+
+    def check_ref(self, function, block, code):
+        target = self.type_of(block, code.target())
+        self.env[code.dest] = PointerType(target)
+
+    def check_same(self, function, block, code):
+        """Moves, borrows and copies have the type of what they're made from."""
+        target = self.type_of(block, code.target())
+        self.env[code.dest] = target
+
+    def check_phi(self, function, block, code):
+        # Values from back edges are only known once what they're made from is checked.
+        incoming = [self.env[ref] for ref in code.refs if ref in self.env]
+        if incoming:
+            t = incoming[0]
+            integer = self.builtins['int']
+            if any(i is not t for i in incoming) and all(isinstance(i, LiteralType) or i is integer for i in incoming):
+                t = integer
+            self.env[code.dest] = t
+
+    def check_as(self, function, block, code):
+        target = code.target()
+        obj = self.type_of(block, target)
+        to  = self.lookup_type(code.type())
+        if not self.registry.is_subtype(obj, to):
+            raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {obj} and {to}')
+        dest = target if isinstance(target, str) else block.instructions[target].dest
+        self.env[dest] = to
+        self.env[code.dest] = to
+
+    def check_ret(self, function, block, code):
+        if function.is_module:
+            return
+        elif len(function.returns) != len(code.refs):
+            if ((len(function.returns) == 1 and function.returns[0][1] == 'void') or (len(function.returns) == 0)) and len(code.refs) == 0:
+                self.env[code.dest] = self.builtins['void']
+            else:
+                raise errors.error(self.name, self.source, code.token.begin, code.token.end, f"Returning wrong amount of returns to '{function.name}'. Expected {len(function.returns)}, but got {len(code.refs)}")
+        elif len(function.returns) == 0 and len(code.refs) == 0:
+            self.env[code.dest] = self.builtins['void']
+
+        for ret, arg in zip(function.returns, code.refs):
+            a = self.lookup_type(ret[1])
+            b = self.type_of(block, arg)
+            if not self.registry.is_subtype(b, a):
+                raise errors.error(self.name, self.source, code.token.begin, code.token.end, f'Type error between {a} and {b}')
+            self.set_type(block, arg, a)
+
+    def infer_lit(self, function, block, code):
         assert code.op == Op.LIT
         assert code.type() is not None, "All literals have a type"
         assert len(code.args) == 3, "Expected type, index and data"
@@ -248,4 +332,26 @@ class TypeChecker:
                 raise TypeError(f'Unknown type {code}')
 
 
-
+# The handler of each op, looked up once per instruction instead of testing the ops one by one.
+TypeChecker.HANDLERS.update({
+    Op.LIT:         TypeChecker.infer_lit,
+    **dict.fromkeys((Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.MOD, Op.AND, Op.OR, Op.EQ, Op.NEQ, Op.LT), TypeChecker.check_binary),
+    Op.ACCESS:      TypeChecker.check_access,
+    Op.DECL:        TypeChecker.check_decl,
+    Op.MULTIDECL:   TypeChecker.check_multidecl,
+    Op.ASSIGN:      TypeChecker.check_assign,
+    Op.CALL:        TypeChecker.check_call,
+    Op._:           TypeChecker.check_result,
+    Op.PARAM:       TypeChecker.check_param,
+    Op.FIELD:       TypeChecker.check_field,
+    Op.INIT:        TypeChecker.check_init,
+    Op.SYSCALL:     TypeChecker.check_syscall,
+    Op.ASM:         TypeChecker.check_asm,
+    Op.INDEX:       TypeChecker.check_index,
+    Op.REF:         TypeChecker.check_ref,
+    **dict.fromkeys((Op.MOVE, Op.BRW, Op.COPY), TypeChecker.check_same),
+    Op.PHI:         TypeChecker.check_phi,
+    Op.AS:          TypeChecker.check_as,
+    **dict.fromkeys((Op.LABEL, Op.BR, Op.JMP), TypeChecker.check_nothing),
+    Op.RET:         TypeChecker.check_ret,
+})
@@ -0,0 +1,740 @@
+# https://www.felixcloutier.com/x86/
+# https://wiki.osdev.org/X86-64_Instruction_Encoding
+# https://www.nasm.us/doc/nasmdoc7.html (the 'bin' output format)
+import functools
+import re
+from typing import NamedTuple, Optional
+
+
+REGISTERS = {}
+for number, name in enumerate(['rax', 'rcx', 'rdx', 'rbx', 'rsp', 'rbp', 'rsi', 'rdi']):
+    REGISTERS[name] = (number, 8)
+    REGISTERS['e' + name[1:]] = (number, 4)
+    REGISTERS[name[1:]] = (number, 2)
+for number, name in enumerate(['al', 'cl', 'dl', 'bl', 'spl', 'bpl', 'sil', 'dil']):
+    REGISTERS[name] = (number, 1)
+for number in range(8, 16):
+    REGISTERS[f'r{number}'] = (number, 8)
+    REGISTERS[f'r{number}d'] = (number, 4)
+    REGISTERS[f'r{number}w'] = (number, 2)
+    REGISTERS[f'r{number}b'] = (number, 1)
+    REGISTERS[f'r{number}l'] = (number, 1)
+
+CONDITIONS = {
+    'o': 0x0, 'no': 0x1, 'b': 0x2, 'c': 0x2, 'nae': 0x2, 'ae': 0x3, 'nb': 0x3, 'nc': 0x3,
+    'e': 0x4, 'z': 0x4, 'ne': 0x5, 'nz': 0x5, 'be': 0x6, 'na': 0x6, 'a': 0x7, 'nbe': 0x7,
+    's': 0x8, 'ns': 0x9, 'p': 0xA, 'pe': 0xA, 'np': 0xB, 'po': 0xB, 'l': 0xC, 'nge': 0xC,
+    'ge': 0xD, 'nl': 0xD, 'le': 0xE, 'ng': 0xE, 'g': 0xF, 'nle': 0xF,
+}
+
+# The operation in the 'reg' field of the ModRM byte for each group of instructions.
+ARITHMETIC = {'add': 0, 'or': 1, 'adc': 2, 'sbb': 3, 'and': 4, 'sub': 5, 'xor': 6, 'cmp': 7}
+UNARY      = {'not': 2, 'neg': 3, 'mul': 4, 'imul': 5, 'div': 6, 'idiv': 7}
+SHIFTS     = {'rol': 0, 'ror': 1, 'shl': 4, 'sal': 4, 'shr': 5, 'sar': 7}
+
+NO_OPERANDS = {
+    'ret': b'\xC3', 'syscall': b'\x0F\x05', 'cqo': b'\x48\x99', 'cdq': b'\x99',
+    'nop': b'\x90', 'leave': b'\xC9', 'hlt': b'\xF4', 'int3': b'\xCC',
+}
+
+SIZES = {'byte': 1, 'word': 2, 'dword': 4, 'qword': 8}
+DATA  = {'db': 1, 'dw': 2, 'dd': 4, 'dq': 8}
+
+LABEL, INSTRUCTION, DATA_, ALIGN, TIMES, SECTION = range(6)
+
+MAX_PASSES = 16
+
+
+class Register(NamedTuple):
+    number: int
+    size: int
+
+
+class Memory(NamedTuple):
+    base: Optional[int]
+    index: Optional[int]
+    scale: int
+    displacement: Optional[tuple]
+    rel: bool
+    size: Optional[int]
+
+
+class Immediate(NamedTuple):
+    expression: tuple
+
+
+class Statement(NamedTuple):
+    kind: int
+    line: int
+    arguments: tuple
+
+
+TOKENS = re.compile(r"""\s*(?:
+    (?P<number>0[xX][0-9a-fA-F_]+|0[bB][01_]+|[0-9][0-9a-fA-F_]*[hH]\b|[0-9][0-9_]*)
+  | (?P<here>\$\$|\$(?![\w.?@]))
+  | (?P<name>[A-Za-z_.?@$][\w.?@$#~]*)
+  | (?P<char>'[^']*'|"[^"]*"|`(?:[^`\\]|\\.)*`)
+  | (?P<operator><<|>>|//|[-+*/%()&|^~])
+)""", re.VERBOSE)
+
+ESCAPES = {
+    'n': 10, 't': 9, 'r': 13, '0': 0, 'a': 7, 'b': 8, 'f': 12, 'v': 11, 'e': 27,
+    '\\': 92, '`': 96, "'": 39, '"': 34, '?': 63,
+}
+
+
+def decode_string(literal: str) -> bytes:
+    """The bytes of a nasm string, where only backquoted strings have escapes."""
+    quote, body = literal[0], literal[1:-1]
+    if quote != '`':
+        return body.encode()
+    result = bytearray()
+    i = 0
+    while i < len(body):
+        c = body[i]
+        i += 1
+        if c != '\\':
+            result += c.encode()
+            continue
+        c = body[i]
+        i += 1
+        if c == 'x':
+            digits = re.match(r'[0-9a-fA-F]{1,2}', body[i:]).group()
+            result.append(int(digits, 16))
+            i += len(digits)
+        elif c in '01234567':
+            digits = re.match(r'[0-7]{1,3}', body[i-1:]).group()
+            result.append(int(digits, 8) & 0xFF)
+            i += len(digits) - 1
+        elif c in ESCAPES:
+            result.append(ESCAPES[c])
+        else:
+            result += ('\\' + c).encode()
+    return bytes(result)
+
+
+@functools.lru_cache(maxsize=None)
+def tokenize(expression: str) -> tuple:
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKENS.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError(f"Invalid expression '{expression}'")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+        while position < len(expression) and expression[position].isspace():
+            position += 1
+    return tuple(tokens)
+
+
+def scan(text: str):
+    """The characters of a line with whether they are within a string."""
+    quote, escaped = None, False
+    for i, c in enumerate(text):
+        if quote:
+            yield i, c, True
+            if escaped:
+                escaped = False
+            elif c == '\\' and quote == '`':
+                escaped = True
+            elif c == quote:
+                quote = None
+        else:
+            if c in '\'"`':
+                quote = c
+            yield i, c, quote is not None
+
+
+def split_operands(text: str) -> list[str]:
+    """Splits on the commas that aren't within brackets, parentheses or strings."""
+    operands, depth, start = [], 0, 0
+    for i, c, quoted in scan(text):
+        if quoted:
+            continue
+        if c in '[(':
+            depth += 1
+        elif c in '])':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            operands.append(text[start:i].strip())
+            start = i + 1
+    operands.append(text[start:].strip())
+    return [o for o in operands if o]
+
+
+def strip_comment(line: str) -> str:
+    if ';' not in line:
+        return line
+    for i, c, quoted in scan(line):
+        if c == ';' and not quoted:
+            return line[:i]
+    return line
+
+
+def fits(value: int, bits: int) -> bool:
+    return -(1 << (bits - 1)) <= value < (1 << (bits - 1))
+
+
+class X86_64_Encoder:
+    """
+    Assembles the nasm syntax that X86_64_Generator emits into a flat binary, like
+    `nasm -f bin` does, but in-process. Only the instructions and directives the
+    generator, the built-ins and inline assembly use are supported.
+
+    Labels are resolved by laying the program out until no address changes. Jumps
+    start out short and are made near once their target is out of reach, which only
+    ever grows the program, so it settles after a few passes.
+
+    A `relocatable` source is assembled without knowing where it's loaded, like an
+    object file. The symbols it doesn't define are left for the linker, which fills in
+    the `relocations` of the calls and 'rel' addresses that refer to them.
+    """
+
+    def __init__(self, source: str, externals: Optional[dict[str, int]] = None, relocatable: bool = False):
+        self.origin = 0
+        # Addresses of symbols defined outside the source, like code that is already loaded.
+        self.externals = externals or {}
+        self.relocatable = relocatable
+        self.defined: set[str] = set()
+        # The offset of each 32 bit field that the linker adds the address of a symbol to.
+        self.relocations: list[tuple[int, str]] = []
+        # The symbols from other objects that the current statement refers to, and where in it they go.
+        self.referenced: list[str] = []
+        self.field: Optional[int] = None
+        # The largest alignment in the source, which is what it must be loaded at.
+        self.alignment = 1
+        self.statements: list[Statement] = []
+        # Jumps that didn't fit in a byte in some pass, by statement index.
+        self.near: set[int] = set()
+        self.symbols: dict[str, int] = {}
+        self.previous: dict[str, int] = {}
+        self.missing: set[str] = set()
+        # The address where the content of each section starts, after its alignment.
+        self.sections: dict[str, int] = {}
+        self.address = 0
+        self.line = 0
+        self.parse(source)
+
+    @staticmethod
+    def assemble(source: str) -> bytearray:
+        return X86_64_Encoder(source).layout()
+
+    def error(self, message: str):
+        raise RuntimeError(f'[Encoder] Line {self.line}: {message}')
+
+    # ---- Parsing ----
+
+    def parse(self, source: str):
+        scope = ''
+        for self.line, line in enumerate(source.split('\n'), start=1):
+            line = strip_comment(line).strip()
+            match = re.match(r'^([A-Za-z_.?@$][\w.?@$#~]*):', line)
+            if match:
+                name = match.group(1)
+                if name.startswith('.'):
+                    name = scope + name
+                else:
+                    scope = name
+                self.statements.append(Statement(LABEL, self.line, (name, )))
+                self.defined.add(name)
+                line = line[match.end():].strip()
+            if line:
+                self.statements.append(self.statement(line, scope))
+
+    def statement(self, line: str, scope: str) -> Statement:
+        mnemonic, _, rest = line.partition(' ')
+        mnemonic = mnemonic.lower()
+        rest = rest.strip()
+
+        if mnemonic in ('bits', 'use64', 'global', 'default'):
+            return Statement(SECTION, self.line, (None, ))
+        if mnemonic == 'org':
+            self.origin = self.evaluate(self.expression(rest, scope))
+            return Statement(SECTION, self.line, (None, ))
+        if mnemonic == 'section':
+            return Statement(SECTION, self.line, (rest.split()[0], ))
+        if mnemonic == 'align':
+            return Statement(ALIGN, self.line, (self.expression(rest, scope), ))
+        if mnemonic == 'times':
+            count, inner = self.split_times(rest)
+            return Statement(TIMES, self.line, (self.expression(count, scope), self.statement(inner, scope)))
+        if mnemonic in DATA:
+            values = [
+                decode_string(o) if o[0] in '\'"`' and o[-1] == o[0] and len(o) > 1 else self.expression(o, scope)
+                for o in split_operands(rest)
+            ]
+            return Statement(DATA_, self.line, (DATA[mnemonic], values))
+        operands = tuple(self.operand(o, scope) for o in split_operands(rest))
+        return Statement(INSTRUCTION, self.line, (mnemonic, operands))
+
+    def split_times(self, text: str) -> tuple[str, str]:
+        """Splits `times <count> <statement>` at the mnemonic following the count."""
+        for match in re.finditer(r'\b([A-Za-z]\w*)\b', text):
+            word = match.group(1).lower()
+            if word in DATA or word in NO_OPERANDS:
+                return text[:match.start()], text[match.start():]
+        self.error(f"Expected an instruction or data after 'times {text}'")
+
+    def expression(self, text: str, scope: str) -> tuple:
+        try:
+            tokens = tokenize(text)
+        except ValueError as e:
+            self.error(str(e))
+        # Local labels belong to the label before them.
+        tokens = tuple((kind, scope + value if kind == 'name' and value.startswith('.') else value) for kind, value in tokens)
+        if tokens and X86_64_Encoder.is_constant(tokens):
+            # Folded once here, instead of in every pass.
+            return (('value', self.evaluate(tokens)), )
+        return tokens
+
+    def operand(self, text: str, scope: str):
+        size = None
+        word, _, rest = text.partition(' ')
+        if word.lower() in SIZES and rest:
+            size = SIZES[word.lower()]
+            text = rest.strip()
+        if text.startswith('[') and text.endswith(']'):
+            return self.memory(text[1:-1].strip(), size, scope)
+        if text.lower() in REGISTERS:
+            return Register(*REGISTERS[text.lower()])
+        return Immediate(self.expression(text, scope))
+
+    def memory(self, text: str, size: Optional[int], scope: str) -> Memory:
+        rel = False
+        if text.lower().startswith('rel '):
+            rel, text = True, text[4:].strip()
+        base = index = None
+        scale = 1
+        displacement = []
+        for sign, term in re.findall(r'([+-]?)\s*([^+-]+)', text):
+            term = term.strip()
+            register, _, factor = term.partition('*')
+            register = register.strip().lower()
+            if register in REGISTERS:
+                number, width = REGISTERS[register]
+                if width != 8 or sign == '-':
+                    self.error(f"Invalid address '[{text}]'")
+                if factor or base is not None:
+                    if index is not None:
+                        self.error(f"Invalid address '[{text}]'")
+                    index, scale = number, int(factor or 1)
+                else:
+                    base = number
+            else:
+                displacement.append(f'{sign}{term}')
+        if scale not in (1, 2, 4, 8):
+            self.error(f"Invalid scale in '[{text}]'")
+        if index == 4:
+            if scale != 1 or base == 4:
+                self.error(f"'rsp' can't be an index in '[{text}]'")
+            base, index = index, base
+        expression = self.expression(' '.join(displacement), scope) if displacement else None
+        return Memory(base, index, scale, expression, rel, size)
+
+    # ---- Expressions ----
+
+    def evaluate(self, tokens: tuple) -> int:
+        if len(tokens) == 1 and tokens[0][0] == 'value':
+            return tokens[0][1]
+        value, position = self.evaluate_binary(tokens, 0, 0)
+        if position != len(tokens):
+            self.error(f"Unexpected '{tokens[position][1]}' in expression")
+        return value
+
+    PRECEDENCE = [('|', ), ('^', ), ('&', ), ('<<', '>>'), ('+', '-'), ('*', '/', '//', '%')]
+
+    def evaluate_binary(self, tokens, position, level):
+        if level == len(X86_64_Encoder.PRECEDENCE):
+            return self.evaluate_unary(tokens, position)
+        left, position = self.evaluate_binary(tokens, position, level + 1)
+        operators = X86_64_Encoder.PRECEDENCE[level]
+        while position < len(tokens) and tokens[position][0] == 'operator' and tokens[position][1] in operators:
+            operator = tokens[position][1]
+            right, position = self.evaluate_binary(tokens, position + 1, level + 1)
+            if   operator == '|':  left |= right
+            elif operator == '^':  left ^= right
+            elif operator == '&':  left &= right
+            elif operator == '<<': left <<= right
+            elif operator == '>>': left >>= right
+            elif operator == '+':  left += right
+            elif operator == '-':  left -= right
+            elif operator == '*':  left *= right
+            elif operator in ('/', '//'): left //= right
+            elif operator == '%':  left %= right
+        return left, position
+
+    def evaluate_unary(self, tokens, position):
+        if position >= len(tokens):
+            self.error('Incomplete expression')
+        kind, value = tokens[position]
+        if kind == 'operator' and value in '-+~':
+            operand, position = self.evaluate_unary(tokens, position + 1)
+            return -operand if value == '-' else ~operand if value == '~' else operand, position
+        if kind == 'operator' and value == '(':
+            result, position = self.evaluate_binary(tokens, position + 1, 0)
+            if position >= len(tokens) or tokens[position] != ('operator', ')'):
+                self.error("Expected ')'")
+            return result, position + 1
+        if kind == 'number':
+            text = value.replace('_', '').lower()
+            if text.startswith('0x'):   return int(text, 16), position + 1
+            if text.startswith('0b'):   return int(text, 2), position + 1
+            if text.endswith('h'):      return int(text[:-1], 16), position + 1
+            return int(text), position + 1
+        if kind == 'value':
+            return value, position + 1
+        if kind == 'here':
+            return self.address if value == '$' else self.origin, position + 1
+        if kind == 'char':
+            return int.from_bytes(decode_string(value), 'little'), position + 1
+        if kind == 'name':
+            return self.lookup(value), position + 1
+        self.error(f"Unexpected '{value}' in expression")
+
+    def lookup(self, name: str) -> int:
+        if name in self.symbols:
+            return self.symbols[name]
+        if name in self.previous:
+            return self.previous[name]
+        if name in self.externals:
+            return self.externals[name]
+        if self.relocatable and name not in self.defined:
+            # Filled in by the linker, which adds the address to what's encoded here.
+            self.referenced.append(name)
+            return 0
+        # Not defined yet. Assume it's close by until the next pass knows better.
+        self.missing.add(name)
+        return self.address
+
+    @staticmethod
+    def is_constant(tokens: Optional[tuple]) -> bool:
+        """Whether the value can't change between passes, so the smallest encoding can be chosen."""
+        return tokens is None or all(kind != 'name' and kind != 'here' for kind, _ in tokens)
+
+    # ---- Layout ----
+
+    def layout(self) -> bytearray:
+        for _ in range(MAX_PASSES):
+            self.symbols, self.missing, self.sections, self.relocations = {}, set(), {}, []
+            near = len(self.near)
+            code = self.emit()
+            if len(self.near) == near and self.symbols == self.previous:
+                if self.missing:
+                    raise RuntimeError(f'[Encoder] Undefined symbols: {", ".join(sorted(self.missing))}')
+                return code
+            self.previous = self.symbols
+        raise RuntimeError(f'[Encoder] Labels did not settle after {MAX_PASSES} passes')
+
+    def emit(self) -> bytearray:
+        code = bytearray()
+        section = '.text'
+        for i, statement in enumerate(self.statements):
+            self.address = self.origin + len(code)
+            self.line = statement.line
+            kind, arguments = statement.kind, statement.arguments
+            self.referenced, self.field = [], None
+            if section not in self.sections and kind not in (SECTION, ALIGN):
+                self.sections[section] = self.address
+            if kind == LABEL:
+                name = arguments[0]
+                if name in self.symbols:
+                    self.error(f"Label '{name}' is already defined")
+                self.symbols[name] = self.address
+            elif kind == SECTION:
+                section = arguments[0] or section
+            elif kind == ALIGN:
+                alignment = self.evaluate(arguments[0])
+                self.alignment = max(self.alignment, alignment)
+                padding = -self.address % alignment
+                code += (b'\x90' if section == '.text' else b'\x00') * padding
+            elif kind == TIMES:
+                count = self.evaluate(arguments[0])
+                if count < 0:
+                    self.error(f'Negative repeat count {count}')
+                inner = arguments[1]
+                if inner.kind == DATA_ and all(isinstance(v, bytes) or X86_64_Encoder.is_constant(v) for v in inner.arguments[1]):
+                    code += self.encode_statement(i, inner) * count
+                    continue
+                for _ in range(count):
+                    self.address = self.origin + len(code)
+                    code += self.encode_statement(i, arguments[1])
+            else:
+                code += self.encode_statement(i, statement)
+            if self.referenced:
+                self.relocate(kind)
+        return code
+
+    def relocate(self, kind: int):
+        """Records where the statement refers to a symbol from another object."""
+        name = self.referenced[0]
+        if kind != INSTRUCTION or self.field is None or len(self.referenced) > 1:
+            self.error(f"'{name}' isn't defined, so it can only be called or used as a 'rel' address")
+        self.relocations.append((self.address - self.origin + self.field, name))
+
+    def encode_statement(self, index: int, statement: Statement) -> bytes:
+        if statement.kind == DATA_:
+            width, values = statement.arguments
+            result = bytearray()
+            for value in values:
+                if isinstance(value, bytes):
+                    result += value + b'\x00' * (-len(value) % width)
+                else:
+                    result += self.immediate(self.evaluate(value), width)
+            return bytes(result)
+        if statement.kind == INSTRUCTION:
+            mnemonic, operands = statement.arguments
+            return self.encode(index, mnemonic, operands)
+        self.error('Expected an instruction or data')
+
+    # ---- Encoding ----
+
+    def immediate(self, value: int, size: int) -> bytes:
+        if not -(1 << (8 * size - 1)) <= value < (1 << (8 * size)):
+            self.error(f'Value {value} does not fit in {size} bytes')
+        return (value & ((1 << (8 * size)) - 1)).to_bytes(size, 'little')
+
+    def size_of(self, *operands) -> int:
+        sizes = {o.size for o in operands if isinstance(o, (Register, Memory)) and o.size is not None}
+        if len(sizes) > 1:
+            self.error('Mismatch in operand sizes')
+        if not sizes:
+            self.error('Operation size not specified')
+        return sizes.pop()
+
+    def modrm(self, reg: int, rm) -> tuple[int, bytes, Optional[int]]:
+        """The REX bits, ModRM, SIB and displacement bytes, and the target of a RIP-relative address."""
+        rex = (reg >> 3) << 2
+        reg = (reg & 7) << 3
+        if isinstance(rm, Register):
+            return rex | rm.number >> 3, bytes([0xC0 | reg | rm.number & 7]), None
+
+        constant = X86_64_Encoder.is_constant(rm.displacement)
+        displacement = self.evaluate(rm.displacement) if rm.displacement else 0
+        if rm.rel:
+            return rex, bytes([reg | 0b101]) + b'\x00' * 4, displacement
+
+        base, index = rm.base, rm.index
+        if base is None and index is None:
+            return rex, bytes([reg | 0b100, 0x25]) + self.immediate(displacement, 4), None
+
+        if index is not None:
+            rex |= (index >> 3) << 1
+        if base is not None:
+            rex |= base >> 3
+        if index is None and base & 7 != 0b100:
+            rm_bits, sib = base & 7, b''
+        else:
+            scale = {1: 0, 2: 1, 4: 2, 8: 3}[rm.scale]
+            sib = bytes([scale << 6 | (index & 7 if index is not None else 0b100) << 3 | (base & 7 if base is not None else 0b101)])
+            rm_bits = 0b100
+
+        if base is None:
+            return rex, bytes([reg | rm_bits]) + sib + self.immediate(displacement, 4), None
+        if displacement == 0 and constant and base & 7 != 0b101:
+            return rex, bytes([reg | rm_bits]) + sib, None
+        if fits(displacement, 8) and constant:
+            return rex, bytes([0x40 | reg | rm_bits]) + sib + self.immediate(displacement, 1), None
+        if not fits(displacement, 32):
+            self.error(f'Displacement {displacement} does not fit in 32 bits')
+        return rex, bytes([0x80 | reg | rm_bits]) + sib + self.immediate(displacement, 4), None
+
+    def instruction(self, opcode: bytes, reg: int, rm, size: int, immediate: bytes = b'', registers=()) -> bytes:
+        """An instruction with a ModRM operand, with the operand size and REX prefixes it needs."""
+        rex, body, target = self.modrm(reg, rm)
+        byte_register = any(isinstance(r, Register) and r.size == 1 and 4 <= r.number < 8 for r in registers)
+        prefix = X86_64_Encoder.prefix(size, rex, byte_register)
+        result = prefix + opcode + body + immediate
+        if target is not None:
+            offset = len(prefix) + len(opcode) + 1
+            self.field = offset
+            result = result[:offset] + self.immediate(target - (self.address + len(result)), 4) + result[offset + 4:]
+        return result
+
+    @staticmethod
+    def prefix(size: int, rex: int = 0, byte_register: bool = False) -> bytes:
+        """The operand size and REX prefixes, where 'spl', 'bpl', 'sil' and 'dil' need an empty REX."""
+        prefix = b'\x66' if size == 2 else b''
+        if size == 8:
+            rex |= 0b1000
+        if rex or byte_register:
+            prefix += bytes([0x40 | rex])
+        return prefix
+
+    def register(self, opcode: int, register: Register) -> bytes:
+        """An instruction with the register in the low bits of the opcode."""
+        prefix = X86_64_Encoder.prefix(register.size, register.number >> 3, register.size == 1 and 4 <= register.number < 8)
+        return prefix + bytes([opcode | register.number & 7])
+
+    def encode(self, index: int, mnemonic: str, operands: tuple) -> bytes:
+        count = len(operands)
+        kinds = tuple(type(o) for o in operands)
+
+        if mnemonic in NO_OPERANDS and count == 0:
+            return NO_OPERANDS[mnemonic]
+
+        if mnemonic == 'mov' and count == 2:
+            return self.encode_mov(*operands)
+
+        if mnemonic in ARITHMETIC and count == 2:
+            return self.encode_arithmetic(ARITHMETIC[mnemonic], *operands)
+
+        if mnemonic == 'test' and count == 2:
+            a, b = operands
+            if isinstance(a, Register) and isinstance(b, Memory):
+                a, b = b, a
+            size = self.size_of(a, b)
+            if isinstance(b, Immediate):
+                value = self.immediate(self.evaluate(b.expression), min(size, 4))
+                if isinstance(a, Register) and a.number == 0:
+                    return self.prefix(size) + bytes([0xA8 if size == 1 else 0xA9]) + value
+                return self.instruction(b'\xF6' if size == 1 else b'\xF7', 0, a, size, value, operands)
+            if isinstance(b, Register):
+                return self.instruction(b'\x84' if size == 1 else b'\x85', b.number, a, size, registers=operands)
+
+        if mnemonic == 'lea' and kinds == (Register, Memory):
+            return self.instruction(b'\x8D', operands[0].number, operands[1], operands[0].size)
+
+        if mnemonic in ('push', 'pop') and count == 1:
+            operand = operands[0]
+            if isinstance(operand, Register) and operand.size == 8:
+                return self.register(0x50 if mnemonic == 'push' else 0x58, Register(operand.number, 4))
+            if isinstance(operand, Memory):
+                return self.instruction(b'\xFF' if mnemonic == 'push' else b'\x8F', 6 if mnemonic == 'push' else 0, operand, 4)
+            if isinstance(operand, Immediate) and mnemonic == 'push':
+                value = self.evaluate(operand.expression)
+                if fits(value, 8) and X86_64_Encoder.is_constant(operand.expression):
+                    return b'\x6A' + self.immediate(value, 1)
+                return b'\x68' + self.immediate(value, 4)
+
+        if mnemonic == 'imul' and count in (2, 3) and kinds[0] == Register:
+            destination, source = operands[0], operands[1]
+            if count == 2 and isinstance(source, Immediate):
+                source, immediate = destination, source
+            elif count == 3 and isinstance(operands[2], Immediate):
+                immediate = operands[2]
+            else:
+                immediate = None
+            if immediate is None:
+                return self.instruction(b'\x0F\xAF', destination.number, source, self.size_of(destination, source))
+            size = self.size_of(destination, source)
+            value = self.evaluate(immediate.expression)
+            if fits(value, 8) and X86_64_Encoder.is_constant(immediate.expression):
+                return self.instruction(b'\x6B', destination.number, source, size, self.immediate(value, 1))
+            return self.instruction(b'\x69', destination.number, source, size, self.immediate(value, min(size, 4)))
+
+        if mnemonic in UNARY and count == 1 and kinds[0] != Immediate:
+            size = self.size_of(*operands)
+            return self.instruction(b'\xF6' if size == 1 else b'\xF7', UNARY[mnemonic], operands[0], size, registers=operands)
+
+        if mnemonic in ('inc', 'dec') and count == 1 and kinds[0] != Immediate:
+            size = self.size_of(*operands)
+            return self.instruction(b'\xFE' if size == 1 else b'\xFF', 0 if mnemonic == 'inc' else 1, operands[0], size, registers=operands)
+
+        if mnemonic in SHIFTS and count == 2 and kinds[0] != Immediate:
+            target, amount = operands
+            size = self.size_of(target)
+            byte = size == 1
+            if isinstance(amount, Register) and amount == Register(1, 1):
+                return self.instruction(b'\xD2' if byte else b'\xD3', SHIFTS[mnemonic], target, size, registers=operands)
+            if isinstance(amount, Immediate):
+                value = self.evaluate(amount.expression)
+                if value == 1:
+                    return self.instruction(b'\xD0' if byte else b'\xD1', SHIFTS[mnemonic], target, size, registers=operands)
+                return self.instruction(b'\xC0' if byte else b'\xC1', SHIFTS[mnemonic], target, size, self.immediate(value, 1), operands)
+
+        if mnemonic in ('movzx', 'movsx') and kinds[0] == Register and count == 2 and kinds[1] != Immediate:
+            destination, source = operands
+            if source.size not in (1, 2):
+                self.error(f"Invalid source size for '{mnemonic}'")
+            opcode = (0xB6 if mnemonic == 'movzx' else 0xBE) + (source.size == 2)
+            return self.instruction(bytes([0x0F, opcode]), destination.number, source, destination.size, registers=operands)
+
+        if mnemonic == 'movsxd' and kinds[0] == Register and count == 2 and kinds[1] != Immediate:
+            return self.instruction(b'\x63', operands[0].number, operands[1], 8)
+
+        if mnemonic.startswith('cmov') and mnemonic[4:] in CONDITIONS and kinds[0] == Register and count == 2 and kinds[1] != Immediate:
+            size = self.size_of(*operands)
+            return self.instruction(bytes([0x0F, 0x40 | CONDITIONS[mnemonic[4:]]]), operands[0].number, operands[1], size)
+
+        if mnemonic.startswith('set') and mnemonic[3:] in CONDITIONS and count == 1 and kinds[0] != Immediate:
+            return self.instruction(bytes([0x0F, 0x90 | CONDITIONS[mnemonic[3:]]]), 0, operands[0], 1, registers=operands)
+
+        if mnemonic in ('jmp', 'call') and count == 1 and kinds[0] != Immediate:
+            return self.instruction(b'\xFF', 4 if mnemonic == 'jmp' else 2, operands[0], 4)
+
+        if mnemonic == 'call' and kinds == (Immediate, ):
+            target = self.evaluate(operands[0].expression)
+            self.field = 1
+            return b'\xE8' + self.immediate(target - (self.address + 5), 4)
+
+        if (mnemonic == 'jmp' or mnemonic[0] == 'j' and mnemonic[1:] in CONDITIONS) and kinds == (Immediate, ):
+            target = self.evaluate(operands[0].expression)
+            short = b'\xEB' if mnemonic == 'jmp' else bytes([0x70 | CONDITIONS[mnemonic[1:]]])
+            if index not in self.near:
+                if fits(target - (self.address + 2), 8):
+                    return short + self.immediate(target - (self.address + 2), 1)
+                self.near.add(index)
+            near = b'\xE9' if mnemonic == 'jmp' else bytes([0x0F, 0x80 | CONDITIONS[mnemonic[1:]]])
+            return near + self.immediate(target - (self.address + len(near) + 4), 4)
+
+        self.error(f"Unsupported instruction '{mnemonic}' with {count} operand(s)")
+
+    def encode_mov(self, destination, source) -> bytes:
+        if isinstance(destination, Register) and isinstance(source, Immediate):
+            value = self.evaluate(source.expression)
+            size = destination.size
+            if size == 8:
+                if not X86_64_Encoder.is_constant(source.expression) or not (fits(value, 32) or 0 <= value < 1 << 32):
+                    return self.register(0xB8, destination) + self.immediate(value, 8)
+                if value >= 0:
+                    # Writing the 32-bit register clears the upper half, like nasm does it.
+                    return self.register(0xB8, Register(destination.number, 4)) + self.immediate(value, 4)
+                return self.instruction(b'\xC7', 0, destination, 8, self.immediate(value, 4))
+            return self.register(0xB0 if size == 1 else 0xB8, destination) + self.immediate(value, size)
+
+        if isinstance(destination, Memory) and isinstance(source, Immediate):
+            size = self.size_of(destination)
+            value = self.immediate(self.evaluate(source.expression), min(size, 4))
+            return self.instruction(b'\xC6' if size == 1 else b'\xC7', 0, destination, size, value)
+
+        if isinstance(source, Register) and not isinstance(destination, Immediate):
+            size = self.size_of(destination, source)
+            return self.instruction(b'\x88' if size == 1 else b'\x89', source.number, destination, size, registers=(destination, source))
+
+        if isinstance(destination, Register) and isinstance(source, Memory):
+            size = self.size_of(destination, source)
+            return self.instruction(b'\x8A' if size == 1 else b'\x8B', destination.number, source, size, registers=(destination, ))
+
+        self.error("Invalid operands for 'mov'")
+
+    def encode_arithmetic(self, operation: int, destination, source) -> bytes:
+        if isinstance(destination, Immediate):
+            self.error('Invalid destination')
+        if isinstance(source, Immediate):
+            size = self.size_of(destination)
+            value = self.evaluate(source.expression)
+            constant = X86_64_Encoder.is_constant(source.expression)
+            accumulator = isinstance(destination, Register) and destination.number == 0
+            if size == 1:
+                if accumulator:
+                    return bytes([operation << 3 | 0x04]) + self.immediate(value, 1)
+                return self.instruction(b'\x80', operation, destination, 1, self.immediate(value, 1), (destination, ))
+            if fits(value, 8) and constant:
+                return self.instruction(b'\x83', operation, destination, size, self.immediate(value, 1))
+            if size == 8 and not fits(value, 32):
+                self.error(f'Value {value} does not fit in a sign-extended dword')
+            immediate = self.immediate(value, min(size, 4))
+            if accumulator:
+                return self.prefix(size) + bytes([operation << 3 | 0x05]) + immediate
+            return self.instruction(b'\x81', operation, destination, size, immediate)
+
+        size = self.size_of(destination, source)
+        byte = size == 1
+        if isinstance(source, Register):
+            return self.instruction(bytes([operation << 3 | (0 if byte else 1)]), source.number, destination, size, registers=(destination, source))
+        if isinstance(destination, Register):
+            return self.instruction(bytes([operation << 3 | (2 if byte else 3)]), destination.number, source, size, registers=(destination, ))
+        self.error('Invalid combination of operands')
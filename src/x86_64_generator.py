@@ -1,4 +1,10 @@
+import copy
+from typing import Callable
+
+from emitter import Emitter
 from ir import Op
+from register_allocator import LinearScan
+from target import DEFAULT_TARGET
 from type import LiteralType, Type, StructType
 
 
@@ -17,142 +23,177 @@ def register_to_size(src, size):
 
 
 class X86_64_Generator:
-    def __init__(self, functions, data, constants, types):
+    SAVE    = ['rbx', 'r12', 'r13', 'r14', 'r15']
+    SCRATCH = ['rax', 'rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9', 'r10', 'r11']
+    # Arguments and return values are passed in these, in order.
+    REGISTERS = SCRATCH + SAVE
+    # Op -> handler(generator, function, block, code), filled in below the class.
+    HANDLERS: dict[Op, Callable] = {}
+
+    def __init__(self, functions, data, constants, types, comments=True, target=DEFAULT_TARGET):
         # https://devblogs.microsoft.com/oldnewthing/20231204-00/?p=109095
         # Nested function - Static chain pointer
 
         # https://uops.info/
         self.functions = functions
-        self.mapping = {}
-        self.vars = {}
         self.data = data
         self.types = types
         self.constants = constants
-        self.save = ['rbx', 'r12', 'r13', 'r14', 'r15']
-        self.scratch = ['rax', 'rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9', 'r10', 'r11']
+        self.target = target
+        self.save = list(X86_64_Generator.SAVE)
+        self.scratch = list(X86_64_Generator.SCRATCH)
         self.regs = self.scratch + self.save
 
-        self.code = ''
+        # Spilled values are loaded into 'r10' and 'r11' for the instruction using them,
+        # so those two are never handed out by the register allocator.
+        self.spill = ['r10', 'r11']
+        self.allocator = LinearScan([r for r in self.regs if r not in self.spill], self.regs, tuple(self.save))
+        self.allocation = None
+        self.saved = []
+        self.frame = False
+        self.reloaded = {}
+        self.position = 0
+        self.parameters = 0
+        # The offset of the block being generated, to leave out jumps to the next one.
+        self.block_offset = 0
+
+        self.emit = Emitter(comments)
         self.stack_size = 0
 
     def type_of(self, function, code) -> Type:
         return self.types[function.name][code.dest]
 
     @staticmethod
-    def generate(module, types):
+    def generate(module, types, comments=True, target=DEFAULT_TARGET, only=None):
+        """The code and data of the module, or of the functions named in `only`."""
+        code, data = X86_64_Generator.generate_functions(module, types, comments, target, only)
+        return ''.join(code.values()), data
+
+    @staticmethod
+    def generate_functions(module, types, comments=True, target=DEFAULT_TARGET, only=None):
+        """Like `generate`, but with the code of each function on its own."""
         functions = module.functions
         data = module.data
         constants = module.constants
 
-        self = X86_64_Generator(functions, data, constants, types)
+        self = X86_64_Generator(functions, data, constants, types, comments, target)
+        handlers = self.HANDLERS
+        result = {}
         for function in self.functions.values():
-            if len(function.blocks) == 0:
+            if len(function.blocks) == 0 or (only is not None and function.name not in only):
                 continue
-            self.code += f"; -------- '{function.name}' --------\n{function.name}:\n"
-            self.mapping = { }
-            self.vars    = { }
-            for block_offset, block in enumerate(function.blocks):
-                self.mapping = self.vars.copy()
-                self.code += f'.{block.label}:\n'
+            self.emit = Emitter(comments)
+            if any(code.op == Op.PHI for _, code in function.code()):
+                # Taken out of SSA form on a copy, so the module is left as it was and can be generated again.
+                function = copy.deepcopy(function, {id(f): f for f in self.functions.values() if f is not function})
+                function.from_ssa()
+            self.allocation = self.allocator.allocate(function, self.exit_values(function))
+            self.position = 0
+            self.parameters = 0
+            if self.emit.comments:
+                self.emit.comment(f"-------- '{function.name}' --------", indent=False)
+            self.emit.label(function.name)
+            # Callee-saved registers are saved once here instead of around every call.
+            returns = not function.is_main and not function.is_module
+            self.saved = [r for r in self.save if r in self.allocation.registers()] if returns else []
+            for r in self.saved:
+                self.add_code('push', r, comment='Callee-saved')
+            # Structs are allocated on the stack, which is restored from 'rbp' on return.
+            self.frame = self.allocation.slots > 0 or (returns and any(code.op == Op.INIT for _, code in function.code()))
+            if self.frame:
+                self.add_code('push', 'rbp')
+                self.add_code('mov', 'rbp', 'rsp')
+                self.add_code('sub', 'rsp', f'{8 * self.allocation.slots + 8 * (self.allocation.slots % 2)}', comment='Spill slots')
+                self.emit.blank()
+            for self.block_offset, block in enumerate(function.blocks):
+                self.emit.label(f'.{block.label}')
                 for code in block.instructions:
-                    if code.op == Op.LIT:
-                        self.generate_lit(function, block, code)
-                    elif code.op in (Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.MOD, Op.EQ, Op.NEQ, Op.LT, Op.AND, Op.OR):
-                        self.generate_bin(function, block, code)
-                    elif code.op == Op.DECL:
-                        self.generate_decl(function, block, code)
-                    elif code.op == Op.MULTIDECL:
-                        self.generate_multidecl(function, block, code)
-                    elif code.op == Op.ASSIGN:
-                        self.generate_assign(function, block, code)
-                    elif code.op == Op.LABEL:
-                        self.code += f'.{code.args[0]}:\n'
-                    elif code.op == Op.CALL:
-                        self.generate_call(function, block, code)
-                    elif code.op == Op.PARAM:
-                        self.generate_param(code)
-                    elif code.op == Op._:
-                        # Pseudo-target
-                        pass
-                    elif code.op == Op.FIELD:
-                        self.generate_field(function, block, code)
-                    elif code.op == Op.INIT:
-                        self.generate_init(function, block, code)
-                    elif code.op == Op.SYSCALL:
-                        self.generate_syscall(function, block, code)
-                    elif code.op == Op.ASM:
-                        self.generate_asm(function, block, code)
-                    elif code.op == Op.INDEX:
-                        self.generate_index(function, block, code)
-                    elif code.op == Op.REF:
-                        self.generate_dereference(function, block, code)
-                    elif code.op == Op.AS:
-                        target = code.refs[0]
-                        src = target if isinstance(target, str) else block.instructions[target].dest
-                        self.mapping[code.dest] = self.peek_reg(src)
-                    elif code.op == Op.ACCESS:
-                        self.generate_get(function, block, code)
-                    else:
-                        assert False, f'Unknown instruction {code}'
+                    self.reload(block, code)
+                    handler = handlers.get(code.op)
+                    assert handler is not None, f'Unknown instruction {code}'
+                    handler(self, function, block, code)
+                    self.store(block, code)
 
                 code = block.terminator
-                if code.op == Op.BR:
-                    self.generate_ite(function, block, code)
-                elif code.op == Op.JMP:
-                    self.generate_jmp(function, code, block_offset)
-                elif code.op == Op.RET:
-                    self.generate_ret(function, block, code)
-                else:
-                    assert False, f"Unknown terminator {code}"
-
-        data = ""
-        for i, d in self.data.items():
-            if type(d) == str:
-                # data += f'string_{i}: db `{d}`, 0\n'
-                # data += f'data_{i}: dq {len(d)}, string_{i}\n'
-                data += f'data_{i}: db `{d}`, 0\n'
+                self.reload(block, code)
+                handler = handlers.get(code.op)
+                assert handler is not None, f"Unknown terminator {code}"
+                handler(self, function, block, code)
+                self.position += 1
+            result[function.name] = self.emit.assemble()
 
-        return self.code, data
+        return result, X86_64_Generator.generate_data(data)
+
+    @staticmethod
+    def generate_data(data) -> str:
+        result = ""
+        for i, d in data.items():
+            if type(d) == str:
+                # result += f'string_{i}: db `{d}`, 0\n'
+                # result += f'data_{i}: dq {len(d)}, string_{i}\n'
+                result += f'data_{i}: db `{d}`, 0\n'
+        return result
 
     def generate_init(self, function, block, code):
         ty = self.type_of(function, code)
         assert isinstance(ty, StructType), f'Invalid type {ty} to init'
-        self.code += f'\t; {ty.name} {ty.fields}\n'
-        self.code += f'\tsub rsp, {ty.size}\n'
+        if self.emit.comments:
+            self.emit.comment(f'{ty.name} {ty.fields}')
+        self.add_code('sub', 'rsp', f'{ty.size}')
         self.stack_size += ty.size
         names = []
         for i, ref in enumerate(code.refs, start=1):
             name = ref if type(ref) == str else block.instructions[ref].dest
             src = self.consume_reg(name)
-            self.code += f'\tmov [rsp + {ty.size - 8 * i}], {src}\t\t; .{i-1} = {name}\n'
+            if src not in self.regs:
+                self.add_code('mov', self.spill[1], src)
+                src = self.spill[1]
+            self.add_code('mov', f'[rsp + {ty.size - 8 * i}]', src, comment=f'.{i-1} = {name}' if self.emit.comments else None)
             names.append(name)
         dst = self.set_reg(code.dest)
-        self.code += f'\tmov {dst}, rsp\t\t\t; {code.dest} : {ty.name} = {{ {", ".join(n for n in names)} }}\n\n'
+        self.add_code('mov', dst, 'rsp', comment=f'{code.dest} : {ty.name} = {{ {", ".join(n for n in names)} }}' if self.emit.comments else None)
+        self.emit.blank()
+
+    def generate_label(self, function, block, code):
+        self.emit.label(f'.{code.args[0]}')
+
+    def generate_as(self, function, block, code):
+        target = code.refs[0]
+        src = target if isinstance(target, str) else block.instructions[target].dest
+        self.move(self.set_reg(code.dest), self.peek_reg(src))
+
+    def generate_nothing(self, function, block, code):
+        # Pseudo-target
+        pass
+
+    @classmethod
+    def register(cls, op: Op, handler):
+        """Makes `handler(generator, function, block, code)` generate the instructions with the op."""
+        cls.HANDLERS[op] = handler
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Registering a handler in a subclass leaves the others alone.
+        cls.HANDLERS = dict(cls.HANDLERS)
 
     def add_code(self, *args, comment=None):
-        if len(args) == 3:
-            a = args[1] + ',' if len(args[1]) == 3 else args[1] + ', '
-            self.code += f'\t{args[0]:<5} {a:<3} {args[2]:<3}'
-        elif len(args) == 2:
-            self.code += f'\t{args[0]:<5} {args[1]:<7}'
-        elif len(args) == 1:
-            self.code += f'\t{args[0]:<13}'
-        else:
-            assert False
-        if comment: self.code += f'\t\t; {comment}'
-        self.code += '\n'
+        self.emit.instruction(*args, comment=comment)
 
-    def generate_jmp(self, function, code, offset):
-        if code.args[0] != offset + 1:  # No need to jump to next block.
+    def generate_jmp(self, function, block, code):
+        if code.args[0] != self.block_offset + 1:  # No need to jump to next block.
             block = function.blocks[code.args[0]]
             self.add_code('jmp', f'.{block.label}')
-            self.code += '\n'
+            self.emit.blank()
 
-    def generate_param(self, code):
+    def generate_param(self, function, block, code):
         param = code.dest
         dst = self.set_reg(param)
-        self.code += f'\t; {dst} := {param}\n\n'
-        self.vars[code.dest] = dst
+        src = self.regs[self.parameters]
+        self.parameters += 1
+        if self.emit.comments:
+            self.emit.comment(f'{dst} := {param}')
+        self.emit.blank()
+        self.move(dst, src)
 
     def generate_call(self, function, block, code):
         func = self.functions[code.args[0]]
@@ -162,103 +203,127 @@ class X86_64_Generator:
 
     def generate_syscall(self, function, block, code):
         pushed = self.prepare_function_call(function, block, code)
-        self.add_code('syscall')
+        self.add_code(*self.target.syscall)
         self.finish_function_call(code, pushed, returns = 1)
 
     def generate_asm(self, function, block, code):
         ty, idx, val = block.instructions[code.refs[0]].args
         assert ty == 'str', f'Expected asm to be a string, got {ty}'
-        code = '\n\t; Inline asm\n\t' + '\n\t'.join(val.split('\\n'))
-        self.code += code + '\n'
+        self.emit.blank()
+        self.emit.comment('Inline asm')
+        self.emit.text('\t' + '\n\t'.join(val.split('\\n')) + '\n')
 
     def finish_function_call(self, code, pushed, returns = 0):
-        # FIXME: I need to write an actual register allocation algorithm...
-        #        This is starting to get a bit too hacky.
-        iterator = reversed(range(returns)) if self.vars else range(returns)
-        for i in iterator:
+        moves = []
+        for i in range(returns):
             dest = code.dest if returns == 1 else f'{code.dest}.{i}'
             dst = self.set_reg(dest)
             if dst != self.regs[i]:
-                self.add_code('mov', dst, self.regs[i], comment=f'ret {i} := {dest}')
+                moves.append((dst, self.regs[i]))
             else:
-                self.code += f'\t; {dst} = {dest}\n'
+                if self.emit.comments:
+                    self.emit.comment(f'{dst} = {dest}')
+        self.parallel_move(moves)
         for var, reg in reversed(pushed):
-            self.add_code('pop', reg, comment=f'Restore {var}')
-        self.code += '\n'
+            self.add_code('pop', reg, comment=f'Restore {var}' if self.emit.comments else None)
+        self.emit.blank()
 
     def prepare_function_call(self, function, block, code):
         assert code.op == Op.CALL or code.op == Op.SYSCALL
 
-        pushed = []
-        for i, r in enumerate(self.regs):
-            if pair := next(((name, reg) for name, reg in self.mapping.items() if reg == r), None):
-                self.add_code('push', r, comment=f'Save {pair[0]}')
-                pushed.append(pair)
-
-        args = [(i, self.peek_reg(arg)) for i, arg in enumerate([
-            arg if type(arg) == str else block.instructions[arg].dest
-            for arg in code.refs
-        ])]
-
-        deferred = []
-        temporaries = []
-        while True:
-            changed = False
-            while args:
-                i, src = args.pop(0)
-                dst = self.regs[i]
-                if dst in (x[1] for x in args) or dst in (x[1] for x in deferred):
-                    deferred.append((i, src))
-                    continue
-                elif src != dst:
-                    self.add_code('mov', dst, src)
-                changed = True
-            if not deferred:
-                break
-            if not changed:
-                j = len(temporaries)
-                v = self.regs[len(code.refs) + j + 1]
-                b = deferred.pop(0)
-                temporaries.append((v, b[0]))
-                self.add_code('mov', v, b[1])
-            args = deferred.copy()
-            deferred = []
-        for temp in temporaries:
-            a, b = temp
-            self.add_code('mov', self.regs[b], a)
+        # Caller-saved registers holding values that are used after the call. A syscall
+        # only clobbers the registers it returns in, 'rcx', 'r11' and the arguments.
+        if code.op == Op.SYSCALL:
+            clobbered = ['rax', 'rdx', 'rcx', 'r11', *self.regs[:len(code.refs)]]
+        else:
+            clobbered = self.scratch
+        live = dict((reg, name) for name, reg in self.allocation.live_across(self.position))
+        pushed = [(live[r], r) for r in self.regs if r in live and r in clobbered]
+        for name, reg in pushed:
+            self.add_code('push', reg, comment=f'Save {name}' if self.emit.comments else None)
+
+        self.parallel_move([
+            (self.regs[i], self.peek_reg(arg if type(arg) == str else block.instructions[arg].dest))
+            for i, arg in enumerate(code.refs)
+        ])
         return pushed
 
+    def parallel_move(self, moves):
+        """
+        Emits moves that behave as if done at the same time, i.e. no source is
+        overwritten before it has been read. Cycles are broken with 'r11'.
+        """
+        pending = [(dst, src) for dst, src in moves if dst != src]
+        while pending:
+            for i, (dst, src) in enumerate(pending):
+                if all(dst != other for _, other in pending):
+                    self.move(dst, src)
+                    pending.pop(i)
+                    break
+            else:
+                dst, src = pending[0]
+                self.add_code('mov', self.spill[1], src)
+                pending = [(d, self.spill[1] if s == src else s) for d, s in pending]
+
+    def move(self, dst, src, comment=None):
+        if dst == src:
+            return
+        if dst not in self.regs and src not in self.regs:
+            # Neither memory to memory nor an immediate of unknown size to memory is encodable.
+            self.add_code('mov', self.spill[1], src)
+            src = self.spill[1]
+        self.add_code('mov', dst, src, comment=comment)
+
     def generate_ret(self, function, block, code):
-        for i, arg in enumerate(code.refs):
-            var = arg if type(arg) == str else block.instructions[arg].dest
-            src = self.mapping[var]
-            if self.regs[i] != src:
-                self.add_code('mov', self.regs[i], src)
+        self.parallel_move([
+            (self.regs[i], self.peek_reg(arg if type(arg) == str else block.instructions[arg].dest))
+            for i, arg in enumerate(code.refs)
+        ])
 
         if function.is_main:
-            self.code += '\t; End of module (implicit exit)\n'
-            if self.mapping: self.add_code('mov', 'rdi', list(self.mapping.values())[-1])
+            self.emit.comment('End of module (implicit exit)')
+            exit_value = self.exit_values(function).get(block.label)
+            if exit_value: self.move('rdi', self.peek_reg(exit_value))
             else: self.add_code('mov', 'rdi', '0')
-            self.add_code('mov', 'rax', '0x2000000+1')
-            self.add_code('syscall')
-            self.code += '\n'
+            self.add_code('mov', 'rax', hex(self.target.exit_syscall), comment='exit')
+            self.add_code(*self.target.syscall)
+            self.emit.blank()
         elif function.is_module:
             pass
         else:
             # self.add_code('add', 'rsp', f'{self.stack_size}')
             self.stack_size = 0
+            if self.frame:
+                self.add_code('mov', 'rsp', 'rbp')
+                self.add_code('pop', 'rbp')
+            for r in reversed(self.saved):
+                self.add_code('pop', r)
             self.add_code('ret')
-            self.code += '\n'
+            self.emit.blank()
 
     def generate_ite(self, function, block, code):
-        cond = block.instructions[code.refs[0]].dest
+        cond = code.refs[0]
+        cond = cond if type(cond) == str else block.instructions[cond].dest
         left = function.blocks[code.args[0]]
         right = function.blocks[code.args[1]]
         src = self.consume_reg(cond)
-        self.code += f'\t; if {cond} goto {left.label} else {right.label}\n'
+        if self.emit.comments:
+            self.emit.comment(f'if {cond} goto {left.label} else {right.label}')
         self.add_code('test', src, src)
         self.add_code('je', f'.{right.label}')
-        self.code += '\n'
+        if code.args[0] != self.block_offset + 1:
+            self.add_code('jmp', f'.{left.label}')
+        self.emit.blank()
+
+    def generate_copy(self, function, block, code):
+        name = code.refs[0]
+        name = name if type(name) == str else block.instructions[name].dest
+        src = self.peek_reg(name)
+        dst = self.set_reg(code.dest)
+        if self.emit.comments:
+            self.emit.comment(f'{code.dest} = {name}')
+        self.emit.blank()
+        self.move(dst, src)
 
     def generate_decl(self, function, block, code):
         if self.type_of(function, code).name == 'func':
@@ -270,10 +335,10 @@ class X86_64_Generator:
         if ty.size <= 8 or True:
             src = self.consume_reg(name)
             dst = self.set_reg(code.dest)
-            self.code += f'\t; {code.dest} ({dst}) : {ty} = {name}\n\n'
-            if dst != src:
-                self.add_code('mov', dst, src)
-            self.vars[code.dest] = dst
+            if self.emit.comments:
+                self.emit.comment(f'{code.dest} ({dst}) : {ty} = {name}')
+            self.emit.blank()
+            self.move(dst, src)
         else:
             assert False
 
@@ -285,10 +350,10 @@ class X86_64_Generator:
             ty = self.types[function.name][name][i]
             src = self.consume_reg(dest)
             dst = self.set_reg(arg)
-            self.code += f'\t; {arg} ({dst}) : {ty} = {dest}\n\n'
-            if dst != src:
-                self.add_code('mov', dst, src)
-            self.vars[arg] = dst
+            if self.emit.comments:
+                self.emit.comment(f'{arg} ({dst}) : {ty} = {dest}')
+            self.emit.blank()
+            self.move(dst, src)
 
     def generate_field(self, function, block, code):
         name = code.refs[0]
@@ -296,20 +361,22 @@ class X86_64_Generator:
         ty = self.type_of(function, code)
         src = self.consume_reg(name)
         dst = self.set_reg(code.dest)
-        self.code += f'\t; {code.dest} ({dst}) : {ty} = {name}\n\n'
-        if dst != src:
-            self.add_code('mov', dst, src)
+        if self.emit.comments:
+            self.emit.comment(f'{code.dest} ({dst}) : {ty} = {name}')
+        self.emit.blank()
+        self.move(dst, src)
 
     def generate_dereference(self, function, block, code):
         object = code.refs[0]
         target = object if type(object) == str else block.instructions[object].dest
 
-        self.code += f'\t; &{target}\n'
+        if self.emit.comments:
+            self.emit.comment(f'&{target}')
         dst = self.set_reg(code.dest)
         obj = self.consume_reg(target)
         self.add_code('mov', dst, obj)
 
-        self.code += '\n'
+        self.emit.blank()
         assert False, 'This requires that we put lvalues into memory'
 
     def generate_get(self, function, block, code):
@@ -325,14 +392,15 @@ class X86_64_Generator:
 
             src = self.peek_reg(code.refs[0])
             dst = self.set_reg(code.dest)
-            self.code += f'\tmov {dst}, [{src} + {thing_ty.size - offset}]\t; {code.dest}: {ty} = {code.refs[0]}.{code.refs[1]}  ({code.refs[0]}: {thing_ty.name})\n'
-            self.code += '\n'
+            comment = f'{code.dest}: {ty} = {code.refs[0]}.{code.refs[1]}  ({code.refs[0]}: {thing_ty.name})' if self.emit.comments else None
+            self.add_code('mov', dst, f'[{src} + {thing_ty.size - offset}]', comment=comment)
+            self.emit.blank()
         else:
             assert isinstance(ty, LiteralType), "Other's not implemented"
 
             dst = self.set_reg(code.dest)
             self.add_code('mov', dst, ty.value())
-            self.code += '\n'
+            self.emit.blank()
             # assert False, 'This requires that we put lvalues into memory'
 
     def generate_assign(self, function, block, code):
@@ -342,12 +410,14 @@ class X86_64_Generator:
         expr   = name_b if type(name_b) == str else block.instructions[name_b].dest
         dst  = self.consume_reg(target)
         src  = self.consume_reg(expr)
-        self.code += f'\t; {target} = {expr}\n\n'
+        if self.emit.comments:
+            self.emit.comment(f'{target} = {expr}')
+        self.emit.blank()
         if type(name_a) != str and block.instructions[name_a].op == Op.INDEX:
             size = self.types[function.name][target].size
             self.add_code('mov', f'[{dst}]', register_to_size(src, size))
-        elif dst != src:
-            self.add_code('mov', dst, src)
+        else:
+            self.move(dst, src)
 
     def generate_index(self, function, block, code):
         object = code.refs[0]
@@ -356,10 +426,12 @@ class X86_64_Generator:
         target = object if type(object) == str else block.instructions[object].dest
         expr   = offset if type(offset) == str else block.instructions[offset].dest
 
-        self.code += f'\t; {target}[{expr}]\n'
+        if self.emit.comments:
+            self.emit.comment(f'{target}[{expr}]')
         dst = self.set_reg(code.dest)
         obj = self.consume_reg(target)
-        self.add_code('mov', dst, obj)
+        if dst != obj:
+            self.add_code('mov', dst, obj)
 
         src = self.consume_reg(expr)
         self.add_code('add', dst, src)
@@ -368,7 +440,7 @@ class X86_64_Generator:
         if not code.args[0]:
             self.add_code('mov', dst, f'[{dst}]')
 
-        self.code += '\n'
+        self.emit.blank()
 
     def generate_bin(self, function, block, code):
         name_a = code.refs[0]
@@ -379,41 +451,42 @@ class X86_64_Generator:
         a = self.consume_reg(name_a)
         reg = self.set_reg(code.dest)
         b = self.consume_reg(name_b)
+        comment = f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}' if self.emit.comments else None
 
         if code.op == Op.ADD:
-            if reg != a: self.add_code('mov', reg, a, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
-            self.add_code('add',  reg, b, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
+            if reg != a: self.add_code('mov', reg, a, comment=comment)
+            self.add_code('add',  reg, b, comment=comment)
         elif code.op == Op.SUB:
-            if reg != a: self.add_code('mov', reg, a, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
-            self.add_code('sub', reg, b, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
+            if reg != a: self.add_code('mov', reg, a, comment=comment)
+            self.add_code('sub', reg, b, comment=comment)
         elif code.op == Op.MUL:
-            if reg != a: self.add_code('mov', reg, a, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
-            self.add_code('imul', reg, b, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
-        elif code.op == Op.DIV:
-            self.add_code('push', 'rax')
-            self.add_code('push', 'rdx')
-            self.add_code('cqo')
-            self.add_code('mov', 'rax', a)
-            self.add_code('idiv', b, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
-            self.add_code('mov', reg, 'rax')
-            self.add_code('pop', 'rdx')
-            self.add_code('pop', 'rax')
-        elif code.op == Op.MOD:
-            self.add_code('push', 'rax')
-            self.add_code('push', 'rdx')
+            if reg != a: self.add_code('mov', reg, a, comment=comment)
+            self.add_code('imul', reg, b, comment=comment)
+        elif code.op in (Op.DIV, Op.MOD):
+            # idiv works on rdx:rax, so they are saved if they hold a value used afterwards.
+            live = set(r for _, r in self.allocation.live_across(self.position))
+            saved = [r for r in ('rax', 'rdx') if r != reg and r in live]
+            if b in ('rax', 'rdx') or b not in self.regs:
+                self.add_code('mov', self.spill[1], b)
+                b = self.spill[1]
+            for r in saved:
+                self.add_code('push', r)
+            if a != 'rax':
+                self.add_code('mov', 'rax', a)
             self.add_code('cqo')
-            self.add_code('mov', 'rax', a)
-            self.add_code('idiv', b, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
-            self.add_code('mov', reg, 'rdx')
-            self.add_code('pop', 'rdx')
-            self.add_code('pop', 'rax')
+            self.add_code('idiv', b, comment=comment)
+            result = 'rax' if code.op == Op.DIV else 'rdx'
+            if reg != result:
+                self.add_code('mov', reg, result)
+            for r in reversed(saved):
+                self.add_code('pop', r)
         elif code.op in (Op.EQ, Op.NEQ, Op.LT):
-            t = self.set_reg('__temp__')
-            self.code += f'\t; {code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}\n'
+            # The second operand has been read by 'cmp', so its spill register is free.
+            t = self.spill[1]
+            self.emit.comment(comment)
             self.add_code('cmp',  f'{a}', f'{b}')
             self.add_code('mov',  f'{reg}', '0')
             self.add_code('mov',  f'{t}',   '1')
-            self.consume_reg('__temp__')
             # https://www.felixcloutier.com/x86/cmovcc
             if   code.op == Op.EQ:  self.add_code('cmove',  f'{reg}', f'{t}')
             elif code.op == Op.NEQ:  self.add_code('cmovnz', f'{reg}', f'{t}')
@@ -421,52 +494,123 @@ class X86_64_Generator:
             else:
                 assert False
         elif code.op in (Op.AND, Op.OR):
-            if reg != a: self.add_code('mov', reg, a, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
-            if   code.op == Op.OR:  self.add_code('or',   reg, b, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
-            elif code.op == Op.AND: self.add_code('and',  reg, b, comment=f'{code.dest} : {self.type_of(function, code)} = {name_a} {code.op} {name_b}')
+            if reg != a: self.add_code('mov', reg, a, comment=comment)
+            if   code.op == Op.OR:  self.add_code('or',   reg, b, comment=comment)
+            elif code.op == Op.AND: self.add_code('and',  reg, b, comment=comment)
             else: assert False
         else:
             assert False, f'Not implemented {code}'
-        self.code += '\n'
+        self.emit.blank()
 
     def generate_lit(self, function, block, code):
         reg = self.set_reg(code.dest)
         t, index, data = code.args
         t = self.type_of(function, code)
+        comments = self.emit.comments
         if t.name == 'str' or t.name == 'char*' or t.name.startswith('char['):
-            self.add_code('lea', reg, f'[rel data_{index}]', comment=f'{code.dest} : {t} = data_{index} ("{data}")')
+            self.add_code('lea', reg, f'[rel data_{index}]', comment=f'{code.dest} : {t} = data_{index} ("{data}")' if comments else None)
         elif t.name == 'real':
-            self.add_code('mov', reg, int(data), comment=f'{code.dest} : {t} = {data}')
+            self.add_code('mov', reg, int(data), comment=f'{code.dest} : {t} = {data}' if comments else None)
         # elif type(t) == StructType and t.name == 'struct string':
         #     self.add_code('lea', reg, f'[rel data_{index}]', comment=f'{code.dest} : {t} = data_{index} ("{data}")')
         else:
             # assert t.name != 'inferred'
-            self.add_code('mov', reg, data, comment=f'{code.dest} : {t} = {data}')
-        self.code += '\n'
+            self.add_code('mov', reg, data, comment=f'{code.dest} : {t} = {data}' if comments else None)
+        self.emit.blank()
+
+    def exit_values(self, function):
+        """
+        The value a module exits with at each implicit return, which is the last result
+        in the block that isn't used, or otherwise the last declared variable.
+        """
+        if not function.is_main:
+            return {}
+        declared = []
+        for block in function.blocks:
+            for code in block.instructions:
+                names = code.args if code.op == Op.MULTIDECL else (code.dest, )
+                if code.op in (Op.PARAM, Op.DECL, Op.COPY, Op.MULTIDECL):
+                    declared.extend(n for n in names if n not in declared)
+
+        exit_values = {}
+        for block in function.blocks:
+            if block.terminator.op != Op.RET or block.terminator.refs:
+                continue
+            used = set(r for code in block.instructions for r in code.refs if type(r) == int)
+            unused = [code.dest for i, code in enumerate(block.instructions) if code.dest is not None and i not in used]
+            if unused or declared:
+                exit_values[block.label] = unused[-1] if unused else declared[-1]
+        return exit_values
+
+    def reload(self, block, code):
+        """
+        Loads spilled operands into the spill registers for instructions that can't
+        read them from memory, and gives a spilled result a register until it's stored.
+        """
+        self.reloaded = {}
+        if code.op in (Op.CALL, Op.SYSCALL, Op.PARAM, Op.DECL, Op.COPY, Op.AS, Op.FIELD, Op.MULTIDECL, Op.RET, Op.JMP):
+            return
+
+        refs = code.refs[:1] if code.op == Op.ACCESS else () if code.op == Op.INIT else code.refs
+        for ref, register in zip(refs, self.spill):
+            name = ref if type(ref) == str else block.instructions[ref].dest
+            if self.allocation.is_spilled(name) and name not in self.reloaded:
+                self.add_code('mov', register, self.allocation.location(name), comment=f'Reload {name}' if self.emit.comments else None)
+                self.reloaded[name] = register
+        if code.dest is not None and self.allocation.is_spilled(code.dest):
+            self.reloaded[code.dest] = self.spill[0]
+
+    def store(self, block, code):
+        written = [code.dest]
+        if code.op == Op.ASSIGN:
+            target = code.refs[0]
+            written.append(target if type(target) == str else block.instructions[target].dest)
+        for name in written:
+            if name in self.reloaded:
+                self.add_code('mov', self.allocation.location(name), self.reloaded[name], comment=f'Spill {name}' if self.emit.comments else None)
+        self.reloaded = {}
+        self.position += 1
 
     def set_reg(self, name):
-        if name in self.vars:
-            return self.vars[name]
-        for reg in self.regs:
-            if reg not in self.mapping.values():
-                self.mapping[name] = reg
-                return reg
-        assert False, "Used up all registers"
+        if name in self.reloaded:
+            return self.reloaded[name]
+        location = self.allocation.location(name)
+        assert location is not None, f"No location for '{name}'"
+        return location
 
     def consume_reg(self, name):
-        try:
-            if name in self.vars:
-                return self.vars[name]
-            else:
-                return self.mapping.pop(name)
-        except KeyError:
-            return f'{self.constants[name]}'
+        return self.peek_reg(name)
 
     def peek_reg(self, name):
-        try:
-            if name in self.vars:
-                return self.vars[name]
-            else:
-                return self.mapping[name]
-        except KeyError:
-            return f'{self.constants[name]}'
\ No newline at end of file
+        if name in self.reloaded:
+            return self.reloaded[name]
+        location = self.allocation.location(name)
+        if location is None:
+            return f'{self.constants[name]}'
+        return location
+
+
+# The handler of each op, looked up once per instruction instead of testing the ops one by one.
+X86_64_Generator.HANDLERS.update({
+    Op.LIT:         X86_64_Generator.generate_lit,
+    **dict.fromkeys((Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.MOD, Op.EQ, Op.NEQ, Op.LT, Op.AND, Op.OR), X86_64_Generator.generate_bin),
+    Op.DECL:        X86_64_Generator.generate_decl,
+    Op.MULTIDECL:   X86_64_Generator.generate_multidecl,
+    Op.ASSIGN:      X86_64_Generator.generate_assign,
+    Op.LABEL:       X86_64_Generator.generate_label,
+    Op.CALL:        X86_64_Generator.generate_call,
+    Op.PARAM:       X86_64_Generator.generate_param,
+    Op._:           X86_64_Generator.generate_nothing,
+    Op.FIELD:       X86_64_Generator.generate_field,
+    Op.INIT:        X86_64_Generator.generate_init,
+    Op.SYSCALL:     X86_64_Generator.generate_syscall,
+    Op.ASM:         X86_64_Generator.generate_asm,
+    Op.INDEX:       X86_64_Generator.generate_index,
+    Op.REF:         X86_64_Generator.generate_dereference,
+    Op.COPY:        X86_64_Generator.generate_copy,
+    Op.AS:          X86_64_Generator.generate_as,
+    Op.ACCESS:      X86_64_Generator.generate_get,
+    Op.BR:          X86_64_Generator.generate_ite,
+    Op.JMP:         X86_64_Generator.generate_jmp,
+    Op.RET:         X86_64_Generator.generate_ret,
+})
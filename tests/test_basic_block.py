@@ -1,4 +1,4 @@
-from ir.ir_code import c, Op
+from ir.ir_code import c, Op, Code
 from ir.basic_block import Block
 
 import unittest
@@ -22,6 +22,14 @@ class TestBasicBlock(unittest.TestCase):
         used = block.use()
         self.assertEqual(used, {'x', 'y', 'z'})
 
+    def test_last_uses(self):
+        instructions = [
+            c(op=Op.ADD, dest="a", refs=("x", "y")),
+            c(op=Op.ADD, dest="b", refs=("a", "x")),
+        ]
+        block = Block('test', instructions, terminator=c(op=Op.RET, refs=("b", )))
+        self.assertEqual(block.last_uses(), {'x': 1, 'y': 0, 'a': 1, 'b': 2})
+
     def test_dce_remove_dead_code(self):
         instructions = [
             c(op=Op.LIT, dest="a", args=('int', 0, 4)),
@@ -81,6 +89,22 @@ class TestBasicBlock(unittest.TestCase):
             c(op=Op.PRINT, refs=("d", )),
         ])
 
+    def test_dce_offset_refs(self):
+        instructions = [
+            c(op=Op.LIT, dest="a", args=('int', 0, 4)),
+            c(op=Op.LIT, dest="b", args=('int', 1, 2)),
+            c(op=Op.LIT, dest="c", args=('int', 2, 1)),
+            Code(Op.GT, dest="d", refs=(0, 2)),
+        ]
+        block = Block('test', instructions, terminator=Code(Op.BR, args=(0, 0), refs=(3, )))
+        self.assertEqual(block.dce(), 1)
+        self.assertEqual(block.instructions, [
+            c(op=Op.LIT, dest="a", args=('int', 0, 4)),
+            c(op=Op.LIT, dest="c", args=('int', 2, 1)),
+            Code(Op.GT, dest="d", refs=(0, 1)),
+        ])
+        self.assertEqual(block.terminator.refs, (2, ))
+
     def test_lvn_remove_duplicate_values(self):
         instructions = [
             c(op=Op.LIT, dest="a", args=('int', 0, 4)),
@@ -145,6 +169,62 @@ class TestBasicBlock(unittest.TestCase):
             c(op=Op.PRINT, refs=("a'3", )),
         ])
 
+    def test_lvn_commutative_values(self):
+        instructions = [
+            c(op=Op.ADD, dest="a", refs=("x", "y")),
+            c(op=Op.ADD, dest="b", refs=("y", "x")),
+            c(op=Op.SUB, dest="c", refs=("x", "y")),
+            c(op=Op.SUB, dest="d", refs=("y", "x")),
+            c(op=Op.MUL, dest="e", refs=("b", "d")),
+            c(op=Op.PRINT, refs=("e", "c")),
+        ]
+        block = Block('test', instructions, terminator=c(op=Op.RET))
+        block.lvn({}, {})
+        self.assertEqual(block.instructions, [
+            c(op=Op.ADD, dest="a", refs=("x", "y")),
+            c(op=Op.SUB, dest="c", refs=("x", "y")),
+            c(op=Op.SUB, dest="d", refs=("y", "x")),
+            c(op=Op.MUL, dest="e", refs=("a", "d")),
+            c(op=Op.PRINT, refs=("e", "c")),
+        ])
+
+    def test_lvn_fold_constants(self):
+        instructions = [
+            c(op=Op.LIT, dest="a", args=('int', 0, 7)),
+            c(op=Op.LIT, dest="b", args=('int', 1, -2)),
+            Code(Op.DIV, dest="c", refs=("a", "b")),      # Truncates to -3
+            Code(Op.MOD, dest="d", refs=("a", "b")),      # 1
+            c(op=Op.LIT, dest="e", args=('int', 2, -3)),  # Same as c
+            c(op=Op.ADD, dest="f", refs=("d", "x")),
+            c(op=Op.PRINT, refs=("c", "e", "f")),
+        ]
+        block = Block('test', instructions, terminator=c(op=Op.RET))
+        block.lvn({}, {}, fold_constants=True)
+        self.assertEqual(block.instructions, [
+            c(op=Op.LIT, dest="a", args=('int', 0, 7)),
+            c(op=Op.LIT, dest="b", args=('int', 1, -2)),
+            Code(Op.LIT, dest="c", args=('int', None, '-3')),
+            Code(Op.LIT, dest="d", args=('int', None, '1')),
+            c(op=Op.ADD, dest="f", refs=("d", "x")),
+            c(op=Op.PRINT, refs=("c", "c", "f")),
+        ])
+
+    def test_lvn_fold_wraps_around(self):
+        instructions = [
+            # Written as the parser writes them.
+            Code(Op.LIT, dest="a", args=('int', 0, '9223372036854775807')),
+            Code(Op.LIT, dest="b", args=('int', 1, '1')),
+            Code(Op.ADD, dest="c", refs=("a", "b")),
+            Code(Op.LIT, dest="d", args=('int', 2, '-9223372036854775808')),
+            Code(Op.LIT, dest="e", args=('int', 3, '-1')),
+            Code(Op.DIV, dest="f", refs=("d", "e")),      # Traps, so it's left alone
+            c(op=Op.PRINT, refs=("c", "f")),
+        ]
+        block = Block('test', instructions, terminator=c(op=Op.RET))
+        block.lvn({}, {}, fold_constants=True)
+        self.assertEqual(block.instructions[2], Code(Op.LIT, dest="c", args=('int', None, str(-(1 << 63)))))
+        self.assertEqual([i.op for i in block.instructions if i.dest == "f"], [Op.DIV])
+
     def test_borrowing(self):
         """
         a := malloc 22
@@ -0,0 +1,20 @@
+import struct
+
+from binary_writer import BinaryWriter
+import unittest
+
+
+class BinaryWriterTest(unittest.TestCase):
+    def test_pack_and_write(self):
+        layout = struct.Struct('<I8sQ')
+        writer = BinaryWriter(32)
+        writer.pack(layout, 0xfeedfacf, b'__TEXT', 0x100000000)
+        writer.write(b'\x90\xC3')
+
+        self.assertEqual(writer.position, layout.size + 2)
+        self.assertEqual(layout.unpack_from(writer.getvalue()), (0xfeedfacf, b'__TEXT\0\0', 0x100000000))
+        self.assertEqual(writer.getvalue()[layout.size:], b'\x90\xC3' + bytes(32 - layout.size - 2))
+
+        writer.seek(30)
+        with self.assertRaises(AssertionError):
+            writer.write(b'abc')
@@ -175,6 +175,22 @@ class BorrowCheckerTest(unittest.TestCase):
         error = BorrowChecker.check(module)
         self.assertEqual("Error in function 'test' at block 'entry': 'r2' cannot mutably borrow 'x'; 'x' already exclusively borrowed by 'r1'", error)
 
+    def test_double_mutable_borrow_across_blocks_error(self):
+        module = parse("""
+        @test()
+            $entry
+                x := 32
+                r1 := ref x
+                r2 := ref x   # r1 is used in the next block, so its loan of x still exists
+                jmp $next
+            $next
+                print r1
+                ret
+        end
+        """)
+        error = BorrowChecker.check(module)
+        self.assertEqual("Error in function 'test' at block 'entry': 'r2' cannot mutably borrow 'x'; 'x' already exclusively borrowed by 'r1'", error)
+
     def test_borrow_after_move_error(self):
         module = parse("""
         @test()
@@ -260,6 +276,138 @@ class BorrowCheckerTest(unittest.TestCase):
         error = BorrowChecker.check(module)
         self.assertEqual("Error in function 'test' at block 'end': Cannot use moved value 'x', it was moved to 'y'", error)
 
+    def test_loop_ok(self):
+        module = parse("""
+        @test(cond: bool)
+            $entry
+                x := 32
+                jmp $loop
+            $loop
+                _ := call print x
+                br cond $loop $end
+            $end
+                ret
+        end
+        """)
+        error = BorrowChecker.check(module)
+        self.assertEqual(None, error)
+
+    def test_move_in_loop_error(self):
+        module = parse("""
+        @test(cond: bool)
+            $entry
+                x := 32
+                jmp $loop
+            $loop
+                y := move x     # x is moved the first time around, so it can't be moved the second
+                br cond $loop $end
+            $end
+                ret
+        end
+        """)
+        error = BorrowChecker.check(module)
+        self.assertEqual("Error in function 'test' at block 'loop': 'y' cannot move 'x'; 'x' is already moved to 'y'", error)
+
+    def test_ref_in_loop_ok(self):
+        module = parse("""
+        @test(cond: bool)
+            $entry
+                x := 32
+                jmp $loop
+            $loop
+                r := ref x          # The loan of the previous iteration ends when 'r' is defined again
+                _ := call print r
+                br cond $loop $end
+            $end
+                ret
+        end
+        """)
+        error = BorrowChecker.check(module)
+        self.assertEqual(None, error)
+
+    def test_ref_in_loop_used_after_ok(self):
+        module = parse("""
+        @test(cond: bool)
+            $entry
+                x := 32
+                jmp $loop
+            $loop
+                r := ref x
+                br cond $loop $end
+            $end
+                _ := call print r   # 'r' is live out of the loop, but still the only loan of 'x'
+                ret
+        end
+        """)
+        error = BorrowChecker.check(module)
+        self.assertEqual(None, error)
+
+    def test_brw_in_loop_ok(self):
+        module = parse("""
+        @test(cond: bool)
+            $entry
+                x := 32
+                jmp $loop
+            $loop
+                r := brw x
+                _ := call print r
+                br cond $loop $end
+            $end
+                ret
+        end
+        """)
+        error = BorrowChecker.check(module)
+        self.assertEqual(None, error)
+
+    def test_ref_in_loop_error(self):
+        module = parse("""
+        @test(cond: bool)
+            $entry
+                x := 32
+                r := brw x
+                jmp $loop
+            $loop
+                s := ref x          # Error: 'r' still borrows 'x' and is used after the loop
+                br cond $loop $end
+            $end
+                _ := call print r
+                ret
+        end
+        """)
+        error = BorrowChecker.check(module)
+        self.assertEqual("Error in function 'test' at block 'loop': 's' cannot mutably borrow 'x'; 'x' already shared borrowed by 'r'", error)
+
+    def test_unreachable_blocks_are_not_checked(self):
+        module = parse("""
+        @test()
+            $b0
+                x0 := 32
+                jmp $b2
+            $b1
+                v1 := ref x0        # Never runs, so 'x0' is never borrowed by 'v1'
+                jmp $b2
+            $b2
+                v3 := ref x0
+                ret
+        end
+        """)
+        error = BorrowChecker.check(module)
+        self.assertEqual(None, error)
+
+    def test_diamonds_are_checked_once(self):
+        # 2^20 paths through the function, but each block is only checked once.
+        blocks = ['$entry\nx := 32\njmp $d0_head\n']
+        for i in range(20):
+            blocks.append(f'$d{i}_head\nbr cond $d{i}_left $d{i}_right\n')
+            blocks.append(f'$d{i}_left\n_ := call print x\njmp $d{i + 1}_head\n')
+            blocks.append(f'$d{i}_right\njmp $d{i + 1}_head\n')
+        blocks.append('$d20_head\ny := move x\nret\n')
+        module = parse('@test(cond: bool)\n' + ''.join(blocks) + 'end\n')
+        error = BorrowChecker.check(module)
+        self.assertEqual(None, error)
+        function = module.functions['test']
+        self.assertEqual(function.analysis_stats.transfers, len(function.blocks))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,57 @@
+import os
+import tempfile
+from functools import partial
+from pathlib import Path
+
+from build_cache import BuildCache
+from lexer import Lexer
+from main import build_functions, check_types, generate_code
+from parser import Parser
+from target import DEFAULT_TARGET
+import unittest
+
+
+class BuildCacheTest(unittest.TestCase):
+    def test_keys_cover_every_part(self):
+        key = BuildCache.key('ir', 'main.sf', 'x := 1\n', False, 'linux')
+        self.assertEqual(key, BuildCache.key('ir', 'main.sf', 'x := 1\n', False, 'linux'))
+        self.assertNotEqual(key, BuildCache.key('ir', 'main.sf', 'x := 2\n', False, 'linux'))
+        self.assertNotEqual(key, BuildCache.key('ir', 'main.sf', 'x := 1\n', False, 'macos'))
+
+    def test_invalidated_by_dependency(self):
+        with tempfile.TemporaryDirectory() as directory:
+            lib = os.path.join(directory, 'lib.sf')
+            Path(lib).write_text('y := 1\n')
+
+            cache = BuildCache(os.path.join(directory, 'cache'))
+            dependencies = BuildCache.dependencies([lib])
+            cache.store('key', ('module', 'types'), dependencies)
+            self.assertEqual(cache.load('key'), (('module', 'types'), dependencies))
+            self.assertIsNone(cache.load('other'))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            Path(lib).write_text('y := 2\n')
+            os.utime(lib, ns=(1, 1))
+            self.assertIsNone(cache.load('key'))
+
+    def test_function_keys(self):
+        def keys(source):
+            module = Parser.parse_module(source, Lexer.lex_fast('test.sf', source), 'test.sf')
+            return {name: BuildCache.function_key(module, f) for name, f in module.functions.items() if f.blocks}
+
+        source = 'a: (x: int) -> int {\n    return x + 1\n}\nb: (x: int) -> int {\n    return x * 2\n}\nexit(a(b(3)))\n'
+        before = keys(source)
+        # Moving a function doesn't change it, but changing its body does.
+        self.assertEqual(keys('\n\n' + source), before)
+        after = keys(source.replace('x * 2', 'x * 3'))
+        self.assertEqual([name for name in before if before[name] != after[name]], ['b'])
+
+    def test_parallel_build(self):
+        source = open('examples/struct.sf').read()
+        module = Parser.parse_module(source, Lexer.lex_fast('struct.sf', source), 'struct.sf')
+        keys = {name: BuildCache.function_key(module, f) for name, f in module.functions.items() if f.blocks}
+        types = dict(zip(keys, build_functions(keys, None, partial(check_types, module), 'types')))
+        code = build_functions(keys, None, partial(generate_code, module, types, True, DEFAULT_TARGET), 'asm')
+        # Each process gets its own copy of the module, so the results are the same in the same order.
+        self.assertEqual(build_functions(keys, None, partial(check_types, module), 'types', jobs=3), list(types.values()))
+        self.assertEqual(build_functions(keys, None, partial(generate_code, module, types, True, DEFAULT_TARGET), 'asm', jobs=3), code)
@@ -0,0 +1,63 @@
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+
+from import_cache import ImportCache
+from ir import validate_ir, remove_unused_functions
+from lexer import Lexer
+from parser import Parser
+from target import TARGETS
+from type_checker import TypeChecker
+from x86_64_generator import X86_64_Generator
+import unittest
+
+
+class Elf64AssemblerTest(unittest.TestCase):
+    TARGET = TARGETS['linux-x86_64']
+
+    def build(self, path):
+        # The libraries import the platform library of the target, so they are parsed again.
+        cache, library = Parser.import_cache, Parser.system_library
+        Parser.import_cache, Parser.system_library = ImportCache(), self.TARGET.library
+        try:
+            source = open(path).read()
+            module = Parser.parse_module(source, Lexer.lex_fast(path, source), os.path.basename(path))
+            validate_ir(module)
+            remove_unused_functions(module)
+            types = TypeChecker.check(module)
+        finally:
+            Parser.import_cache, Parser.system_library = cache, library
+        code, data = X86_64_Generator.generate(module, types, target=self.TARGET)
+        executable, _ = self.TARGET.make_executable('test', code, data)
+        return executable
+
+    def test_segments(self):
+        executable = self.build('examples/main.sf')
+        self.assertEqual(executable[:4], b'\x7FELF')
+        entry, program_headers = struct.unpack_from('<QQ', executable, 24)
+        count, = struct.unpack_from('<H', executable, 56)
+        self.assertEqual(count, 2)
+
+        segments = [struct.unpack_from('<IIQQQQQQ', executable, program_headers + 56 * i) for i in range(count)]
+        (_, text_flags, text_offset, text_address, _, text_size, _, _), (_, data_flags, data_offset, data_address, _, data_size, _, _) = segments
+        self.assertEqual(text_flags, 0x5)
+        self.assertEqual(data_flags, 0x6)
+        self.assertTrue(text_address <= entry < text_address + text_size)
+        self.assertEqual(data_offset % 0x1000, 0)
+        self.assertEqual(data_address - data_offset, text_address - text_offset)
+        self.assertEqual(data_offset + data_size, len(executable))
+
+    @unittest.skipUnless(sys.platform == 'linux' and platform.machine() == 'x86_64', 'Runs a Linux executable')
+    def test_runs(self):
+        executable = self.build('examples/main.sf')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'main')
+            with open(path, 'wb') as file:
+                file.write(executable)
+            os.chmod(path, 0o755)
+            process = subprocess.run([path], capture_output=True)
+        self.assertEqual(process.stdout, b'Hello world!\nHello World 0123456789\nKaboom\n')
+        self.assertEqual(process.returncode, 7)
@@ -0,0 +1,19 @@
+from emitter import Emitter
+import unittest
+
+
+class EmitterTest(unittest.TestCase):
+    def test_assemble(self):
+        emit = Emitter()
+        emit.label('main')
+        emit.comment('x = 1')
+        emit.instruction('mov', 'rax', '1', comment='x')
+        emit.instruction('push', 'rax')
+        emit.instruction('ret')
+        self.assertEqual(emit.assemble(), 'main:\n\t; x = 1\n\tmov   rax, 1  \t\t; x\n\tpush  rax    \n\tret          \n')
+
+    def test_without_comments(self):
+        emit = Emitter(comments=False)
+        emit.comment('x = 1')
+        emit.instruction('mov', 'rax', '1', comment='x')
+        self.assertEqual(emit.assemble(), '\tmov   rax, 1  \n')
@@ -1,5 +1,8 @@
 from ir.ir_parser import parse
-from ir.ir_code import c, Op
+from ir.ir_code import c, Op, Code
+from ssa import check_if_in_ssa_form
+from type_checker import TypeChecker
+from x86_64_generator import X86_64_Generator
 import unittest
 
 
@@ -114,6 +117,66 @@ class TestFunction(unittest.TestCase):
             'end': set(),
         })
 
+    def test_analysis_worklist(self):
+        module = parse("""
+        @test()
+            $entry
+                x := 0
+                y := 10
+                jmp $header
+            $end
+                print x
+                ret
+            $body
+                one := 1
+                x := x + one
+                jmp $header
+            $header
+                cond := x < y
+                br cond $body $end
+        end
+        """)
+        function = module.functions['test']
+        self.assertEqual([b.label for b in function.reverse_postorder()], ['entry', 'header', 'end', 'body'])
+
+        live_in, live_out = function.live_variables()
+        self.assertDictEqual(live_in, {'entry': set(), 'header': {'x', 'y'}, 'body': {'x', 'y'}, 'end': {'x'}})
+        self.assertDictEqual(live_out, {'entry': {'x', 'y'}, 'header': {'x', 'y'}, 'body': {'x', 'y'}, 'end': set()})
+        # Backwards in postorder: 'body' is revisited once 'header' is known, and 'header' once more after it.
+        self.assertEqual(function.analysis_stats.transfers, 6)
+        self.assertEqual(function.analysis_stats.iterations, 2)
+
+        numbering, in_bits, _ = function.live_variable_bits()
+        self.assertEqual(numbering.decode(in_bits['body']), {'x', 'y'})
+        self.assertEqual(dict(function.live_in()), live_in)
+
+    def test_dce(self):
+        module = parse("""
+        @test()
+            $entry
+                x := 34
+                y := 35
+                unused := x + y         # Dead, never used
+                cond := x > y           # Only used by the terminator
+                br cond $left $right
+            $left
+                z := x + y
+                w := z + z              # Dead, and makes 'z' dead in the next round
+                jmp $end
+            $right
+                z := x + x
+                jmp $end
+            $end
+                print x
+                ret
+        end
+        """)
+        function = module.functions['test']
+        self.assertEqual(function.dce(), 4)
+        self.assertEqual([i.dest for i in function.blocks[0].instructions], ['x', 'y', 'cond'])
+        self.assertEqual(function.blocks[1].instructions, [])
+        self.assertEqual(function.blocks[2].instructions, [])
+
     def test_interval_analysis(self):
         module = parse("""
         @test()
@@ -231,6 +294,168 @@ class TestFunction(unittest.TestCase):
             7: {0, 1, 5, 6, 7},
         })
 
+    def test_dominance_frontiers(self):
+        module = parse("""
+        @test(cond: bool)
+            $0
+                jmp $1
+            $1
+                br cond $2 $4
+            $2
+                jmp $3
+            $3
+                br cond $1 $5
+            $4
+                jmp $5
+            $5
+                jmp $6
+            $6
+                br cond $5 $7
+            $7
+                ret cond
+        end
+        """)
+        function = module.functions['test']
+        self.assertDictEqual(function.immediate_dominators(), {0: None, 1: 0, 2: 1, 3: 2, 4: 1, 5: 1, 6: 5, 7: 6})
+        self.assertDictEqual(function.dominance_frontiers(), {
+            0: set(), 1: {1}, 2: {1, 5}, 3: {1, 5}, 4: {5}, 5: {5}, 6: {5}, 7: set(),
+        })
+
+        tree = function.dominator_tree()
+        self.assertEqual(tree.children[1], [2, 4, 5])
+        self.assertTrue(tree.dominates(1, 7))
+        self.assertTrue(tree.dominates(3, 3))
+        self.assertFalse(tree.dominates(4, 5))
+        self.assertFalse(tree.dominates(7, 1))
+
+    def test_lvn_diamond(self):
+        module = parse("""
+        @test(a: int, b: int, c: int, d: int, cond: bool)
+            $entry
+                e := a + b
+                br cond $left $right
+            $left
+                x := a + b
+                jmp $end
+            $right
+                x := c + d
+                jmp $end
+            $end
+                y := c + d      # 'x' only holds 'c + d' coming from the right
+                z := a + b      # 'e' holds 'a + b' on both paths
+                print y
+                print z
+                ret
+        end
+        """)
+        function = module.functions['test']
+        function.lvn()
+        entry, left, right, end = function.blocks
+        self.assertEqual(left.instructions, [])
+        self.assertEqual([(i.op, i.dest, i.refs) for i in right.instructions], [(Op.ADD, 'x', ('c', 'd'))])
+        self.assertEqual([(i.op, i.dest, i.refs) for i in end.instructions], [
+            (Op.ADD, 'y', ('c', 'd')),
+            (Op.PRINT, None, ('y', )),
+            (Op.PRINT, None, ('e', )),
+        ])
+
+    def test_to_ssa(self):
+        module = parse("""
+        @test(n: int)
+            $entry
+                i := 0
+                s := 0
+                one := 1
+                jmp $loop
+            $loop
+                s := s + i
+                i := i + one
+                cond := i < n
+                br cond $loop $end
+            $end
+                print s
+                ret
+        end
+        """)
+        function = module.functions['test']
+        function.to_ssa()
+        self.assertTrue(check_if_in_ssa_form(module))
+
+        entry, loop, end = function.blocks
+        self.assertEqual([i.dest for i in entry.instructions], ['i', 's', 'one'])
+        self.assertEqual([(i.op, i.dest, i.args, i.refs) for i in loop.instructions], [
+            (Op.PHI, "i'0", ('entry', 'loop'), ('i', "i'1")),
+            (Op.PHI, "s'0", ('entry', 'loop'), ('s', "s'1")),
+            (Op.ADD, "s'1", (), ("s'0", "i'0")),
+            (Op.ADD, "i'1", (), ("i'0", 'one')),
+            (Op.LT, 'cond', (), ("i'1", 'n')),
+        ])
+        self.assertEqual(end.instructions[0].refs, ("s'1", ))
+
+    def test_from_ssa_parallel_copies(self):
+        module = parse("""
+        @test(cond: bool)
+            $entry
+                a := 1
+                b := 2
+                jmp $loop
+            $loop
+                br cond $loop $end
+            $end
+                print a
+                ret
+        end
+        """)
+        function = module.functions['test']
+        entry, loop, end = function.blocks
+        # Swaps 'x' and 'y' on every iteration.
+        loop.instructions[0:0] = [
+            Code(Op.PHI, dest='x', args=('entry', 'loop'), refs=('a', 'y')),
+            Code(Op.PHI, dest='y', args=('entry', 'loop'), refs=('b', 'x')),
+        ]
+        function.invalidate()
+        function.from_ssa()
+
+        self.assertEqual(loop.instructions, [])
+        self.assertEqual([(i.dest, i.refs) for i in entry.instructions if i.op == Op.COPY], [('x', ('a', )), ('y', ('b', ))])
+        # The back edge is critical, so it gets a block of its own.
+        split = function.blocks[3]
+        self.assertEqual(loop.terminator.args, (3, 2))
+        self.assertEqual(split.terminator.args, (1, ))
+        self.assertEqual([(i.dest, i.refs) for i in split.instructions], [
+            ("x'copy0", ('y', )),
+            ('y', ('x', )),
+            ('x', ("x'copy0", )),
+        ])
+
+    def test_generating_leaves_ssa_form(self):
+        module = parse("""
+        @test()
+            $entry
+                i := 0
+                s := 0
+                one := 1
+                ten := 10
+                jmp $loop
+            $loop
+                s := s + i
+                i := i + one
+                cond := i < ten
+                br cond $loop $end
+            $end
+                ret
+        end
+        """)
+        function = module.functions['test']
+        function.to_ssa()
+        types = TypeChecker.check(module)
+        code = X86_64_Generator.generate(module, types)
+
+        # The generator takes a copy out of SSA form, so the module can be generated again.
+        self.assertEqual(len(function.blocks), 3)
+        self.assertEqual([i.op for i in function.blocks[1].instructions[:2]], [Op.PHI, Op.PHI])
+        self.assertEqual(X86_64_Generator.generate(module, types), code)
+
     def test_borrowing_ok(self):
         module = parse("""
         @test(cond: bool)
@@ -0,0 +1,73 @@
+import os
+import tempfile
+from pathlib import Path
+
+from import_cache import ImportCache
+from lexer import Lexer
+from parser import Parser
+import unittest
+
+
+class ImportCacheTest(unittest.TestCase):
+    def test_invalidated_by_content_not_mtime(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lib.sf')
+            Path(path).write_text('x := 1\n')
+
+            cache = ImportCache()
+            cache.store(path, 'x := 1\n', ('parsed', 1), [])
+            self.assertEqual(('parsed', 1), cache.load(path))
+
+            # Touched, same content.
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(('parsed', 1), cache.load(path))
+
+            Path(path).write_text('x := 2\n')
+            os.utime(path, ns=(1, 1))
+            self.assertIsNone(cache.load(path))
+
+    def test_invalidated_by_dependency(self):
+        with tempfile.TemporaryDirectory() as directory:
+            lib, dep = os.path.join(directory, 'lib.sf'), os.path.join(directory, 'dep.sf')
+            Path(lib).write_text('import * from dep\n')
+            Path(dep).write_text('y := 1\n')
+
+            cache = ImportCache()
+            cache.store(dep, 'y := 1\n', 'dep', [])
+            cache.store(lib, 'import * from dep\n', 'lib', [dep])
+
+            Path(dep).write_text('y := 2\n')
+            os.utime(dep, ns=(1, 1))
+            self.assertIsNone(cache.load(lib))
+
+    def test_persisted_between_caches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lib.sf')
+            Path(path).write_text('x := 1\n')
+
+            ImportCache(directory).store(path, 'x := 1\n', 'parsed', [])
+            cache = ImportCache(directory)
+            self.assertEqual('parsed', cache.load(path))
+            self.assertEqual(1, cache.hits)
+
+    def test_parse_with_cached_imports(self):
+        source = Path('examples/main.sf').read_text()
+
+        def parse_main():
+            module = Parser.parse_module(source, Lexer.lex_fast('main.sf', source), 'main.sf')
+            return {name: repr(f) for name, f in module.functions.items()}, module.data, sorted(module.imports)
+
+        previous, Parser.import_cache = Parser.import_cache, ImportCache()
+        try:
+            uncached = parse_main()
+            self.assertEqual(0, Parser.import_cache.hits)
+            cached = parse_main()
+            self.assertEqual(2, Parser.import_cache.hits)
+        finally:
+            Parser.import_cache = previous
+
+        self.assertEqual(uncached, cached)
+
+
+if __name__ == '__main__':
+    unittest.main()
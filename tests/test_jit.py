@@ -0,0 +1,42 @@
+import os
+
+from import_cache import ImportCache
+from ir import validate_ir, remove_unused_functions
+from jit import JIT
+from lexer import Lexer
+from parser import Parser
+from type_checker import TypeChecker
+from x86_64_generator import X86_64_Generator
+import unittest
+
+
+@unittest.skipUnless(JIT.supported(), 'Runs x86_64 code in this process')
+class JITTest(unittest.TestCase):
+
+    def generate(self, path):
+        cache, library = Parser.import_cache, Parser.system_library
+        Parser.import_cache, Parser.system_library = ImportCache(), JIT.TARGET.library
+        try:
+            source = open(path).read()
+            module = Parser.parse_module(source, Lexer.lex_fast(path, source), os.path.basename(path))
+            validate_ir(module)
+            remove_unused_functions(module)
+            types = TypeChecker.check(module)
+        finally:
+            Parser.import_cache, Parser.system_library = cache, library
+        return X86_64_Generator.generate(module, types, target=JIT.TARGET)
+
+    def test_runs(self):
+        written = []
+        status = JIT.run(*self.generate('examples/main.sf'), write=lambda fd, data: written.append((fd, data)))
+        self.assertEqual(status, 7)
+        self.assertEqual(b''.join(data for fd, data in written), b'Hello world!\nHello World 0123456789\nKaboom\n')
+        self.assertTrue(all(fd == 1 for fd, _ in written))
+
+    def test_runs_again(self):
+        # Every run gets fresh memory, so the allocator starts over.
+        code, data = self.generate('examples/struct.sf')
+        for _ in range(3):
+            written = []
+            self.assertEqual(JIT.run(code, data, write=lambda fd, text: written.append(text)), 32)
+            self.assertEqual(b''.join(written), b'Hello ted!\n11\n21\n')
@@ -0,0 +1,49 @@
+from pathlib import Path
+from lexer import Lexer, TokenBuffer, TokenStream
+import unittest
+
+
+def lex_with(lex, source):
+    try:
+        return [(t.kind, t.data, repr(t.begin), repr(t.end)) for t in lex('test', source)]
+    except Exception as e:
+        return type(e), str(e)
+
+
+class LexerTest(unittest.TestCase):
+    def assertSameTokens(self, source):
+        self.assertEqual(lex_with(Lexer.lex, source), lex_with(Lexer.lex_fast, source), repr(source))
+
+    def test_fast_lexer_on_examples(self):
+        for path in Path(__file__).parent.parent.glob('examples/*.sf'):
+            self.assertSameTokens(path.read_text())
+
+    def test_fast_lexer_edge_cases(self):
+        sources = [
+            '', 'a', 'x := 0x1F + 12.5 - 007', 'a <= b -> c += 1', '"text" "unterminated',
+            'x # comment', 'x #', '#\n', '/* block\n comment */ y', '/* unterminated +', '/*/ x',
+            '{[()]}', '(]', ')', '(', 'héllo ½ ٣4', '\r', '`',
+        ]
+        for source in sources:
+            self.assertSameTokens(source)
+
+    def test_token_stream_reads_from_buffer(self):
+        source = 'x := f(1, "a")'
+        tokens = Lexer.lex_fast('test', source)
+        self.assertIsInstance(tokens, TokenBuffer)
+        self.assertEqual(lex_with(Lexer.lex, source), lex_with(lambda _, s: TokenBuffer.from_tokens(Lexer.lex('test', s)), source))
+
+        stream = TokenStream(source, tokens, 'test')
+        self.assertEqual(stream.peek_kind(), 'ident')
+        self.assertEqual(stream.peek_kind(1), ':=')
+        self.assertTrue(stream.peek_if_all('ident', ':=', 'ident'))
+        self.assertEqual(stream.next('ident').data, b'x')
+        self.assertIsNone(stream.next_if('ident'))
+        self.assertEqual([t.kind for t in stream.next_if_all(':=', 'ident', '(')], [':=', 'ident', '('])
+        self.assertEqual(stream.previous_kind(), '(')
+        self.assertTrue(stream.peek_if_any('number', 'real'))
+        self.assertEqual([t.data for t in stream.peek_many(3)], [1, None, b'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
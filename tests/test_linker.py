@@ -0,0 +1,45 @@
+from import_cache import ImportCache
+from ir import validate_ir, remove_unused_functions
+from lexer import Lexer
+from linker import Linker, ObjectFile
+from parser import Parser
+from target import TARGETS
+from type_checker import TypeChecker
+from x86_64_encoder import X86_64_Encoder
+from x86_64_generator import X86_64_Generator
+import unittest
+
+
+class LinkerTest(unittest.TestCase):
+    def test_relocations(self):
+        caller = ObjectFile.assemble('main:\n    call add\n    lea rax, [rel value + 4]\n    ret\n')
+        self.assertEqual(caller.relocations, [(1, 'add'), (8, 'value')])
+        callee = ObjectFile.assemble('add:\n    ret\nvalue: dq 0, 0\n')
+
+        binary, sections = Linker.link([caller, callee], 0x1000)
+        self.assertEqual(sections, {'.text': 0x1000})
+        self.assertEqual(binary, X86_64_Encoder.assemble('org 0x1000\nmain:\n    call add\n    lea rax, [rel value + 4]\n    ret\nadd:\n    ret\nvalue: dq 0, 0\n'))
+
+    def test_undefined(self):
+        with self.assertRaises(RuntimeError):
+            ObjectFile.assemble('main:\n    jmp elsewhere\n')
+        with self.assertRaises(RuntimeError):
+            Linker.link([ObjectFile.assemble('main:\n    call elsewhere\n')], 0)
+
+    def test_same_as_assembled_together(self):
+        for target in TARGETS.values():
+            cache, library = Parser.import_cache, Parser.system_library
+            Parser.import_cache, Parser.system_library = ImportCache(), target.library
+            try:
+                source = open('examples/struct.sf').read()
+                module = Parser.parse_module(source, Lexer.lex_fast('struct.sf', source), 'struct.sf')
+                validate_ir(module)
+                remove_unused_functions(module)
+                types = TypeChecker.check(module)
+            finally:
+                Parser.import_cache, Parser.system_library = cache, library
+
+            code, data = X86_64_Generator.generate_functions(module, types, target=target)
+            objects = [ObjectFile.assemble(c) for c in code.values()]
+            executable, _ = target.make_executable('test', ''.join(code.values()), data)
+            self.assertEqual(target.link_executable(objects, data), executable)
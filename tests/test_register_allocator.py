@@ -0,0 +1,50 @@
+from lexer import Lexer
+from parser import Parser
+from register_allocator import LinearScan
+import unittest
+
+
+def parse_function(source, name):
+    module = Parser.parse_module(source, Lexer.lex_fast('test', source), 'test.sf')
+    return module.functions[name]
+
+
+class RegisterAllocatorTest(unittest.TestCase):
+    ARGUMENTS = ['rax', 'rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9']
+
+    def test_spills_when_out_of_registers(self):
+        values = [f'v{i}' for i in range(10)]
+        source = 'sum: (x: int) -> int {\n'
+        source += ''.join(f'\t{v} := x + {i}\n' for i, v in enumerate(values))
+        source += f'\treturn {" + ".join(values)}\n}}\n'
+        function = parse_function(source, 'sum')
+
+        allocation = LinearScan(['rax', 'rbx', 'rcx'], self.ARGUMENTS).allocate(function)
+        self.assertGreater(allocation.slots, 0)
+
+        intervals = list(allocation.intervals.values())
+        for i, a in enumerate(intervals):
+            self.assertIsNotNone(a.location, a)
+            for b in intervals[i+1:]:
+                first, second = sorted((a, b), key=lambda x: x.start)
+                # A result may take the register of an operand that dies where it's defined.
+                reused = first.end == second.start and (second.source == first.name or second.late)
+                overlaps = first.end >= second.start and not reused
+                self.assertFalse(overlaps and a.location == b.location, f'{a} and {b}')
+
+    def test_parameters_and_copies_share_registers(self):
+        function = parse_function('add: (a: int, b: int) -> int {\n\tc := a + b\n\treturn c\n}\n', 'add')
+        allocation = LinearScan(self.ARGUMENTS, self.ARGUMENTS).allocate(function)
+
+        self.assertEqual(allocation.location('a'), 'rax')
+        self.assertEqual(allocation.location('b'), 'rdi')
+        # The sum is computed in the register of 'a', and 'c' is declared in place.
+        self.assertEqual(allocation.location('c'), 'rax')
+        self.assertEqual(allocation.slots, 0)
+
+    def test_values_live_across_calls_are_callee_saved(self):
+        function = parse_function('f: (a: int) -> int {\n\tb := f(a)\n\treturn a + b\n}\n', 'f')
+        allocation = LinearScan(['rax', 'rdi', 'rbx'], self.ARGUMENTS, ('rbx', )).allocate(function)
+
+        self.assertEqual(allocation.location('a'), 'rbx')
+        self.assertEqual(allocation.location('b'), 'rax')
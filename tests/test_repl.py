@@ -0,0 +1,51 @@
+from import_cache import ImportCache
+from jit import JIT
+from parser import Parser
+from repl import ReplSession
+import unittest
+
+
+@unittest.skipUnless(JIT.supported(), 'Runs x86_64 code in this process')
+class ReplSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous = Parser.import_cache, Parser.system_library
+        Parser.import_cache, Parser.system_library = ImportCache(), JIT.TARGET.library
+        self.written = []
+        self.session = ReplSession(write=lambda fd, data: self.written.append(data))
+
+    def tearDown(self):
+        self.session.close()
+        Parser.import_cache, Parser.system_library = self.previous
+
+    def run_lines(self, *lines):
+        self.written.clear()
+        for line in lines:
+            self.assertIsNone(self.session.execute(line + '\n'), line)
+        return b''.join(self.written)
+
+    def test_variables_outlive_their_line(self):
+        self.assertEqual(self.run_lines('x := 5', 'y := x + 2', 'x = x * 10', 'a := print_int(x + y)'), b'57\n')
+        # Earlier lines aren't run again.
+        self.assertEqual(self.run_lines('b := print_int(y)'), b'7\n')
+
+    def test_functions_structs_and_loops(self):
+        output = self.run_lines(
+            'twice: (n: int) -> int { return n + n }',
+            'Person: struct { name: str, age: int }',
+            'p := Person { name = "ted", age = 21 }',
+            'i := 0',
+            'while i < 3 { e := print_int(twice(i))\n i = i + 1 }',
+            'a := print_int(p.age + i)',
+            'b := print(p.name, 3)',
+        )
+        self.assertEqual(output, b'0\n2\n4\n24\nted')
+
+    def test_errors_leave_the_session_as_is(self):
+        with self.assertRaises(RuntimeError):
+            self.session.execute('x := y\n')
+        self.assertEqual(self.run_lines('y := 1', 'x := print_int(y)'), b'1\n')
+
+    def test_exit(self):
+        self.run_lines('code := 3')
+        self.assertEqual(self.session.execute('exit(code)\n'), 3)
@@ -1,3 +1,4 @@
+from ir import Block, Code, Function, Module, Op
 from ir.ir_parser import parse
 from type_checker import TypeChecker
 from type import *
@@ -29,5 +30,70 @@ class TypeCheckerTest(unittest.TestCase):
             '_': PrimitiveType(name='int', size=8),
         }, types[function.name])
 
+    def test_checks_straight_line_code_once(self):
+        module = parse("""
+        @test_0()
+            $entry
+                n := 32
+                x := call alloc n
+                y := move x
+                _ := call print y
+                ret
+        end
+        """)
+        visited = []
+
+        class CountingChecker(TypeChecker):
+            pass
+        for op, handler in TypeChecker.HANDLERS.items():
+            CountingChecker.register(op, lambda checker, f, b, c, handler=handler: visited.append(c) or handler(checker, f, b, c))
+
+        checker = CountingChecker(module.name, module.source, module.functions, module.data, module.constants, module.types)
+        checker.check_()
+        self.assertEqual(len(visited), 5)
+        self.assertIsNot(TypeChecker.HANDLERS[Op.LIT], CountingChecker.HANDLERS[Op.LIT])
+
+    def test_loops_converge(self):
+        # 'a' is an int from the start, but it takes a trip around the loop for each phi to reach 'c'.
+        loop = Block('loop', [
+            Code(Op.PHI, dest='c', args=('entry', 'loop'), refs=('one', 'b2')),
+            Code(Op.PHI, dest='b', args=('entry', 'loop'), refs=('one', 'a2')),
+            Code(Op.PHI, dest='a', args=('entry', 'loop'), refs=('one', 'two')),
+            Code(Op.COPY, dest='a2', refs=('a', )),
+            Code(Op.COPY, dest='b2', refs=('b', )),
+        ], terminator=Code(Op.BR, args=(1, 2), refs=('one', )))
+        entry = Block('entry', [
+            Code(Op.LIT, dest='one', args=('int', 0, 1)),
+            Code(Op.LIT, dest='two', args=('int', 1, 2)),
+        ], terminator=Code(Op.JMP, args=(1, )))
+        function = Function('test', blocks=[entry, loop, Block('exit', [], terminator=Code(Op.RET))])
+        module = Module('test', '', {'test': function}, {}, {}, {}, {})
+
+        types = TypeChecker.check(module)['test']
+        for name in ('a', 'a2', 'b', 'b2', 'c'):
+            self.assertEqual(types[name], PrimitiveType(name='int', size=8), name)
+
+    def test_types_are_interned(self):
+        module = parse("""
+        @test_0()
+            $entry
+                n := 32
+                m := 32
+                x := call alloc n
+                y := call alloc m
+                ret
+        end
+        """)
+        types = TypeChecker.check(module)['test_0']
+        self.assertIs(types['n'], types['m'])
+        self.assertIs(types['x'], types['y'])
+
+        registry = TypeRegistry()
+        char = registry.intern(PrimitiveType(name='char', size=1))
+        self.assertIs(registry.intern(PointerType(char)), registry.intern(PointerType(PrimitiveType(name='char', size=1))))
+        self.assertIsNot(registry.intern(ArrayType(char, 3)), registry.intern(ArrayType(char, 4)))
+        self.assertTrue(registry.is_subtype(LiteralType(3), PrimitiveType(name='int', size=8)))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
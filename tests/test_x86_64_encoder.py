@@ -0,0 +1,70 @@
+from x86_64_encoder import X86_64_Encoder
+import unittest
+
+
+def assemble(source):
+    return X86_64_Encoder.assemble('BITS 64\n' + source)
+
+
+class X86_64_EncoderTest(unittest.TestCase):
+    def test_instructions(self):
+        # Expected bytes are from GNU as, except that 'mov r64, imm' uses the
+        # shorter 32-bit form for values that zero-extend, like nasm does.
+        cases = {
+            'mov rax, rdi':             '4889f8',
+            'mov r11, 1':               '41bb01000000',
+            'mov rax, -1':              '48c7c0ffffffff',
+            'mov rax, 0x100000000':     '48b80000000001000000',
+            'mov [rsp + 16], r11':      '4c895c2410',
+            'mov r11, [rbp - 1024]':    '4c8b9d00fcffff',
+            'mov [rax], dil':           '408838',
+            'mov [r13], rax':           '49894500',
+            'add rax, 1000':            '4805e8030000',
+            'sub rsp, 24':              '4883ec18',
+            'imul rcx, rsi':            '480fafce',
+            'idiv r11':                 '49f7fb',
+            'cmp r9, rdx':              '4939d1',
+            'cmovnz rax, r11':          '490f45c3',
+            'test rdi, rdi':            '4885ff',
+            'lea r8, [rsi + rdi]':      '4c8d043e',
+            'lea rax, [r13 + rax*2 - 300]': '498d8445d4feffff',
+            'push r15':                 '4157',
+            'pop rbx':                  '5b',
+            'cqo':                      '4899',
+            'syscall':                  '0f05',
+        }
+        for source, expected in cases.items():
+            self.assertEqual(assemble(source).hex(), expected, source)
+
+    def test_jumps_grow_when_out_of_range(self):
+        code = assemble('main:\n\tjmp .end\n\tje .end\n\ttimes 100 nop\n.end:\n\tret\n')
+        self.assertEqual(code[:4].hex(), 'eb66' + '7464')
+
+        code = assemble('main:\n\tjmp .end\n\tje .end\n\ttimes 200 nop\n.end:\n\tret\n')
+        self.assertEqual(code[:11].hex(), 'e9ce000000' + '0f84c8000000')
+
+        code = assemble('main:\n\tcall main\n')
+        self.assertEqual(code.hex(), 'e8fbffffff')
+
+    def test_labels_and_data(self):
+        code = X86_64_Encoder.assemble(
+            'BITS 64\norg 0x1000\n'
+            'start:\n\tlea rsi, [rel memory.ptr]\n\tret\n'
+            'section .data\nalign 16\nmemory:\n.ptr: dq 0\n'
+            'text: db `a\\n`, 0\n'
+            'times 32-($-memory) db 0xFF\n'
+        )
+        # 'memory.ptr' is at 0x1010, and the instruction ends at 0x1007.
+        self.assertEqual(code[:7].hex(), '488d3509000000')
+        self.assertEqual(code[8:16], bytes(8))
+        self.assertEqual(code[16:24], bytes(8))
+        self.assertEqual(code[24:27], b'a\n\x00')
+        self.assertEqual(code[27:], b'\xFF' * 21)
+
+    def test_errors(self):
+        with self.assertRaises(RuntimeError):
+            assemble('jmp nowhere\n')
+        with self.assertRaises(RuntimeError):
+            assemble('mov rax, eax\n')
+        with self.assertRaises(RuntimeError):
+            assemble('mov [rax], 1\n')